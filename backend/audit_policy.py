@@ -0,0 +1,100 @@
+"""
+请求审计策略（按路由模板和方法）
+- always 每个请求记录一条日志（写操作、认证事件、敏感读取）
+- sample 按百分比抽样记录，如 sample:10 表示记录约 10% 的请求
+- count  只计数，按 AUDIT_AGGREGATE_INTERVAL_SECONDS 周期汇总为每用户每路由一条日志
+- skip   不记录
+失败的请求（状态码 >= 400 或抛出异常）除 skip 外始终逐条记录
+未列出的写操作按 always 处理，未列出的读操作按 AUDIT_DEFAULT_READ_POLICY 处理
+AUDIT_ROUTE_POLICIES 可覆盖或补充下表，如 "GET /api/user/logs=sample:5,GET /api/keys=count"
+"""
+import random
+from typing import Dict, Tuple
+from config import settings
+
+ALWAYS = "always"
+SAMPLE = "sample"
+COUNT = "count"
+SKIP = "skip"
+AUDIT_MODES = (ALWAYS, SAMPLE, COUNT, SKIP)
+
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# (方法, 路由模板) -> (策略, 抽样百分比)
+ROUTE_POLICIES: Dict[Tuple[str, str], Tuple[str, int]] = {
+    # 高频读取：只计数
+    ("GET", "/api/user/dashboard"): (COUNT, 0),
+    ("GET", "/api/keys/providers"): (COUNT, 0),
+    ("GET", "/api/keys/models"): (COUNT, 0),
+    ("GET", "/api/keys/models/{provider_id}"): (COUNT, 0),
+    ("GET", "/api/totp/status"): (COUNT, 0),
+    ("GET", "/api/me"): (COUNT, 0),
+    ("GET", "/api/user/log-actions"): (COUNT, 0),
+    ("GET", "/api/auth/log-actions"): (COUNT, 0),
+    # 列表和统计查询：抽样
+    ("GET", "/api/keys"): (SAMPLE, 10),
+    ("GET", "/api/user/logs"): (SAMPLE, 10),
+    ("GET", "/api/auth/logs"): (SAMPLE, 10),
+    ("GET", "/api/user/login-history"): (SAMPLE, 10),
+    ("GET", "/api/auth/login-history"): (SAMPLE, 10),
+    ("GET", "/api/user/login-stats"): (SAMPLE, 10),
+    ("GET", "/api/user/token-usage"): (SAMPLE, 10),
+    ("GET", "/api/user/token-stats"): (SAMPLE, 10),
+    ("GET", "/api/user/balances"): (SAMPLE, 10),
+    ("GET", "/api/user/renewals"): (SAMPLE, 10),
+    ("GET", "/api/user/renewals/summary"): (SAMPLE, 10),
+    # 敏感读取：返回明文密钥、重新生成 TOTP、备用码
+    ("GET", "/api/keys/{key_id}"): (ALWAYS, 100),
+    ("GET", "/api/totp/regenerate"): (ALWAYS, 100),
+    ("GET", "/api/totp/backup-codes"): (ALWAYS, 100),
+}
+
+
+def parse_policy(value: str) -> Tuple[str, int]:
+    """解析策略字符串（always / sample:N / count / skip），无法识别时返回 always"""
+    mode, _, percent = value.strip().lower().partition(":")
+    if mode == SAMPLE:
+        try:
+            return SAMPLE, min(max(int(percent or "10"), 0), 100)
+        except ValueError:
+            return SAMPLE, 10
+    if mode in AUDIT_MODES:
+        return mode, 100 if mode == ALWAYS else 0
+    return ALWAYS, 100
+
+
+def _load_overrides(spec: str) -> Dict[Tuple[str, str], Tuple[str, int]]:
+    overrides = {}
+    for item in spec.split(","):
+        route, _, policy = item.partition("=")
+        method, _, path = route.strip().partition(" ")
+        if method and path and policy:
+            overrides[(method.upper(), path.strip())] = parse_policy(policy)
+    return overrides
+
+
+_policies = {**ROUTE_POLICIES, **_load_overrides(settings.AUDIT_ROUTE_POLICIES)}
+_default_read_policy = parse_policy(settings.AUDIT_DEFAULT_READ_POLICY)
+
+
+def resolve_policy(method: str, route_path: str) -> Tuple[str, int]:
+    """返回 (策略, 抽样百分比)"""
+    policy = _policies.get((method, route_path))
+    if policy is not None:
+        return policy
+    return _default_read_policy if method in READ_METHODS else (ALWAYS, 100)
+
+
+def should_log(method: str, route_path: str, failed: bool) -> str:
+    """
+    判断本次请求的处理方式：返回 always（逐条记录）、count（计入汇总）或 skip
+    抽样未命中的请求返回 skip
+    """
+    mode, percent = resolve_policy(method, route_path)
+    if mode == SKIP:
+        return SKIP
+    if failed or mode == ALWAYS:
+        return ALWAYS
+    if mode == SAMPLE:
+        return ALWAYS if random.random() * 100 < percent else SKIP
+    return COUNT
@@ -0,0 +1,224 @@
+"""
+异步批量审计日志写入
+- 中间件只把日志行放入有界内存队列，不在请求路径上访问数据库
+- 后台任务按数量（AUDIT_BATCH_SIZE）或时间（AUDIT_FLUSH_INTERVAL_MS）攒批，一个事务批量插入
+- 数据库写入在线程中执行，不阻塞事件循环
+- 队列满时的策略（AUDIT_OVERFLOW_POLICY）：
+  drop   直接丢弃新日志
+  sample 队列超过 80% 后只保留每 AUDIT_SAMPLE_RATE 条中的 1 条（失败请求始终保留），满了丢弃
+  block  等待队列有空位（请求会被拖慢，但不丢日志）
+- 只计数的请求（audit_policy 中的 count 策略）在内存中按 (用户, 方法, 路由) 累加，
+  每 AUDIT_AGGREGATE_INTERVAL_SECONDS 汇总为一条"访问汇总"日志
+- 关闭时写完队列中剩余的日志和未汇总的计数
+- AUDIT_STORAGE=segments 时批量追加到分段文件（segment_log），不写数据库
+"""
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, Optional
+from config import settings
+from database import engine
+from models_v2 import LogEntry
+from segment_log import segments_enabled, get_segment_store
+from count_cache import invalidate_counts
+
+OVERFLOW_POLICIES = ("drop", "sample", "block")
+
+# sample 策略开始采样的队列占用比例
+SAMPLE_THRESHOLD = 0.8
+
+# 关闭信号（放入队列，写入任务处理完之前的日志后退出）
+_STOP = object()
+
+
+class AuditLogWriter:
+    """有界队列 + 后台批量写入"""
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float,
+                 overflow_policy: str = "drop", sample_rate: int = 10,
+                 aggregate_interval: float = 60):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy if overflow_policy in OVERFLOW_POLICIES else "drop"
+        self.sample_rate = max(1, sample_rate)
+        self.aggregate_interval = aggregate_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._aggregate_task: Optional[asyncio.Task] = None
+        self._sample_counter = 0
+        # (用户ID, 用户名, 方法, 路由) -> 请求次数
+        self._counters: Dict[tuple, int] = {}
+        self._window_start = datetime.utcnow()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.failed = 0
+        self.batches = 0
+        self.counted = 0
+        self.aggregates = 0
+
+    def start(self):
+        """在事件循环中启动后台写入任务（应用启动时调用）"""
+        if self._task is None:
+            loop = asyncio.get_running_loop()
+            self._queue = asyncio.Queue(maxsize=self.queue_size)
+            self._task = loop.create_task(self._run())
+            self._aggregate_task = loop.create_task(self._aggregate_loop())
+
+    async def stop(self):
+        """停止后台任务并写完剩余日志（应用关闭时调用）"""
+        if self._task is None:
+            return
+        self._aggregate_task.cancel()
+        self._aggregate_task = None
+        await self.flush_counters()
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+        # 停止信号之后才入队的日志直接写入
+        remaining = []
+        while not self._queue.empty():
+            remaining.append(self._queue.get_nowait())
+        self._queue = None
+        if remaining:
+            await asyncio.to_thread(self._write, remaining)
+
+    async def submit(self, entry: dict):
+        """提交一条日志（LogEntry 列名 -> 值），按溢出策略处理队列满的情况"""
+        if self._queue is None:
+            # 写入任务未启动（如脚本或测试中直接使用应用），退化为同步写入
+            await asyncio.to_thread(self._write, [entry])
+            return
+        entry.setdefault("created_at", datetime.utcnow())
+
+        if self.overflow_policy == "block":
+            await self._queue.put(entry)
+            self.queued += 1
+            return
+
+        if (self.overflow_policy == "sample" and entry.get("status") != "failed"
+                and self._queue.qsize() >= self.queue_size * SAMPLE_THRESHOLD):
+            self._sample_counter += 1
+            if self._sample_counter % self.sample_rate:
+                self.sampled_out += 1
+                return
+
+        try:
+            self._queue.put_nowait(entry)
+            self.queued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def count(self, user_id: int, username: str, method: str, route: str):
+        """只计数的请求：累加到当前汇总周期"""
+        key = (user_id, username, method, route)
+        self._counters[key] = self._counters.get(key, 0) + 1
+        self.counted += 1
+        if self._queue is None:
+            # 写入任务未启动时没有周期汇总，立即写出
+            await self.flush_counters()
+
+    async def flush_counters(self):
+        """把当前周期的计数汇总为日志（每个用户每个路由一条）"""
+        counters, self._counters = self._counters, {}
+        window_start, self._window_start = self._window_start, datetime.utcnow()
+        for (user_id, username, method, route), count in counters.items():
+            self.aggregates += 1
+            await self.submit({
+                "user_id": user_id,
+                "username": username,
+                "action": "访问汇总",
+                "resource_type": "SYSTEM",
+                "resource_id": None,
+                "resource_name": route,
+                "ip_address": None,
+                "user_agent": None,
+                "status": "success",
+                "error_message": None,
+                "details": {
+                    "method": method,
+                    "route": route,
+                    "count": count,
+                    "window_start": window_start.isoformat(),
+                    "window_seconds": round((self._window_start - window_start).total_seconds()),
+                },
+                "created_at": window_start,
+            })
+
+    async def _aggregate_loop(self):
+        while True:
+            await asyncio.sleep(self.aggregate_interval)
+            await self.flush_counters()
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            await asyncio.to_thread(self._write, batch)
+
+    def _write(self, batch: list):
+        """一个事务批量插入（或一次追加到分段文件）；整批失败时逐条重试，只丢弃有问题的行"""
+        try:
+            if segments_enabled():
+                get_segment_store().append(batch)
+            else:
+                with engine.begin() as conn:
+                    conn.execute(LogEntry.__table__.insert(), batch)
+            invalidate_counts("logs", (entry["user_id"] for entry in batch))
+            self.written += len(batch)
+            self.batches += 1
+            return
+        except Exception as e:
+            if len(batch) == 1:
+                self.failed += 1
+                print(f"Failed to log request: {e}")
+                return
+        for entry in batch:
+            self._write([entry])
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.overflow_policy,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "failed": self.failed,
+            "batches": self.batches,
+            "counted": self.counted,
+            "aggregates": self.aggregates,
+            "pending_counters": len(self._counters),
+        }
+
+
+audit_writer = AuditLogWriter(
+    queue_size=settings.AUDIT_QUEUE_SIZE,
+    batch_size=settings.AUDIT_BATCH_SIZE,
+    flush_interval=settings.AUDIT_FLUSH_INTERVAL_MS / 1000,
+    overflow_policy=settings.AUDIT_OVERFLOW_POLICY,
+    sample_rate=settings.AUDIT_SAMPLE_RATE,
+    aggregate_interval=settings.AUDIT_AGGREGATE_INTERVAL_SECONDS,
+)
+
+
+def get_audit_writer_stats() -> dict:
+    return audit_writer.stats()
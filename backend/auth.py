@@ -3,22 +3,109 @@
 - JWT Token生成/验证
 - 密码哈希
 - 用户身份验证
+- 已认证用户缓存
+- 会话令牌签发与撤销检查
+- 接口中的密码哈希在独立进程池中执行（hash_pool）
 """
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
 from config import settings
 from database import get_db
 from models_v2 import User
+from session_store import new_jti, record_session, is_token_revoked
+from hash_pool import get_hash_pool
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# rounds 固定为 BCRYPT_ROUNDS，不同 rounds 的哈希 needs_update 返回 True
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 
+class UserCache:
+    """
+    已认证用户的有界 TTL 缓存（按 JWT subject 索引）
+    缓存的是用户行的列快照，命中时合并到当前会话，不产生数据库查询
+    每个用户有一个版本戳，失效时递增；查询期间发生失效的结果不会写入缓存
+    缓存仅在进程内有效，多 worker 部署时其他进程依赖 TTL 过期
+    命中/未命中计数由 /metrics 导出（app_user_cache_hits / app_user_cache_misses）
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._stamps = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stamp(self, username: str) -> int:
+        with self._lock:
+            return self._stamps.get(username, 0)
+
+    def get(self, username: str) -> Optional[dict]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is None or entry[1] <= now or entry[2] != self._stamps.get(username, 0):
+                if entry is not None:
+                    del self._entries[username]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, username: str, snapshot: dict, stamp: int):
+        with self._lock:
+            if stamp != self._stamps.get(username, 0):
+                return
+            self._entries[username] = (snapshot, time.monotonic() + self.ttl_seconds, stamp)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self._lock:
+            self._entries.pop(username, None)
+            self._stamps[username] = self._stamps.get(username, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
+
+_user_columns = [attr.key for attr in sa_inspect(User).column_attrs]
+
+
+def invalidate_user_cache(username: str):
+    """
+    用户行发生变化后调用（修改密码、删除账户、锁定、禁用、登录状态更新）
+    """
+    user_cache.invalidate(username)
+
+
+def get_user_cache_stats() -> dict:
+    """用户缓存命中统计（metrics.component_stats 读取，导出为 app_user_cache_*）"""
+    return user_cache.stats()
+
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """验证密码"""
     return pwd_context.verify(plain_password, hashed_password)
@@ -29,6 +116,31 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """哈希算法或 rounds 与当前配置不一致（只解析哈希头，不做计算）"""
+    return pwd_context.needs_update(hashed_password)
+
+
+def verify_password_pooled(plain_password: str, hashed_password: str) -> bool:
+    """在哈希进程池中验证密码（同步接口使用，队列满时返回 503）"""
+    return get_hash_pool().run(verify_password, plain_password, hashed_password)
+
+
+def get_password_hash_pooled(password: str) -> str:
+    """在哈希进程池中生成密码哈希（同步接口使用）"""
+    return get_hash_pool().run(get_password_hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """在哈希进程池中验证密码（async 接口使用，不阻塞事件循环）"""
+    return await get_hash_pool().run_async(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    """在哈希进程池中生成密码哈希（async 接口使用）"""
+    return await get_hash_pool().run_async(get_password_hash, password)
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """创建JWT访问令牌"""
     to_encode = data.copy()
@@ -41,6 +153,17 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     return encoded_jwt
 
 
+def issue_access_token(db: Session, user: User, ip: str = None, ua: str = None,
+                       commit: bool = True) -> str:
+    """签发带 jti 的访问令牌并记录会话（可被撤销），commit=False 时由调用方提交"""
+    jti = new_jti()
+    expires_delta = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    expires_at = datetime.utcnow() + expires_delta
+    token = create_access_token(data={"sub": user.username, "jti": jti}, expires_delta=expires_delta)
+    record_session(db, jti, user.id, expires_at, ip, ua, commit)
+    return token
+
+
 def decode_token(token: str) -> Optional[dict]:
     """解码JWT令牌"""
     try:
@@ -50,7 +173,33 @@ def decode_token(token: str) -> Optional[dict]:
         return None
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+def load_user(db: Session, username: str) -> Optional[User]:
+    """按用户名获取用户（优先读缓存），返回绑定到当前会话的实例"""
+    snapshot = user_cache.get(username)
+    if snapshot is not None:
+        cached = User(**snapshot)
+        make_transient_to_detached(cached)
+        return db.merge(cached, load=False)
+
+    stamp = user_cache.stamp(username)
+    user = db.query(User).filter(User.username == username).first()
+    if user is not None:
+        user_cache.put(username, {key: getattr(user, key) for key in _user_columns}, stamp)
+    return user
+
+
+def set_request_user(request: Request, user: User):
+    """
+    把已认证的用户写入请求上下文（request.state），
+    中间件（审计日志等）直接读取，不再重复解析 token 和查询用户
+    只保存 ID 和用户名，请求结束、数据库会话关闭后仍可安全读取
+    """
+    request.state.user_id = user.id
+    request.state.username = user.username
+
+
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme),
+                     db: Session = Depends(get_db)) -> User:
     """获取当前用户"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -66,7 +215,10 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     if username is None:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == username).first()
+    if is_token_revoked(payload.get("jti")):
+        raise credentials_exception
+    
+    user = load_user(db, username)
     if user is None:
         raise credentials_exception
     
@@ -77,4 +229,5 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     if user.locked_until and user.locked_until > datetime.utcnow():
         raise HTTPException(status_code=400, detail="账户已暂时锁定")
     
+    set_request_user(request, user)
     return user
\ No newline at end of file
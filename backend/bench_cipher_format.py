@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+密文格式基准测试：Fernet 文本 vs AES-GCM 二进制
+对比单行存储大小和解密吞吐量
+运行方式: python bench_cipher_format.py [密钥数量，默认 1000000]
+"""
+import secrets
+import sys
+import time
+from config import settings
+from key_crypto import KeyRing, keys_from_settings
+
+
+def measure_decrypt(decrypt, ciphertexts: list) -> float:
+    """返回每秒解密次数"""
+    start = time.perf_counter()
+    for ciphertext in ciphertexts:
+        decrypt(ciphertext)
+    return len(ciphertexts) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    keyring = KeyRing(keys_from_settings(), settings.ENCRYPTION_KEY_VERSION)
+    # 典型的服务商密钥长度（sk- 前缀 + 48 字符）
+    plaintexts = [f"sk-{secrets.token_urlsafe(36)}" for _ in range(count)]
+
+    fernet_tokens = [keyring.encrypt(p) for p in plaintexts]
+    aesgcm_blobs = [keyring.encrypt_bytes(p) for p in plaintexts]
+
+    plain_size = sum(len(p) for p in plaintexts)
+    fernet_size = sum(len(t) for t in fernet_tokens)
+    aesgcm_size = sum(len(b) for b in aesgcm_blobs)
+
+    fernet_rate = measure_decrypt(keyring.decrypt, fernet_tokens)
+    aesgcm_rate = measure_decrypt(keyring.decrypt_bytes, aesgcm_blobs)
+
+    print("=" * 50)
+    print(f"密文格式对比（{count} 个密钥）")
+    print("=" * 50)
+    print(f"明文平均长度:   {plain_size / count:.1f} 字节")
+    print(f"Fernet 平均长度: {fernet_size / count:.1f} 字节 ({fernet_size / plain_size:.2f}x)")
+    print(f"AES-GCM 平均长度: {aesgcm_size / count:.1f} 字节 ({aesgcm_size / plain_size:.2f}x)")
+    print(f"Fernet 解密:  {fernet_rate:,.0f} 次/秒")
+    print(f"AES-GCM 解密: {aesgcm_rate:,.0f} 次/秒 ({aesgcm_rate / fernet_rate:.1f}x)")
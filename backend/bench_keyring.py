@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+密钥揭示（GET /api/keys/{key_id}）解密延迟基准测试
+对比：每次调用重新派生 PBKDF2 密钥 vs 进程级密钥环
+运行方式: python bench_keyring.py [次数]
+"""
+import sys
+import time
+from cryptography.fernet import Fernet
+from config import settings
+from key_crypto import KeyRing, derive_fernet_key, keys_from_settings, parse_token
+
+
+def decrypt_per_call(token: str) -> str:
+    """旧实现：每次解密都重新派生密钥"""
+    f = Fernet(derive_fernet_key(settings.API_KEY_ENCRYPTION_KEY, settings.ENCRYPTION_SALT))
+    return f.decrypt(parse_token(token)[1].encode()).decode()
+
+
+def measure(func, token: str, rounds: int) -> float:
+    """返回单次调用平均耗时（毫秒）"""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(token)
+    return (time.perf_counter() - start) * 1000 / rounds
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+    keyring = KeyRing(keys_from_settings(), settings.ENCRYPTION_KEY_VERSION)
+    token = keyring.encrypt("sk-bench-0123456789abcdefghijklmnopqrstuvwxyz")
+
+    before = measure(decrypt_per_call, token, rounds)
+    after = measure(keyring.decrypt, token, rounds * 100)
+
+    print("=" * 50)
+    print("密钥揭示解密延迟")
+    print("=" * 50)
+    print(f"每次派生密钥: {before:.3f} ms/次")
+    print(f"进程级密钥环: {after:.4f} ms/次")
+    print(f"加速比: {before / after:.0f}x")
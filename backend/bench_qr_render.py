@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+注册第一步（/api/register/step1）二维码渲染基准测试
+1. 单独渲染：旧实现（每次新建 QRCode + make_image PNG）vs 渲染服务 png / svg / uri
+2. 接口吞吐：各模式下 register/step1 的每秒请求数
+   默认用固定哈希替换 bcrypt（bcrypt 耗时与二维码格式无关），--with-hash 时保留真实哈希
+运行方式: python bench_qr_render.py [请求数，默认 300] [--with-hash]
+"""
+import base64
+import io
+import os
+import sys
+import tempfile
+import time
+
+# 基准测试使用独立的临时数据库
+_db_file = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_db_file.name}")
+os.environ.setdefault("REGISTRATION_STORE", "memory")
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from database import Base, engine
+from qr_render import QRRenderer, build_totp_uri, QR_MODES
+from totp_utils import generate_totp_secret
+from routers import auth as auth_router
+
+
+def legacy_png(uri: str) -> str:
+    """旧实现：每次请求新建 QRCode 对象并通过 make_image 生成 PNG"""
+    import qrcode
+    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    qr.add_data(uri)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def measure(func, uris: list) -> tuple:
+    """返回 (每秒次数, 平均输出字节数)"""
+    start = time.perf_counter()
+    sizes = [len(func(uri) or "") for uri in uris]
+    return len(uris) / (time.perf_counter() - start), sum(sizes) / len(sizes)
+
+
+def bench_endpoint(client: TestClient, mode: str, count: int) -> float:
+    """返回 register/step1 每秒请求数"""
+    start = time.perf_counter()
+    for i in range(count):
+        response = client.post(f"/api/register/step1?qr_format={mode}",
+                               json={"username": f"bench_{mode}_{i}", "password": "Bench-Passw0rd"})
+        assert response.status_code == 200, response.text
+    return count / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 300
+    with_hash = "--with-hash" in sys.argv
+
+    uris = [build_totp_uri(f"user{i}", generate_totp_secret()) for i in range(count)]
+    renderer = QRRenderer(workers=2)
+
+    print("=" * 60)
+    print(f"二维码渲染（{count} 次，每次新密钥）")
+    print("=" * 60)
+    rate, size = measure(legacy_png, uris)
+    print(f"旧实现 PNG:      {rate:8.1f} 次/秒  平均 {size / 1024:6.1f} KB")
+    for mode in QR_MODES:
+        rate, size = measure(lambda uri: renderer.render(uri, mode)["qr_code"], uris)
+        print(f"渲染服务 {mode:<4}:   {rate:8.1f} 次/秒  平均 {size / 1024:6.1f} KB")
+
+    Base.metadata.create_all(bind=engine)
+    auth_router.limiter.enabled = False
+    if not with_hash:
+        auth_router.get_password_hash_pooled = lambda password: "$2b$12$" + "x" * 53
+    app = FastAPI()
+    app.include_router(auth_router.router)
+    client = TestClient(app)
+
+    print("=" * 60)
+    print(f"POST /api/register/step1（{count} 次，{'含' if with_hash else '不含'} bcrypt）")
+    print("=" * 60)
+    for mode in QR_MODES:
+        print(f"qr_format={mode:<4}: {bench_endpoint(client, mode, count):8.1f} 请求/秒")
+
+    os.unlink(_db_file.name)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+bcrypt 成本校准
+在当前主机上测量不同 rounds 的哈希耗时，推荐不超过目标延迟的最大 rounds
+设置 BCRYPT_ROUNDS 后，用户下次登录时旧哈希会自动按新 rounds 重新生成
+
+运行方式: python calibrate_bcrypt.py [--target-ms 250] [--samples 5] [--write ../.env]
+"""
+import argparse
+import os
+import re
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from passlib.hash import bcrypt
+from config import settings
+
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+
+
+def measure_rounds(rounds: int, samples: int) -> float:
+    """返回指定 rounds 下单次哈希耗时的中位数（毫秒）"""
+    hasher = bcrypt.using(rounds=rounds)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hasher.hash("calibration-Passw0rd!")
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def calibrate(target_ms: float, samples: int) -> int:
+    """逐级增加 rounds，返回耗时不超过目标的最大值（至少 MIN_ROUNDS）"""
+    recommended = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, MAX_ROUNDS + 1):
+        elapsed = measure_rounds(rounds, samples)
+        marker = "  <-- 当前配置" if rounds == settings.BCRYPT_ROUNDS else ""
+        print(f"  rounds={rounds:<3} {elapsed:8.1f} ms{marker}")
+        if elapsed > target_ms:
+            break
+        recommended = rounds
+        # 每增加 1 轮耗时翻倍，下一级必然超过目标时提前结束
+        if elapsed * 2 > target_ms:
+            print(f"  rounds={rounds + 1:<3} {elapsed * 2:8.1f} ms（估算）")
+            break
+    return recommended
+
+
+def write_env(path: Path, rounds: int):
+    """在 env 文件中设置 BCRYPT_ROUNDS（已存在则替换）"""
+    content = path.read_text(encoding="utf-8") if path.exists() else ""
+    line = f"BCRYPT_ROUNDS={rounds}"
+    if re.search(r"^BCRYPT_ROUNDS=.*$", content, flags=re.M):
+        content = re.sub(r"^BCRYPT_ROUNDS=.*$", line, content, flags=re.M)
+    else:
+        content = content.rstrip("\n") + ("\n" if content else "") + line + "\n"
+    path.write_text(content, encoding="utf-8")
+    print(f"✅ 已写入 {path}: {line}（重启服务后生效）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="测量 bcrypt 哈希耗时并推荐 rounds")
+    parser.add_argument("--target-ms", type=float, default=250, help="单次哈希目标耗时（毫秒）")
+    parser.add_argument("--samples", type=int, default=5, help="每个 rounds 的采样次数")
+    parser.add_argument("--write", type=Path, default=None, help="将结果写入指定 env 文件")
+    args = parser.parse_args()
+
+    print("=" * 50)
+    print(f"bcrypt 成本校准（目标 {args.target_ms:.0f} ms，CPU 核数 {os.cpu_count()}）")
+    print("=" * 50)
+    rounds = calibrate(args.target_ms, args.samples)
+    print(f"推荐 BCRYPT_ROUNDS={rounds}（当前 {settings.BCRYPT_ROUNDS}）")
+
+    if args.write:
+        write_env(args.write, rounds)
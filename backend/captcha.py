@@ -1,11 +1,17 @@
 """
 验证码生成和验证模块
+- 字体只加载一次
+- 预渲染池：后台线程持续补充 (token, 图片)，接口只从池中取出，不在请求中绘图
 """
 import random
 import string
 import io
+import base64
 import hashlib
+import threading
 import time
+from collections import deque
+from typing import Optional
 from PIL import Image, ImageDraw, ImageFont
 from jose import jwt
 from config import settings
@@ -13,6 +19,38 @@ from config import settings
 # 验证码有效期（秒）
 CAPTCHA_EXPIRE_SECONDS = 300  # 5分钟
 
+# 池中条目的最长存放时间，超过后丢弃（保证取出后仍有足够的有效期）
+CAPTCHA_POOL_MAX_AGE = CAPTCHA_EXPIRE_SECONDS // 2
+
+# 依次尝试的字体，都不可用时使用 Pillow 内置字体
+FONT_CANDIDATES = [
+    "arial.ttf",
+    "DejaVuSans.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/usr/share/fonts/dejavu/DejaVuSans.ttf",
+]
+
+_font = None
+_font_lock = threading.Lock()
+
+
+def get_captcha_font():
+    """加载验证码字体（进程内只加载一次）"""
+    global _font
+    if _font is None:
+        with _font_lock:
+            if _font is None:
+                candidates = [settings.CAPTCHA_FONT_PATH] if settings.CAPTCHA_FONT_PATH else []
+                for path in candidates + FONT_CANDIDATES:
+                    try:
+                        _font = ImageFont.truetype(path, 28)
+                        break
+                    except OSError:
+                        continue
+                else:
+                    _font = ImageFont.load_default(size=28)
+    return _font
+
 def generate_captcha_text(length: int = 4) -> str:
     """生成随机验证码文本"""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
@@ -26,11 +64,7 @@ def generate_captcha_image(text: str) -> bytes:
     image = Image.new('RGB', (width, height), color=(255, 255, 255))
     draw = ImageDraw.Draw(image)
     
-    # 使用默认字体（如果系统有其他字体可以指定）
-    try:
-        font = ImageFont.truetype("arial.ttf", 28)
-    except:
-        font = ImageFont.load_default()
+    font = get_captcha_font()
     
     # 绘制干扰线
     for _ in range(3):
@@ -76,3 +110,80 @@ def verify_captcha(token: str, user_input: str) -> bool:
         return payload.get("answer") == user_input.lower()
     except:
         return False
+
+
+def render_captcha() -> dict:
+    """生成一个完整的验证码（答案 token + base64 图片）"""
+    text = generate_captcha_text()
+    image = generate_captcha_image(text)
+    return {
+        "captcha_token": create_captcha_token(text),
+        "captcha_image": "data:image/png;base64," + base64.b64encode(image).decode(),
+    }
+
+
+class CaptchaPool:
+    """
+    预渲染验证码池
+    - pop() 只做一次出队，池空时才在当前线程现场渲染
+    - 数量低于一半时唤醒后台线程补充到 size
+    - 每个条目只会被取出一次；存放超过 CAPTCHA_POOL_MAX_AGE 的条目丢弃
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items = deque()
+        self._refill_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.served = 0
+        self.misses = 0
+
+    def start(self):
+        if self._thread is None and self.size > 0:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._refill_loop, name="captcha-pool", daemon=True)
+            self._thread.start()
+            self._refill_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._refill_event.set()
+        self._thread = None
+
+    def _refill_loop(self):
+        while not self._stop_event.is_set():
+            self._refill_event.wait()
+            self._refill_event.clear()
+            while not self._stop_event.is_set() and len(self._items) < self.size:
+                try:
+                    self._items.append((time.time(), render_captcha()))
+                except Exception as e:
+                    print(f"⚠️  验证码预生成失败: {e}")
+                    break
+
+    def pop(self) -> dict:
+        """取出一个验证码"""
+        oldest = time.time() - CAPTCHA_POOL_MAX_AGE
+        item = None
+        while True:
+            try:
+                created_at, captcha = self._items.popleft()
+            except IndexError:
+                break
+            if created_at >= oldest:
+                item = captcha
+                break
+        if len(self._items) < self.size // 2:
+            self._refill_event.set()
+        if item is None:
+            self.misses += 1
+            item = render_captcha()
+        self.served += 1
+        return item
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "served": self.served, "misses": self.misses}
+
+
+captcha_pool = CaptchaPool(settings.CAPTCHA_POOL_SIZE)
@@ -5,6 +5,16 @@ import secrets
 
 logger = logging.getLogger(__name__)
 
+
+def _parse_previous_keys(value: str) -> dict:
+    """解析历史加密密钥，格式: 版本:密钥:盐值，多个用逗号分隔"""
+    keys = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        version, key, salt = item.split(":", 2)
+        keys[int(version)] = (key.encode()[:32].ljust(32, b'0'), salt.encode()[:16].ljust(16, b'0'))
+    return keys
+
+
 class Settings:
     # Environment
     ENV: str = os.getenv("ENV", "development")
@@ -38,6 +48,83 @@ class Settings:
     
     # Password hashing
     PWD_CONTEXT_SCHEME: str = "bcrypt"
+    # bcrypt 成本（用 calibrate_bcrypt.py 按部署主机校准），与之不同的旧哈希在登录时自动升级
+    BCRYPT_ROUNDS: int = int(os.getenv("BCRYPT_ROUNDS", "12"))
+    
+    # 密码哈希进程池：进程数（0 表示 CPU 核数的一半）和最大排队数，排满后返回 503
+    PASSWORD_HASH_WORKERS: int = int(os.getenv("PASSWORD_HASH_WORKERS", "0"))
+    PASSWORD_HASH_MAX_QUEUE: int = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "16"))
+    
+    # 已认证用户缓存（减少每个请求的用户查询）
+    USER_CACHE_SIZE: int = int(os.getenv("USER_CACHE_SIZE", "10000"))
+    USER_CACHE_TTL_SECONDS: int = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+    
+    # 列表接口总数缓存（按用户和过滤条件，写入时失效），total=estimate 时非 PostgreSQL 最多统计的条数
+    COUNT_CACHE_SIZE: int = int(os.getenv("COUNT_CACHE_SIZE", "20000"))
+    COUNT_CACHE_TTL_SECONDS: int = int(os.getenv("COUNT_CACHE_TTL_SECONDS", "30"))
+    COUNT_ESTIMATE_CAP: int = int(os.getenv("COUNT_ESTIMATE_CAP", "10000"))
+    
+    # 会话撤销：后台同步其他 worker 撤销记录的间隔（秒），0 表示不同步
+    SESSION_SYNC_INTERVAL_SECONDS: int = int(os.getenv("SESSION_SYNC_INTERVAL_SECONDS", "5"))
+    
+    # 待完成注册存储：memory（单 worker）或 sqlite（多 worker 共享文件）
+    REGISTRATION_STORE: str = os.getenv("REGISTRATION_STORE", "memory").lower()
+    REGISTRATION_STORE_PATH: str = os.getenv(
+        "REGISTRATION_STORE_PATH",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "pending_registrations.db")
+    )
+    
+    # TOTP 二维码：默认输出格式（png / svg / uri）、PNG 渲染线程数
+    QR_RENDER_MODE: str = os.getenv("QR_RENDER_MODE", "png").lower()
+    QR_RENDER_WORKERS: int = int(os.getenv("QR_RENDER_WORKERS", "2"))
+    
+    # 验证码：预渲染池大小（0 表示不预渲染）和字体文件路径（为空时自动查找）
+    CAPTCHA_POOL_SIZE: int = int(os.getenv("CAPTCHA_POOL_SIZE", "200"))
+    CAPTCHA_FONT_PATH: str = os.getenv("CAPTCHA_FONT_PATH", "")
+    
+    # 请求审计日志异步批量写入：队列容量、每批条数、最长攒批时间（毫秒）
+    # 队列满时策略 drop / sample / block，sample 时高负载下每 AUDIT_SAMPLE_RATE 条保留 1 条
+    AUDIT_QUEUE_SIZE: int = int(os.getenv("AUDIT_QUEUE_SIZE", "10000"))
+    AUDIT_BATCH_SIZE: int = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+    AUDIT_FLUSH_INTERVAL_MS: int = int(os.getenv("AUDIT_FLUSH_INTERVAL_MS", "1000"))
+    AUDIT_OVERFLOW_POLICY: str = os.getenv("AUDIT_OVERFLOW_POLICY", "drop").lower()
+    AUDIT_SAMPLE_RATE: int = int(os.getenv("AUDIT_SAMPLE_RATE", "10"))
+    
+    # 按路由的审计策略（见 audit_policy.py）：未列出的读请求的默认策略、
+    # 路由策略覆盖（"GET /api/x=sample:5,GET /api/y=count"）、只计数请求的汇总周期
+    AUDIT_DEFAULT_READ_POLICY: str = os.getenv("AUDIT_DEFAULT_READ_POLICY", "always")
+    AUDIT_ROUTE_POLICIES: str = os.getenv("AUDIT_ROUTE_POLICIES", "")
+    AUDIT_AGGREGATE_INTERVAL_SECONDS: int = int(os.getenv("AUDIT_AGGREGATE_INTERVAL_SECONDS", "60"))
+    
+    # 审计日志存储：database（log_entries 表）或 segments（追加写分段文件，单个分段上限 MB）
+    AUDIT_STORAGE: str = os.getenv("AUDIT_STORAGE", "database").lower()
+    AUDIT_SEGMENT_DIR: str = os.getenv(
+        "AUDIT_SEGMENT_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "audit_segments")
+    )
+    AUDIT_SEGMENT_MAX_MB: int = int(os.getenv("AUDIT_SEGMENT_MAX_MB", "64"))
+    
+    # log_entries / login_history 分区：none 或 monthly（见 partitions.py）
+    # 保留月数（0 表示永久保留），归档目录为空时过期分区直接删除
+    LOG_PARTITIONING: str = os.getenv("LOG_PARTITIONING", "none").lower()
+    LOG_RETENTION_MONTHS: int = int(os.getenv("LOG_RETENTION_MONTHS", "0"))
+    LOG_ARCHIVE_DIR: str = os.getenv("LOG_ARCHIVE_DIR", "")
+    
+    # 操作日志搜索：fulltext（SQLite FTS5 / PostgreSQL tsvector + pg_trgm 索引）或 none（LIKE 匹配）
+    LOG_SEARCH: str = os.getenv("LOG_SEARCH", "fulltext").lower()
+    
+    # 用量批量上报（/api/usage/batch）每批最多事件数和请求体最大字节数（超过返回 413）
+    USAGE_BATCH_MAX_EVENTS: int = int(os.getenv("USAGE_BATCH_MAX_EVENTS", "50000"))
+    USAGE_BATCH_MAX_BYTES: int = int(os.getenv("USAGE_BATCH_MAX_BYTES", str(32 * 1024 * 1024)))
+    
+    # Prometheus /metrics：各 worker 的快照目录、写入周期（0 表示不写快照，只导出本进程），
+    # 访问令牌（为空时 /metrics 拒绝所有请求）
+    METRICS_DIR: str = os.getenv(
+        "METRICS_DIR",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics_snapshots")
+    )
+    METRICS_SNAPSHOT_INTERVAL_SECONDS: int = int(os.getenv("METRICS_SNAPSHOT_INTERVAL_SECONDS", "5"))
+    METRICS_TOKEN: str = os.getenv("METRICS_TOKEN", "")
     
     # API Key encryption - 生产环境必须设置
     _encryption_key_str = os.getenv("ENCRYPTION_KEY")
@@ -60,6 +147,20 @@ class Settings:
         ENCRYPTION_SALT: bytes = b"dev-salt-16-byte"
         logger.warning("⚠️  使用默认 ENCRYPTION_SALT（仅限开发环境）")
     
+    # 当前加密密钥版本，轮换 ENCRYPTION_KEY/ENCRYPTION_SALT 时递增
+    ENCRYPTION_KEY_VERSION: int = int(os.getenv("ENCRYPTION_KEY_VERSION", "1"))
+    
+    # 历史密钥（仅用于解密旧版本密文），格式: 版本:密钥:盐值,版本:密钥:盐值
+    ENCRYPTION_PREVIOUS_KEYS: dict = _parse_previous_keys(os.getenv("ENCRYPTION_PREVIOUS_KEYS", ""))
+    
+    # API Key 密文格式: fernet（文本，兼容旧数据）、aesgcm（紧凑二进制）
+    # 或 envelope（每个用户独立的数据密钥，由主密钥包装）
+    API_KEY_CIPHER_FORMAT: str = os.getenv("API_KEY_CIPHER_FORMAT", "fernet").lower()
+    
+    # 已解包数据密钥的缓存（信封加密）
+    DATA_KEY_CACHE_SIZE: int = int(os.getenv("DATA_KEY_CACHE_SIZE", "1024"))
+    DATA_KEY_CACHE_TTL_SECONDS: int = int(os.getenv("DATA_KEY_CACHE_TTL_SECONDS", "300"))
+    
     # CORS - 从环境变量读取允许的域名
     _cors_origins = os.getenv("CORS_ORIGINS")
     if _cors_origins:
@@ -88,6 +189,30 @@ class Settings:
             if len(self.API_KEY_ENCRYPTION_KEY) < 32:
                 issues.append("ENCRYPTION_KEY 长度不足 32 字节")
             
+            if self.API_KEY_CIPHER_FORMAT not in ("fernet", "aesgcm", "envelope"):
+                issues.append("API_KEY_CIPHER_FORMAT 只能是 fernet、aesgcm 或 envelope")
+            
+            if self.REGISTRATION_STORE not in ("memory", "sqlite"):
+                issues.append("REGISTRATION_STORE 只能是 memory 或 sqlite")
+            
+            if self.QR_RENDER_MODE not in ("svg", "png", "uri"):
+                issues.append("QR_RENDER_MODE 只能是 svg、png 或 uri")
+            
+            if self.AUDIT_OVERFLOW_POLICY not in ("drop", "sample", "block"):
+                issues.append("AUDIT_OVERFLOW_POLICY 只能是 drop、sample 或 block")
+            
+            if self.AUDIT_STORAGE not in ("database", "segments"):
+                issues.append("AUDIT_STORAGE 只能是 database 或 segments")
+            
+            if self.LOG_PARTITIONING not in ("none", "monthly"):
+                issues.append("LOG_PARTITIONING 只能是 none 或 monthly")
+            
+            if self.LOG_SEARCH not in ("fulltext", "none"):
+                issues.append("LOG_SEARCH 只能是 fulltext 或 none")
+            
+            if self.ENCRYPTION_KEY_VERSION in self.ENCRYPTION_PREVIOUS_KEYS:
+                issues.append("ENCRYPTION_PREVIOUS_KEYS 包含当前密钥版本")
+            
             if "*" in self.CORS_ORIGINS:
                 issues.append("CORS_ORIGINS 包含通配符 '*'")
             
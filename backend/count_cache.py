@@ -0,0 +1,160 @@
+"""
+列表接口总数缓存与估算
+- 按 (列表类型, 用户, 过滤条件) 缓存 count() 结果，有界 LRU + TTL
+- 写入方失效：ORM 写入在事务提交后按记录的用户失效，审计日志等 Core 批量写入
+  在写入后调用 invalidate_counts；每个 (列表类型, 用户) 有版本戳，
+  统计期间发生写入的结果不会写入缓存
+- 缓存仅在进程内有效，多 worker 部署时其他进程依赖 COUNT_CACHE_TTL_SECONDS 过期
+- total=estimate 时返回估算值：PostgreSQL 使用查询计划的行数估计，
+  其他数据库最多数到 COUNT_ESTIMATE_CAP 条，超过时返回下界
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import event, func, literal_column
+from sqlalchemy.orm import Session
+from config import settings
+from models_v2 import LogEntry, LoginHistory, TokenUsage, RenewalRecord
+
+TOTAL_MODES = ("exact", "estimate")
+
+# 模型 -> 列表类型
+COUNTED_MODELS = {
+    LogEntry: "logs",
+    LoginHistory: "login_history",
+    TokenUsage: "token_usage",
+    RenewalRecord: "renewals",
+}
+
+
+class CountCache:
+    """总数缓存"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # (类型, 用户, 过滤条件) -> (总数, 到期时间, 版本戳)
+        self._stamps = {}  # (类型, 用户) -> 版本戳
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def stamp(self, kind: str, user_id: int) -> int:
+        with self._lock:
+            return self._stamps.get((kind, user_id), 0)
+
+    def get(self, kind: str, user_id: int, filters: tuple) -> Optional[int]:
+        key = (kind, user_id, filters)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now or entry[2] != self._stamps.get((kind, user_id), 0):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, kind: str, user_id: int, filters: tuple, total: int, stamp: int):
+        key = (kind, user_id, filters)
+        with self._lock:
+            if stamp != self._stamps.get((kind, user_id), 0):
+                return
+            self._entries[key] = (total, time.monotonic() + self.ttl_seconds, stamp)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kind: str, user_id: int):
+        """递增版本戳，该用户该类型的所有过滤条件的缓存一并失效"""
+        with self._lock:
+            self._stamps[(kind, user_id)] = self._stamps.get((kind, user_id), 0) + 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations}
+
+
+count_cache = CountCache(settings.COUNT_CACHE_SIZE, settings.COUNT_CACHE_TTL_SECONDS)
+
+
+def invalidate_counts(kind: str, user_ids):
+    """写入后调用：kind 为 logs / login_history / token_usage / renewals"""
+    for user_id in set(user_ids):
+        count_cache.invalidate(kind, user_id)
+
+
+def get_count_cache_stats() -> dict:
+    return count_cache.stats()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_invalidations(session, flush_context):
+    """记录本事务中新增或删除了哪些用户的记录，提交后再失效（提交前其他会话还看不到变化）"""
+    pending = session.info.setdefault("count_invalidations", set())
+    for obj in list(session.new) + list(session.deleted):
+        kind = COUNTED_MODELS.get(type(obj))
+        if kind is not None and obj.user_id is not None:
+            pending.add((kind, obj.user_id))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    for kind, user_id in session.info.pop("count_invalidations", ()):
+        count_cache.invalidate(kind, user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session):
+    session.info.pop("count_invalidations", None)
+
+
+def estimate_count(db: Session, query) -> Tuple[int, bool]:
+    """返回 (估算总数, 是否为估算值)"""
+    if db.bind.dialect.name == "postgresql":
+        compiled = query.statement.compile(dialect=db.bind.dialect)
+        plan = db.connection().exec_driver_sql(
+            f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params
+        ).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"]), True
+
+    cap = settings.COUNT_ESTIMATE_CAP
+    capped = query.with_entities(literal_column("1")).order_by(None).limit(cap).subquery()
+    total = db.query(func.count()).select_from(capped).scalar()
+    return total, total >= cap
+
+
+def check_total_mode(mode: str) -> str:
+    """校验 total 参数（exact / estimate），其他值返回 400"""
+    if mode not in TOTAL_MODES:
+        raise HTTPException(status_code=400, detail=f"total 只支持 {' / '.join(TOTAL_MODES)}")
+    return mode
+
+
+def count_total(db: Session, query, kind: str, user_id: int, filters: tuple,
+                mode: str = "exact") -> Tuple[int, bool]:
+    """
+    列表总数：优先使用缓存，未命中时按 mode 精确统计或估算
+    返回 (总数, 是否为估算值)；精确值（含未超过上限的估算）写入缓存
+    """
+    cached = count_cache.get(kind, user_id, filters)
+    if cached is not None:
+        return cached, False
+    stamp = count_cache.stamp(kind, user_id)
+    if mode == "estimate":
+        total, estimated = estimate_count(db, query)
+    else:
+        total, estimated = query.order_by(None).count(), False
+    if not estimated:
+        count_cache.put(kind, user_id, filters, total, stamp)
+    return total, estimated
@@ -1,14 +1,30 @@
-from sqlalchemy import create_engine, event
+import json
+import threading
+import zlib
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, text, Integer, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from config import settings
 
+try:
+    import fcntl
+except ImportError:  # Windows：只在进程内加锁
+    fcntl = None
+
+
+def _json_serializer(value) -> str:
+    """JSON 列保留中文原文（默认转义为 \\uXXXX，全文搜索和 LIKE 无法匹配）"""
+    return json.dumps(value, ensure_ascii=False)
+
+
 # 根据数据库类型创建引擎
 if settings.USE_SQLITE:
     # SQLite 配置
     engine = create_engine(
         settings.DATABASE_URL,
-        connect_args={"check_same_thread": False}  # SQLite 需要这个参数
+        connect_args={"check_same_thread": False},  # SQLite 需要这个参数
+        json_serializer=_json_serializer
     )
     
     # 启用 SQLite 外键约束
@@ -20,7 +36,7 @@ if settings.USE_SQLITE:
 else:
     # PostgreSQL 配置 (使用 psycopg 驱动)
     DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+psycopg://")
-    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+    engine = create_engine(DATABASE_URL, pool_pre_ping=True, json_serializer=_json_serializer)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -31,4 +47,97 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+
+_migration_thread_lock = threading.Lock()
+
+
+@contextmanager
+def migration_lock(name: str):
+    """
+    串行化多个 worker 的启动迁移和 DDL（每个 worker 的 startup 钩子都会执行），
+    获得锁后需重新检查迁移状态
+    - PostgreSQL：会话级 advisory lock，持有一个专用连接直到退出（迁移可能跨多个事务）
+    - SQLite：数据库文件旁的 {文件名}.migrate.lock 文件锁（内存数据库只在进程内加锁）
+    """
+    with _migration_thread_lock:
+        if not settings.USE_SQLITE:
+            key = zlib.crc32(name.encode())
+            with engine.connect() as conn:
+                conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": key})
+                conn.commit()
+                try:
+                    yield
+                finally:
+                    conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+                    conn.commit()
+            return
+
+        database = engine.url.database
+        if not database or database == ":memory:" or fcntl is None:
+            yield
+            return
+        with open(f"{database}.migrate.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# 新增列（表名, 列名, 类型），已有数据库启动时自动补齐
+SCHEMA_UPGRADES = [
+    ("user_api_keys", "api_key_cipher", LargeBinary()),
+    ("totp_configs", "last_used_step", Integer()),
+]
+
+
+def _dedupe_token_usage_request_ids(conn):
+    """
+    建立 (user_id, request_id) 唯一索引前处理已有的重复值：
+    保留每组中 ID 最小的一条，其余记录的 request_id 置空（记录本身和用量统计不变）
+    """
+    count = conn.execute(text(
+        "UPDATE token_usage SET request_id = NULL "
+        "WHERE request_id IS NOT NULL AND EXISTS ("
+        "SELECT 1 FROM token_usage t WHERE t.user_id = token_usage.user_id "
+        "AND t.request_id = token_usage.request_id AND t.id < token_usage.id)"
+    )).rowcount
+    if count:
+        print(f"⚠️  token_usage 中有 {count} 条记录的 request_id 与同一用户的更早记录重复，"
+              f"已将其 request_id 置空后建立唯一索引（记录保留，之后以相同 request_id 上报会被视为重复）")
+
+
+# 建立唯一索引前需要先处理的已有数据
+UNIQUE_INDEX_PREPARE = {
+    "ux_token_usage_user_request_id": _dedupe_token_usage_request_ids,
+}
+
+
+def upgrade_schema(bind=engine):
+    """为已有数据库补齐模型中新增的列和索引"""
+    inspector = inspect(bind)
+    views = set(inspector.get_view_names())
+    with bind.begin() as conn:
+        for table_name, column_name, column_type in SCHEMA_UPGRADES:
+            if not inspector.has_table(table_name):
+                continue
+            columns = {c["name"] for c in inspector.get_columns(table_name)}
+            if column_name not in columns:
+                type_sql = column_type.compile(dialect=bind.dialect)
+                conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {type_sql}"))
+                print(f"✅ 已添加列 {table_name}.{column_name}")
+        
+        # 已有表上缺失的索引（SQLite 按月分区后日志表是视图，索引建在各月份表上）
+        for table in Base.metadata.sorted_tables:
+            if table.name in views or not inspector.has_table(table.name):
+                continue
+            existing = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    prepare = UNIQUE_INDEX_PREPARE.get(index.name)
+                    if prepare is not None:
+                        prepare(conn)
+                    index.create(conn)
+                    print(f"✅ 已添加索引 {index.name}")
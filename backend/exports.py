@@ -0,0 +1,123 @@
+"""
+历史记录流式导出（操作日志、登录历史、Token 使用记录）
+- 格式：ndjson（每行一个 JSON 对象）或 csv（UTF-8 BOM，表格软件可直接打开中文；dict 字段写为 JSON 文本）
+- csv 中以 = + - @ 制表符 回车 开头的文本前加 '，防止表格软件把用户输入当作公式执行
+- gzip=true 时逐块压缩，下载文件名带 .gz 后缀
+- 查询通过 yield_per 分批读取（PostgreSQL 使用服务端游标），输出累积到 EXPORT_CHUNK_BYTES 后写出，
+  内存占用与导出行数无关
+- 生成器使用独立的数据库会话：请求依赖的会话在开始发送响应前就已关闭
+- 每读取一批由 StreamingResponse 在线程池中取下一块，导出期间不长期占用线程池线程
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Callable, Iterable, Iterator, List, Optional
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from database import SessionLocal
+
+EXPORT_FORMATS = ("ndjson", "csv")
+
+# 每次从数据库读取的行数
+EXPORT_BATCH_SIZE = 1000
+# 输出缓冲达到该大小后写出一块
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+# 表格软件会当作公式解析的开头字符
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, ensure_ascii=False, default=_json_default)
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _encode_rows(rows: Iterable[dict], fields: List[str], fmt: str) -> Iterator[str]:
+    """把记录编码为文本块（约 EXPORT_CHUNK_BYTES 一块）"""
+    buffer = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        buffer.write("\ufeff")
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+    for row in rows:
+        if writer is not None:
+            writer.writerow([_csv_value(row.get(field)) for field in fields])
+        else:
+            buffer.write(json.dumps({field: row.get(field) for field in fields},
+                                    ensure_ascii=False, default=_json_default))
+            buffer.write("\n")
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def _stream(produce: Callable[[Session], Iterable[dict]], fields: List[str],
+            fmt: str, compress: bool) -> Iterator[bytes]:
+    db = SessionLocal()
+    try:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        for chunk in _encode_rows(produce(db), fields, fmt):
+            data = chunk.encode("utf-8")
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor is not None:
+            yield compressor.flush()
+    finally:
+        db.close()
+
+
+def check_export_format(fmt: str) -> str:
+    fmt = (fmt or "").lower()
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"导出格式只支持 {' / '.join(EXPORT_FORMATS)}")
+    return fmt
+
+
+def export_response(produce: Callable[[Session], Iterable[dict]], fields: List[str],
+                    fmt: str, compress: bool, filename: str) -> StreamingResponse:
+    """
+    流式导出响应：produce(db) 返回记录（列名 -> 值）的迭代器，
+    应对查询使用 yield_per(EXPORT_BATCH_SIZE)；fields 为输出的列及顺序
+    """
+    fmt = check_export_format(fmt)
+    filename = f"{filename}.{fmt}" + (".gz" if compress else "")
+    media_type = "application/gzip" if compress else MEDIA_TYPES[fmt]
+    return StreamingResponse(
+        _stream(produce, fields, fmt, compress),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+def export_filename(kind: str, user_id: int, now: Optional[datetime] = None) -> str:
+    return f"{kind}_{user_id}_{(now or datetime.utcnow()).strftime('%Y%m%d%H%M%S')}"
@@ -0,0 +1,126 @@
+"""
+密码哈希进程池
+- bcrypt 计算放到独立进程中执行，不占用事件循环和 Starlette 线程池的 CPU
+- 排队数量有上限，超过时立即返回 503，登录高峰不会拖垮其他接口
+- 记录排队深度、等待时间和拒绝次数
+"""
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from fastapi import HTTPException
+from config import settings
+
+
+def _timed_call(func, args: tuple, submitted_at: float):
+    """在工作进程中执行，返回 (结果, 排队等待秒数)"""
+    wait = time.time() - submitted_at
+    return func(*args), wait
+
+
+class HashPool:
+    """
+    有界的密码哈希进程池
+    in-flight = 正在执行 + 排队中，超过 workers + max_queue 时拒绝新任务
+    """
+
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _submit(self, func, *args):
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试",
+                                    headers={"Retry-After": "1"})
+            self._in_flight += 1
+        try:
+            future = self._executor.submit(_timed_call, func, args, time.time())
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+            if future is None or future.cancelled() or future.exception() is not None:
+                return
+            wait = max(0.0, future.result()[1])
+            self.completed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def run(self, func, *args):
+        """同步调用（在工作线程中阻塞等待结果）"""
+        future = self._submit(func, *args)
+        return future.result()[0]
+
+    async def run_async(self, func, *args):
+        """异步调用（不阻塞事件循环）"""
+        future = self._submit(func, *args)
+        result, _ = await asyncio.wrap_future(future)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "in_flight": self._in_flight,
+                "queue_depth": max(0, self._in_flight - self.workers),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": round(self.total_wait * 1000 / self.completed, 2) if self.completed else 0.0,
+                "max_wait_ms": round(self.max_wait * 1000, 2),
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_hash_pool: Optional[HashPool] = None
+_hash_pool_lock = threading.Lock()
+
+
+def init_hash_pool() -> HashPool:
+    """启动时创建进程池"""
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None:
+            workers = settings.PASSWORD_HASH_WORKERS or max(1, (os.cpu_count() or 2) // 2)
+            _hash_pool = HashPool(workers, settings.PASSWORD_HASH_MAX_QUEUE)
+    return _hash_pool
+
+
+def get_hash_pool() -> HashPool:
+    if _hash_pool is None:
+        return init_hash_pool()
+    return _hash_pool
+
+
+def shutdown_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is not None:
+            _hash_pool.shutdown()
+            _hash_pool = None
+
+
+def get_hash_pool_stats() -> dict:
+    """进程池尚未创建时返回空字典（读取统计不创建进程池）"""
+    pool = _hash_pool
+    if pool is None:
+        return {}
+    return pool.stats()
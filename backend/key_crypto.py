@@ -0,0 +1,402 @@
+"""
+API密钥加密模块
+- 进程级密钥环：PBKDF2 派生只在启动和轮换时执行一次
+- 复用 Fernet 实例，避免每次加解密重复派生密钥
+- 密文带版本标记（v{版本}:{token}），轮换后仍可解密旧版本密文
+- 可选 AES-GCM 二进制格式（API_KEY_CIPHER_FORMAT=aesgcm），存入 api_key_cipher 列
+  格式: 格式标记(1字节) + 密钥版本(2字节) + nonce(12字节) + 密文和认证标签
+- 可选信封加密（API_KEY_CIPHER_FORMAT=envelope）：每个用户一个数据密钥，由主密钥包装
+  后存入 user_data_keys；已解包的数据密钥保存在有界 TTL LRU 缓存中，
+  缓存项带数据密钥记录的 (id, created_at)，命中时与数据库中当前记录比对，
+  其他进程删除账户或用户ID被复用后不会继续使用旧的数据密钥
+  格式: 格式标记(1字节) + nonce(12字节) + 密文和认证标签（认证数据绑定用户ID）
+  主密钥轮换时只需重新包装数据密钥: python reencrypt_keys.py --rewrap-data-keys
+"""
+import os
+import struct
+import threading
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from config import settings
+
+# PBKDF2 迭代次数（修改会导致已有密文无法解密）
+KDF_ITERATIONS = 100000
+
+# 未带版本标记的旧密文按此版本优先尝试解密
+LEGACY_KEY_VERSION = 1
+
+# 二进制密文格式标记
+FORMAT_AESGCM = 0x01
+FORMAT_ENVELOPE = 0x02
+BINARY_HEADER = struct.Struct(">BH")
+ENVELOPE_HEADER = struct.Struct(">B")
+NONCE_SIZE = 12
+
+# 包装数据密钥时的附加认证数据，防止与普通密文互换
+WRAP_CONTEXT = b"data-key"
+
+CIPHER_FORMATS = ("fernet", "aesgcm", "envelope")
+
+
+def derive_fernet_key(master_key: bytes, salt: bytes, iterations: int = KDF_ITERATIONS) -> bytes:
+    """从主密钥派生 Fernet 密钥（开销较大，只应在构建密钥环时调用）"""
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        iterations=iterations,
+    )
+    return urlsafe_b64encode(kdf.derive(master_key))
+
+
+def derive_aesgcm_key(fernet_key: bytes) -> bytes:
+    """从派生好的 Fernet 密钥再派生独立的 AES-GCM 子密钥（避免同一密钥用于两种算法）"""
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"api-key-aesgcm")
+    return hkdf.derive(urlsafe_b64decode(fernet_key))
+
+
+def parse_token(token: str) -> Tuple[Optional[int], str]:
+    """拆分密文的版本标记，旧格式返回 (None, token)"""
+    if token.startswith("v"):
+        version, sep, body = token[1:].partition(":")
+        if sep and version.isdigit():
+            return int(version), body
+    return None, token
+
+
+class KeyRing:
+    """
+    版本化密钥环：持有各版本派生好的 Fernet 密钥和可复用的加密实例
+    新密文总是使用当前版本加密，解密时按密文中的版本号选择密钥
+    Fernet 实例无内部可变状态，可在线程池的多个线程间共享
+    """
+
+    def __init__(self, keys: Dict[int, Tuple[bytes, bytes]], current_version: int):
+        if current_version not in keys:
+            raise ValueError(f"缺少当前版本 {current_version} 的密钥")
+        self.keys = keys
+        self.current_version = current_version
+        self.fernet_keys = {
+            version: derive_fernet_key(master_key, salt)
+            for version, (master_key, salt) in keys.items()
+        }
+        self.fernet_key = self.fernet_keys[current_version]
+        self._fernets = {version: Fernet(key) for version, key in self.fernet_keys.items()}
+        self._aesgcms = {
+            version: AESGCM(derive_aesgcm_key(key)) for version, key in self.fernet_keys.items()
+        }
+        self._prefix = f"v{current_version}:"
+        # 旧格式密文的尝试顺序：约定的旧版本优先，其余从新到旧
+        self._legacy_order = sorted(self._fernets, key=lambda v: (v != LEGACY_KEY_VERSION, -v))
+
+    def encrypt(self, plaintext: str) -> str:
+        token = self._fernets[self.current_version].encrypt(plaintext.encode()).decode()
+        return self._prefix + token
+
+    def decrypt(self, token: str) -> str:
+        version, body = parse_token(token)
+        if version is not None:
+            fernet = self._fernets.get(version)
+            if fernet is None:
+                raise InvalidToken(f"未知的密钥版本: {version}")
+            return fernet.decrypt(body.encode()).decode()
+
+        for legacy_version in self._legacy_order:
+            try:
+                return self._fernets[legacy_version].decrypt(body.encode()).decode()
+            except InvalidToken:
+                continue
+        raise InvalidToken("无法使用任何已知密钥解密")
+
+    def _seal(self, data: bytes, context: bytes) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        header = BINARY_HEADER.pack(FORMAT_AESGCM, self.current_version)
+        return header + nonce + self._aesgcms[self.current_version].encrypt(nonce, data, header + context)
+
+    def _open(self, blob: bytes, context: bytes) -> bytes:
+        blob = bytes(blob)
+        if len(blob) < BINARY_HEADER.size + NONCE_SIZE:
+            raise InvalidToken("密文长度不足")
+        marker, version = BINARY_HEADER.unpack_from(blob)
+        if marker != FORMAT_AESGCM:
+            raise InvalidToken(f"未知的密文格式: {marker}")
+        aesgcm = self._aesgcms.get(version)
+        if aesgcm is None:
+            raise InvalidToken(f"未知的密钥版本: {version}")
+        header_size = BINARY_HEADER.size
+        nonce = blob[header_size:header_size + NONCE_SIZE]
+        try:
+            return aesgcm.decrypt(nonce, blob[header_size + NONCE_SIZE:], blob[:header_size] + context)
+        except InvalidTag:
+            raise InvalidToken("AES-GCM 认证失败")
+
+    def encrypt_bytes(self, plaintext: str) -> bytes:
+        """AES-GCM 加密为紧凑的二进制密文"""
+        return self._seal(plaintext.encode(), b"")
+
+    def decrypt_bytes(self, blob: bytes) -> str:
+        return self._open(blob, b"").decode()
+
+    def wrap_key(self, data_key: bytes) -> bytes:
+        """用当前版本主密钥包装数据密钥"""
+        return self._seal(data_key, WRAP_CONTEXT)
+
+    def unwrap_key(self, wrapped_key: bytes) -> bytes:
+        return self._open(wrapped_key, WRAP_CONTEXT)
+
+    def needs_reencrypt(self, ciphertext: Union[str, bytes], cipher_format: str = "fernet") -> bool:
+        """密文是否不是目标格式的当前版本（只检查标记，不解密）"""
+        if isinstance(ciphertext, str):
+            return cipher_format != "fernet" or not ciphertext.startswith(self._prefix)
+        if is_envelope(ciphertext):
+            # 信封密文与主密钥版本无关，轮换只需重新包装数据密钥
+            return cipher_format != "envelope"
+        if len(ciphertext) < BINARY_HEADER.size:
+            # 截断或损坏的密文：交给重新加密流程，解密失败时记入 failed，不中断整批
+            return True
+        marker, version = BINARY_HEADER.unpack_from(ciphertext)
+        return cipher_format != "aesgcm" or marker != FORMAT_AESGCM or version != self.current_version
+
+    def reencrypt(self, ciphertext: Union[str, bytes], cipher_format: str = "fernet",
+                  user_id: int = None, data_key: AESGCM = None) -> Union[str, bytes]:
+        """用当前版本重新加密为目标格式（涉及信封格式时需提供用户ID和数据密钥）"""
+        plaintext = self.decrypt_any(ciphertext, user_id, data_key)
+        if cipher_format == "envelope":
+            return envelope_encrypt(data_key, user_id, plaintext)
+        return self.encrypt_bytes(plaintext) if cipher_format == "aesgcm" else self.encrypt(plaintext)
+
+    def decrypt_any(self, ciphertext: Union[str, bytes], user_id: int = None, data_key: AESGCM = None) -> str:
+        """按类型和格式标记自动识别：str 为 Fernet，bytes 为 AES-GCM 或信封密文"""
+        if isinstance(ciphertext, (bytes, bytearray, memoryview)):
+            if is_envelope(ciphertext):
+                if data_key is None:
+                    raise InvalidToken("信封密文需要用户数据密钥")
+                return envelope_decrypt(data_key, user_id, ciphertext)
+            return self.decrypt_bytes(ciphertext)
+        return self.decrypt(ciphertext)
+
+
+def is_envelope(blob: bytes) -> bool:
+    return len(blob) > 0 and blob[0] == FORMAT_ENVELOPE
+
+
+def _envelope_aad(user_id: int) -> bytes:
+    return ENVELOPE_HEADER.pack(FORMAT_ENVELOPE) + struct.pack(">Q", user_id)
+
+
+def envelope_encrypt(data_key: AESGCM, user_id: int, plaintext: str) -> bytes:
+    """用用户数据密钥加密，认证数据绑定用户ID（密文不能挪到其他用户名下）"""
+    nonce = os.urandom(NONCE_SIZE)
+    return ENVELOPE_HEADER.pack(FORMAT_ENVELOPE) + nonce + data_key.encrypt(nonce, plaintext.encode(), _envelope_aad(user_id))
+
+
+def envelope_decrypt(data_key: AESGCM, user_id: int, blob: bytes) -> str:
+    blob = bytes(blob)
+    header_size = ENVELOPE_HEADER.size
+    nonce = blob[header_size:header_size + NONCE_SIZE]
+    try:
+        return data_key.decrypt(nonce, blob[header_size + NONCE_SIZE:], _envelope_aad(user_id)).decode()
+    except InvalidTag:
+        raise InvalidToken("信封密文认证失败")
+
+
+class DataKeyCache:
+    """
+    已解包数据密钥的有界 TTL LRU 缓存
+    同一用户连续揭示多个密钥时只需解包一次
+    每项记录数据密钥记录的版本（id, created_at），版本不一致视为未命中
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, version: tuple) -> Optional[AESGCM]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[1] <= now or entry[2] != version:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, user_id: int, version: tuple, data_key: AESGCM):
+        with self._lock:
+            self._entries[user_id] = (data_key, time.monotonic() + self.ttl_seconds, version)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def keys_from_settings() -> Dict[int, Tuple[bytes, bytes]]:
+    """从配置收集所有版本的密钥材料"""
+    keys = dict(settings.ENCRYPTION_PREVIOUS_KEYS)
+    keys[settings.ENCRYPTION_KEY_VERSION] = (settings.API_KEY_ENCRYPTION_KEY, settings.ENCRYPTION_SALT)
+    return keys
+
+
+_keyring: KeyRing = None
+_keyring_lock = threading.Lock()
+
+_data_key_cache = DataKeyCache(settings.DATA_KEY_CACHE_SIZE, settings.DATA_KEY_CACHE_TTL_SECONDS)
+
+
+def init_keyring() -> KeyRing:
+    """根据当前配置构建密钥环（应用启动时调用）"""
+    global _keyring
+    keyring = KeyRing(keys_from_settings(), settings.ENCRYPTION_KEY_VERSION)
+    with _keyring_lock:
+        _keyring = keyring
+    return keyring
+
+
+def rotate_keyring(master_key: bytes, salt: bytes) -> KeyRing:
+    """
+    显式轮换：新增一个版本作为当前版本，旧版本保留用于解密
+    已有密文需通过 reencrypt_keys.py 迁移到新版本
+    """
+    global _keyring
+    with _keyring_lock:
+        current = _keyring or KeyRing(keys_from_settings(), settings.ENCRYPTION_KEY_VERSION)
+        keys = dict(current.keys)
+        new_version = max(keys) + 1
+        keys[new_version] = (master_key, salt)
+        _keyring = KeyRing(keys, new_version)
+        return _keyring
+
+
+def get_keyring() -> KeyRing:
+    """获取进程级密钥环（未初始化时懒加载）"""
+    global _keyring
+    if _keyring is None:
+        with _keyring_lock:
+            if _keyring is None:
+                _keyring = KeyRing(keys_from_settings(), settings.ENCRYPTION_KEY_VERSION)
+    return _keyring
+
+
+def encrypt_api_key(api_key: str) -> str:
+    """加密API密钥（Fernet 文本格式）"""
+    return get_keyring().encrypt(api_key)
+
+
+def decrypt_api_key(encrypted_key: Union[str, bytes]) -> str:
+    """解密API密钥，同时支持 Fernet 文本和 AES-GCM 二进制两种格式"""
+    return get_keyring().decrypt_any(encrypted_key)
+
+
+def create_data_key(user_id: int):
+    """
+    为用户生成并保存数据密钥，返回 UserDataKey 记录
+    使用独立会话立即提交，避免调用方事务回滚后缓存中留下未持久化的密钥
+    """
+    from sqlalchemy.exc import IntegrityError
+    from database import SessionLocal
+    from models_v2 import UserDataKey
+
+    keyring = get_keyring()
+    db = SessionLocal()
+    try:
+        record = UserDataKey(
+            user_id=user_id,
+            key_version=keyring.current_version,
+            wrapped_key=keyring.wrap_key(AESGCM.generate_key(bit_length=256))
+        )
+        db.add(record)
+        try:
+            db.commit()
+            db.refresh(record)
+        except IntegrityError:
+            # 并发请求已创建
+            db.rollback()
+            record = db.query(UserDataKey).filter(UserDataKey.user_id == user_id).first()
+        db.expunge(record)
+        return record
+    finally:
+        db.close()
+
+
+def get_data_key(db, user_id: int, create: bool = False) -> AESGCM:
+    """
+    获取用户已解包的数据密钥（优先读缓存）
+    每次先查询当前数据密钥记录的 (id, created_at)，与缓存项不一致时重新解包
+    """
+    from models_v2 import UserDataKey
+
+    current = db.query(UserDataKey.id, UserDataKey.created_at).filter(
+        UserDataKey.user_id == user_id
+    ).first()
+    if current is not None:
+        data_key = _data_key_cache.get(user_id, tuple(current))
+        if data_key is not None:
+            return data_key
+        record = db.query(UserDataKey).filter(UserDataKey.id == current.id).first()
+    else:
+        record = None
+    if record is None:
+        if not create:
+            raise InvalidToken("用户数据密钥不存在")
+        record = create_data_key(user_id)
+
+    data_key = AESGCM(get_keyring().unwrap_key(record.wrapped_key))
+    _data_key_cache.put(user_id, (record.id, record.created_at), data_key)
+    return data_key
+
+
+def invalidate_data_key(user_id: int = None):
+    """清除本进程缓存的数据密钥（删除账户后调用；其他进程在下次读取时按记录版本失效）"""
+    _data_key_cache.invalidate(user_id)
+
+
+def get_data_key_cache_stats() -> dict:
+    return _data_key_cache.stats()
+
+
+def store_api_key(db, key, api_key: str):
+    """按配置的格式加密并写入 UserApiKey 行"""
+    if settings.API_KEY_CIPHER_FORMAT == "envelope":
+        data_key = get_data_key(db, key.user_id, create=True)
+        key.api_key_cipher = envelope_encrypt(data_key, key.user_id, api_key)
+        key.api_key_encrypted = ""
+    elif settings.API_KEY_CIPHER_FORMAT == "aesgcm":
+        key.api_key_cipher = get_keyring().encrypt_bytes(api_key)
+        key.api_key_encrypted = ""
+    else:
+        key.api_key_encrypted = encrypt_api_key(api_key)
+        key.api_key_cipher = None
+
+
+def reveal_api_key(db, key) -> str:
+    """解密 UserApiKey 行中的密钥（二进制列优先）"""
+    if key.api_key_cipher is not None:
+        if is_envelope(key.api_key_cipher):
+            return envelope_decrypt(get_data_key(db, key.user_id), key.user_id, key.api_key_cipher)
+        return decrypt_api_key(key.api_key_cipher)
+    return decrypt_api_key(key.api_key_encrypted)
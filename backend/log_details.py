@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+操作日志 details 字段（JSON 对象）
+- 列类型：PostgreSQL 为 JSONB（jsonb_path_ops GIN 索引），SQLite 为 JSON（JSON1 函数查询）
+- normalize_details() 把写入值统一为 JSON 对象：dict 原样保存，JSON 文本和 Python repr 解析为对象，
+  其他文本保存为 {"message": ...}，非对象值保存为 {"value": ...}
+- 旧数据迁移：按主键分批把历史的 json.dumps / str(dict) / 自由文本统一为 JSON 对象，
+  PostgreSQL 随后把列改为 JSONB；完成后写入 data_migrations，之后启动不再扫描
+- 过滤条件 filter=status_code>=400、filter=response_time_ms>500、filter=method=POST 在数据库中执行，
+  键可用点号访问嵌套字段，值为数字时按数字比较，带引号时按文本比较（如 query_params.page="2"），
+  多个条件同时满足；
+  键不存在或类型不同（如数字条件遇到文本）的记录不匹配；超出 64 位整数或浮点范围的数字返回 400
+
+运行方式: python log_details.py [--batch-size 1000]（启动时也会自动执行）
+"""
+import argparse
+import ast
+import json
+import math
+import os
+import re
+import sys
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fastapi import HTTPException
+from sqlalchemy import and_, cast, func, inspect, text
+from sqlalchemy.dialects.postgresql import JSONPATH
+from config import settings
+from database import engine, migration_lock
+from log_search import FTS_TABLE
+from partitions import physical_tables
+
+MIGRATION_NAME = "log_entries_details_json"
+
+# 单次请求最多的过滤条件数
+MAX_DETAIL_FILTERS = 5
+
+FILTER_PATTERN = re.compile(
+    r"^\s*([A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)\s*(>=|<=|!=|=|>|<)\s*(.*?)\s*$"
+)
+NUMERIC_OPERATORS = (">=", "<=", ">", "<")
+# 数字条件的整数范围（SQLite INTEGER 为 64 位）
+MAX_FILTER_INT = 2 ** 63 - 1
+
+_MISSING = object()
+
+
+# ============ 写入 ============
+
+def _parse_text(value: str):
+    """依次尝试 JSON 和 Python 字面量（str(dict) 写入的旧数据），都失败时返回 _MISSING"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        pass
+    if value[:1] in "{[":
+        try:
+            # 字面量中可能有元组、集合等，转一次 JSON 保证可序列化
+            return json.loads(json.dumps(ast.literal_eval(value), default=str))
+        except Exception:
+            pass
+    return _MISSING
+
+
+def _is_json_object(value: str) -> bool:
+    try:
+        return isinstance(json.loads(value), dict)
+    except ValueError:
+        return False
+
+
+def normalize_details(value) -> Optional[dict]:
+    """把日志详情统一为 JSON 对象（空值返回 None）"""
+    if value is None or value == "" or value == {}:
+        return None
+    if isinstance(value, dict):
+        return value
+    if not isinstance(value, str):
+        return {"value": json.loads(json.dumps(value, default=str))}
+    parsed = _parse_text(value.strip())
+    if parsed is _MISSING:
+        return {"message": value}
+    if isinstance(parsed, dict):
+        return parsed
+    return {"value": parsed}
+
+
+# ============ 过滤 ============
+
+def parse_detail_filter(expression: str) -> Tuple[str, str, object]:
+    """解析 "键 运算符 值"，返回 (键, 运算符, 值)；值为数字时转换为 int / float"""
+    match = FILTER_PATTERN.match(expression or "")
+    if not match:
+        raise HTTPException(status_code=400, detail=f"无效的详情过滤条件: {expression}")
+    key, operator, raw = match.groups()
+    value = raw
+    if len(raw) >= 2 and raw[0] == raw[-1] and raw[0] in "\"'":
+        value = raw[1:-1]
+    else:
+        try:
+            value = int(raw)
+        except ValueError:
+            try:
+                value = float(raw)
+            except ValueError:
+                pass
+    if isinstance(value, float) and not math.isfinite(value):
+        # nan / inf 等单词仍按文本比较，1e400 之类溢出的数字无法转为 jsonpath 字面量
+        if any(c.isdigit() for c in raw):
+            raise HTTPException(status_code=400, detail=f"数字超出范围: {expression}")
+        value = raw
+    if isinstance(value, int) and abs(value) > MAX_FILTER_INT:
+        raise HTTPException(status_code=400, detail=f"数字超出范围: {expression}")
+    if operator in NUMERIC_OPERATORS and not isinstance(value, (int, float)):
+        raise HTTPException(status_code=400, detail=f"比较运算 {operator} 需要数字: {expression}")
+    return key, operator, value
+
+
+def parse_detail_filters(expressions: Optional[List[str]]) -> List[Tuple[str, str, object]]:
+    expressions = [e for e in (expressions or []) if e and e.strip()]
+    if len(expressions) > MAX_DETAIL_FILTERS:
+        raise HTTPException(status_code=400, detail=f"详情过滤条件最多 {MAX_DETAIL_FILTERS} 个")
+    return [parse_detail_filter(e) for e in expressions]
+
+
+def _compare(left, operator: str, right):
+    if operator == "=":
+        return left == right
+    if operator == "!=":
+        return left != right
+    if operator == ">=":
+        return left >= right
+    if operator == "<=":
+        return left <= right
+    if operator == ">":
+        return left > right
+    return left < right
+
+
+def apply_detail_filters(query, source, filters: List[Tuple[str, str, object]]):
+    """在数据库中按 details 字段过滤"""
+    for key, operator, value in filters:
+        if settings.USE_SQLITE:
+            path = "$." + key
+            numeric = isinstance(value, (int, float))
+            query = query.filter(and_(
+                func.json_type(source.details, path).in_(("integer", "real") if numeric else ("text",)),
+                _compare(func.json_extract(source.details, path), operator, value),
+            ))
+        else:
+            # jsonpath 条件，类型不同的比较结果为 unknown（不匹配），可使用 jsonb_path_ops 索引
+            jsonpath_operator = "==" if operator == "=" else operator
+            condition = f"$.{key} ? (@ {jsonpath_operator} {json.dumps(value, ensure_ascii=False)})"
+            query = query.filter(source.details.op("@?")(cast(condition, JSONPATH)))
+    return query
+
+
+def record_matches_filters(record: dict, filters: List[Tuple[str, str, object]]) -> bool:
+    """分段文件存储下逐条匹配"""
+    if not filters:
+        return True
+    details = normalize_details(record.get("details")) or {}
+    for key, operator, value in filters:
+        current = details
+        for part in key.split("."):
+            current = current.get(part, _MISSING) if isinstance(current, dict) else _MISSING
+        numeric = isinstance(value, (int, float))
+        if numeric and (isinstance(current, bool) or not isinstance(current, (int, float))):
+            return False
+        if not numeric and not isinstance(current, str):
+            return False
+        if not _compare(current, operator, value):
+            return False
+    return True
+
+
+# ============ 迁移 ============
+
+def _migration_done(conn) -> bool:
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS data_migrations (name VARCHAR(100) PRIMARY KEY, completed_at TIMESTAMP)"
+    ))
+    return conn.execute(text(
+        "SELECT 1 FROM data_migrations WHERE name = :name"
+    ), {"name": MIGRATION_NAME}).first() is not None
+
+
+def _normalize_table(table_name: str, batch_size: int, update_fts: bool) -> int:
+    """按主键分批规范化一张物理表，返回更新的行数"""
+    updated, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(text(
+                f"SELECT id, CAST(details AS TEXT) FROM {table_name} "
+                f"WHERE id > :last_id AND details IS NOT NULL ORDER BY id LIMIT :limit"
+            ), {"last_id": last_id, "limit": batch_size}).all()
+            if not rows:
+                return updated
+            last_id = rows[-1][0]
+            changes = []
+            for row_id, raw in rows:
+                if _is_json_object(raw):
+                    continue
+                normalized = normalize_details(raw)
+                changes.append({
+                    "id": row_id,
+                    "details": json.dumps(normalized, ensure_ascii=False) if normalized else None,
+                })
+            if changes:
+                conn.execute(text(f"UPDATE {table_name} SET details = :details WHERE id = :id"), changes)
+                if update_fts:
+                    conn.execute(text(f"UPDATE {FTS_TABLE} SET details = :details WHERE rowid = :id"), changes)
+                updated += len(changes)
+
+
+def migrate_log_details(batch_size: int = 1000) -> int:
+    """
+    规范化历史日志的 details，PostgreSQL 下把列改为 JSONB，返回更新的行数
+    持有 migration_lock，多个 worker 同时启动时只有第一个执行，其余看到已完成的标记后跳过
+    """
+    with migration_lock(MIGRATION_NAME):
+        with engine.begin() as conn:
+            if _migration_done(conn):
+                return 0
+            inspector = inspect(conn)
+            column_type = None
+            if not settings.USE_SQLITE:
+                column_type = conn.execute(text(
+                    "SELECT data_type FROM information_schema.columns "
+                    "WHERE table_name = 'log_entries' AND column_name = 'details'"
+                )).scalar()
+            update_fts = settings.USE_SQLITE and FTS_TABLE in inspector.get_table_names()
+
+        updated = 0
+        if column_type != "jsonb":
+            for table_name in physical_tables("log_entries"):
+                updated += _normalize_table(table_name, batch_size, update_fts)
+
+        with engine.begin() as conn:
+            if not settings.USE_SQLITE:
+                if column_type != "jsonb":
+                    conn.execute(text(
+                        "ALTER TABLE log_entries ALTER COLUMN details TYPE JSONB USING details::jsonb"
+                    ))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_log_entries_details ON log_entries "
+                    "USING GIN (details jsonb_path_ops)"
+                ))
+            conn.execute(text(
+                "INSERT INTO data_migrations (name, completed_at) VALUES (:name, :now)"
+            ), {"name": MIGRATION_NAME, "now": datetime.utcnow()})
+        return updated
+
+
+def init_log_details():
+    """启动时执行一次 details 迁移（需在日志分区初始化之后）"""
+    updated = migrate_log_details()
+    if updated:
+        print(f"✅ 已规范化 {updated} 条操作日志详情")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="规范化操作日志 details 字段")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    updated = migrate_log_details(args.batch_size)
+    print(f"✅ 完成，更新 {updated} 条记录")
+
+
+if __name__ == "__main__":
+    main()
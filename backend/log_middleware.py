@@ -1,9 +1,12 @@
+import time
 from datetime import datetime
 from sqlalchemy.orm import Session
 from fastapi import Request, HTTPException, status
-from routers.auth import get_current_user
 from models_v2 import LogEntry
-import json
+from audit_writer import audit_writer
+from audit_policy import should_log, ALWAYS, COUNT
+from log_details import normalize_details
+from metrics import request_metrics
 from pathlib import Path
 
 def log_action(
@@ -35,119 +38,122 @@ def log_action(
             user_agent=user_agent,
             status=status,
             error_message=error_message,
-            details=json.dumps(details) if details else None
+            details=normalize_details(details)
         )
         db.add(log_entry)
         db.commit()
     except Exception as e:
         print(f"Failed to log action: {e}")
 
+# 按路由模板（方法, 路径）识别的操作类型：(操作, 资源类型)，其他请求记为"访问"
+ROUTE_ACTIONS = {
+    ("POST", "/api/login"): ("登录", "USER"),
+    ("POST", "/api/logout"): ("登出", "USER"),
+    ("POST", "/api/keys"): ("创建密钥", "API_KEY"),
+    ("PUT", "/api/keys/{key_id}"): ("更新密钥", "API_KEY"),
+    ("DELETE", "/api/keys/{key_id}"): ("删除密钥", "API_KEY"),
+}
+
+
 async def log_middleware(request: Request, call_next):
     """
     全局中间件，记录所有请求的操作日志
+    - 用户取自认证依赖写入的 request.state（set_request_user），不重复解析 token、不查询数据库
+    - 操作类型按路由匹配结果（request.scope 中的 route 和 path_params）查表，不解析路径字符串
+    - 按 audit_policy 的路由策略逐条记录、抽样、只计数或跳过
+    - 所有请求（包括未认证的）计入 metrics 的延迟直方图和处理中请求数
+    日志交给 audit_writer 异步批量写入，请求路径上不访问数据库
     """
-    from database import SessionLocal
-    
     start_time = datetime.utcnow()
+    started = time.perf_counter()
     response = None
     exception = None
     
+    request_metrics.start()
     try:
         response = await call_next(request)
     except Exception as e:
         exception = e
         response = None
+    request_metrics.finish(
+        getattr(request.scope.get("route"), "path", None),
+        request.method,
+        response.status_code if response is not None else 500,
+        (time.perf_counter() - started) * 1000,
+    )
     
-    # 只记录 API 路由的操作
-    if request.url.path.startswith("/api/"):
+    # log_entries.user_id 非空，只记录已认证用户的请求
+    user_id = getattr(request.state, "user_id", None)
+    if user_id is not None:
         try:
-            db = SessionLocal()
-            current_user = None
-            
-            try:
-                current_user = await get_current_user(request)
-            except:
-                pass
-            
-            # 获取客户端 IP
-            x_forwarded_for = request.headers.get("X-Forwarded-For")
-            if x_forwarded_for:
-                ip_address = x_forwarded_for.split(",")[0].strip()
-            else:
-                x_real_ip = request.headers.get("X-Real-IP")
-                if x_real_ip:
-                    ip_address = x_real_ip
-                else:
-                    ip_address = request.client.host if request.client else "unknown"
-            
-            # 获取 User-Agent
-            user_agent = request.headers.get("User-Agent", "")[:500] if request.headers.get("User-Agent") else ""
-            
-            # 构建日志详情
-            details = {
-                "method": request.method,
-                "path": request.url.path,
-                "query_params": dict(request.query_params),
-                "status_code": response.status_code if response else (500 if exception else None),
-                "response_time_ms": (datetime.utcnow() - start_time).total_seconds() * 1000
-            }
-            
-            # 根据操作类型记录不同的日志
-            action = "访问"
-            resource_type = "SYSTEM"
-            resource_id = None
-            resource_name = "unknown"  # 初始化默认值，避免变量未定义错误
-            
-            if request.url.path.endswith("/login"):
-                action = "登录"
-                resource_type = "USER"
-                if current_user:
-                    resource_name = current_user.username
-                else:
-                    resource_name = request.query_params.get("username", "unknown")
-            elif request.url.path.endswith("/logout"):
-                action = "登出"
-                resource_type = "USER"
-                resource_name = current_user.username if current_user else "unknown"
-            elif "/api/keys/" in request.url.path:
-                if request.method == "POST":
-                    action = "创建密钥"
-                    resource_type = "API_KEY"
-                    resource_name = request.query_params.get("key_name", "unknown")
-                elif request.method == "PUT":
-                    action = "更新密钥"
-                    resource_type = "API_KEY"
-                    key_id = request.url.path.split("/")[-1]
-                    resource_id = int(key_id) if key_id.isdigit() else None
-                    resource_name = request.query_params.get("key_name", "unknown")
-                elif request.method == "DELETE":
-                    action = "删除密钥"
-                    resource_type = "API_KEY"
-                    key_id = request.url.path.split("/")[-1]
-                    resource_id = int(key_id) if key_id.isdigit() else None
-                    resource_name = "unknown"
-            
-            # 记录日志
-            log_action(
-                db=db,
-                user_id=current_user.id if current_user else None,
-                username=current_user.username if current_user else None,
-                action=action,
-                resource_type=resource_type,
-                resource_id=resource_id,
-                resource_name=resource_name,
-                ip_address=ip_address,
-                user_agent=user_agent,
-                status="success" if (response and response.status_code < 400) or (not response and not exception) else "failed",
-                error_message=str(exception) if exception else None,
-                details=details
-            )
-            
-            db.close()
+            route_path = getattr(request.scope.get("route"), "path", None)
+            failed = exception is not None or (response is not None and response.status_code >= 400)
+            mode = should_log(request.method, route_path, failed)
+            if mode == COUNT:
+                await audit_writer.count(user_id, request.state.username, request.method, route_path)
+            elif mode == ALWAYS:
+                await audit_writer.submit(
+                    _build_entry(request, route_path, response, exception, failed, start_time)
+                )
         except Exception as e:
             print(f"Failed to log request: {e}")
     
     if exception:
         raise exception
     
-    return response
\ No newline at end of file
+    return response
+
+
+def _build_entry(request: Request, route_path: str, response, exception, failed: bool,
+                 start_time: datetime) -> dict:
+    """构建一条请求日志（LogEntry 列名 -> 值）"""
+    username = request.state.username
+    
+    # 获取客户端 IP
+    x_forwarded_for = request.headers.get("X-Forwarded-For")
+    if x_forwarded_for:
+        ip_address = x_forwarded_for.split(",")[0].strip()
+    else:
+        x_real_ip = request.headers.get("X-Real-IP")
+        if x_real_ip:
+            ip_address = x_real_ip
+        else:
+            ip_address = request.client.host if request.client else "unknown"
+    
+    # 获取 User-Agent
+    user_agent = request.headers.get("User-Agent", "")[:500] if request.headers.get("User-Agent") else ""
+    
+    # 构建日志详情
+    details = {
+        "method": request.method,
+        "path": request.url.path,
+        "route": route_path,
+        "query_params": dict(request.query_params),
+        "status_code": response.status_code if response else (500 if exception else None),
+        "response_time_ms": (datetime.utcnow() - start_time).total_seconds() * 1000
+    }
+    
+    # 根据操作类型记录不同的日志
+    action, resource_type = ROUTE_ACTIONS.get((request.method, route_path), ("访问", "SYSTEM"))
+    resource_id = None
+    resource_name = "unknown"
+    if resource_type == "USER":
+        resource_name = username
+    elif resource_type == "API_KEY":
+        key_id = str(request.scope.get("path_params", {}).get("key_id", ""))
+        resource_id = int(key_id) if key_id.isdigit() else None
+        resource_name = request.query_params.get("key_name", "unknown")
+    
+    return {
+        "user_id": request.state.user_id,
+        "username": username,
+        "action": action,
+        "resource_type": resource_type,
+        "resource_id": resource_id,
+        "resource_name": resource_name,
+        "ip_address": ip_address,
+        "user_agent": user_agent,
+        "status": "failed" if failed else "success",
+        "error_message": str(exception) if exception else None,
+        "details": details
+    }
@@ -0,0 +1,265 @@
+"""
+操作日志全文搜索（LOG_SEARCH=fulltext 时启用）
+- 搜索范围：action、resource_name、error_message、details
+- SQLite：FTS5 虚拟表 log_entries_fts（trigram 分词，支持中文和任意子串匹配），rowid 即日志 ID；
+  普通表由 AFTER INSERT / DELETE 触发器同步，分区模式下由分区视图的 INSTEAD OF 触发器同步
+  （见 partitions.py），删除过期分区时一并清理；首次启用时从现有日志回填
+- PostgreSQL：simple 配置的 tsvector GIN 表达式索引 + pg_trgm 三元组 GIN 索引（子串/中文匹配），
+  索引由数据库在插入时维护，分区表上的索引自动建到各分区
+- 搜索词按空白拆分，所有词都需匹配；SQLite trigram 至少需要 3 个字符，更短的词退回 LIKE 匹配
+- 结果按相关度（SQLite bm25 / PostgreSQL ts_rank）排序，摘要在本页结果上生成，
+  内容经过 HTML 转义，命中部分用 <mark> 标记
+- 未启用时 q 参数退回对四个字段的 LIKE 匹配，按时间倒序
+"""
+import html
+import json
+import re
+import sqlite3
+from functools import lru_cache
+from typing import List, Optional
+from sqlalchemy import and_, column, desc, func, inspect, literal_column, or_, select, table, text
+from config import settings
+from database import engine, migration_lock
+
+FTS_TABLE = "log_entries_fts"
+SEARCH_FIELDS = ("action", "resource_name", "error_message", "details")
+
+# 搜索词个数上限
+MAX_TERMS = 8
+# trigram 分词可匹配的最短搜索词
+MIN_TRIGRAM_LENGTH = 3
+# 摘要中命中位置前后保留的字符数
+SNIPPET_BEFORE = 30
+SNIPPET_AFTER = 80
+
+# PostgreSQL 索引与查询使用同一个表达式（查询条件的表达式与索引一致时才能使用索引）
+PG_DOCUMENT = " || ' ' || ".join(
+    f"coalesce(CAST({{prefix}}{field} AS TEXT), '')" for field in SEARCH_FIELDS
+)
+
+_fts_ready = False
+
+
+def search_enabled() -> bool:
+    return settings.LOG_SEARCH == "fulltext"
+
+
+@lru_cache(maxsize=None)
+def _sqlite_trigram_supported() -> bool:
+    """FTS5 trigram 分词需要 SQLite 3.34+ 且编译时启用 FTS5"""
+    try:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE t USING fts5(a, tokenize='trigram')")
+        finally:
+            conn.close()
+        return True
+    except sqlite3.Error:
+        return False
+
+
+def sqlite_fts_active() -> bool:
+    """SQLite 下是否维护 FTS 表（供分区视图触发器判断是否同步写入）"""
+    return settings.USE_SQLITE and search_enabled() and _sqlite_trigram_supported()
+
+
+# ============ SQLite 同步语句 ============
+
+def sqlite_create_table() -> str:
+    return (f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"user_id UNINDEXED, {', '.join(SEARCH_FIELDS)}, tokenize='trigram')")
+
+
+def sqlite_sync_insert(id_expr: str = "NEW.id") -> str:
+    fields = ", ".join(SEARCH_FIELDS)
+    values = ", ".join(f"NEW.{field}" for field in SEARCH_FIELDS)
+    return (f"INSERT INTO {FTS_TABLE} (rowid, user_id, {fields}) "
+            f"VALUES ({id_expr}, NEW.user_id, {values});")
+
+
+def sqlite_sync_delete() -> str:
+    return f"DELETE FROM {FTS_TABLE} WHERE rowid = OLD.id;"
+
+
+def sqlite_drop_partition(partition: str) -> str:
+    """删除分区前清理该分区对应的索引行"""
+    return f"DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT id FROM {partition})"
+
+
+def _sqlite_init():
+    global _fts_ready
+    with engine.begin() as conn:
+        conn.execute(text("DROP TRIGGER IF EXISTS log_entries_fts_insert"))
+        conn.execute(text("DROP TRIGGER IF EXISTS log_entries_fts_delete"))
+        if not search_enabled():
+            conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+            return
+        if not _sqlite_trigram_supported():
+            print("⚠️  当前 SQLite 不支持 FTS5 trigram 分词，日志搜索使用 LIKE 匹配")
+            return
+
+        # 分区视图的触发器引用 FTS 表，分区初始化时可能已建好表（见 partitions.py），按是否为空判断回填
+        conn.execute(text(sqlite_create_table()))
+        empty = conn.execute(text(f"SELECT 1 FROM {FTS_TABLE} LIMIT 1")).first() is None
+        if empty and conn.execute(text("SELECT 1 FROM log_entries LIMIT 1")).first() is not None:
+            fields = ", ".join(SEARCH_FIELDS)
+            count = conn.execute(text(
+                f"INSERT INTO {FTS_TABLE} (rowid, user_id, {fields}) "
+                f"SELECT id, user_id, {fields} FROM log_entries"
+            )).rowcount
+            print(f"✅ 已建立操作日志全文索引（{count} 条）")
+
+        # 分区模式下 log_entries 是视图，由分区视图的触发器同步
+        if "log_entries" in inspect(conn).get_table_names():
+            conn.execute(text(
+                f"CREATE TRIGGER log_entries_fts_insert AFTER INSERT ON log_entries BEGIN "
+                f"{sqlite_sync_insert()} END"
+            ))
+            conn.execute(text(
+                f"CREATE TRIGGER log_entries_fts_delete AFTER DELETE ON log_entries BEGIN "
+                f"{sqlite_sync_delete()} END"
+            ))
+    _fts_ready = True
+
+
+# ============ PostgreSQL 索引 ============
+
+def _pg_init():
+    global _fts_ready
+    if not search_enabled():
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX IF EXISTS ix_log_entries_search_tsv"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_log_entries_search_trgm"))
+        return
+
+    document = PG_DOCUMENT.format(prefix="")
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_log_entries_search_tsv ON log_entries "
+            f"USING GIN (to_tsvector('simple', {document}))"
+        ))
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_log_entries_search_trgm ON log_entries "
+                f"USING GIN (({document}) gin_trgm_ops)"
+            ))
+    except Exception as e:
+        print(f"⚠️  无法创建 pg_trgm 索引，子串搜索将扫描该用户的全部日志: {e}")
+    _fts_ready = True
+
+
+def init_log_search():
+    """启动时建立或移除全文索引（需在日志分区初始化之后执行，多个 worker 依次执行）"""
+    with migration_lock("log-search"):
+        if settings.USE_SQLITE:
+            _sqlite_init()
+        else:
+            _pg_init()
+
+
+# ============ 查询 ============
+
+def parse_terms(q: Optional[str]) -> List[str]:
+    """按空白拆分搜索词（去重，最多 MAX_TERMS 个）"""
+    terms = []
+    for term in (q or "").split():
+        if term.lower() not in (t.lower() for t in terms):
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+
+def _like_pattern(term: str) -> str:
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def _like_any_field(source, term: str):
+    pattern = _like_pattern(term)
+    return or_(*[getattr(source, field).ilike(pattern, escape="\\") for field in SEARCH_FIELDS])
+
+
+def apply_search(query, source, user_id: int, terms: List[str]):
+    """
+    为日志查询加上搜索条件、相关度列和排序，返回的查询每行为 (日志, 相关度)
+    相关度越大越相关；按 LIKE 匹配时相关度为 0，结果按时间倒序
+    """
+    if _fts_ready and settings.USE_SQLITE:
+        long_terms = [t for t in terms if len(t) >= MIN_TRIGRAM_LENGTH]
+        short_terms = [t for t in terms if len(t) < MIN_TRIGRAM_LENGTH]
+        if long_terms:
+            match = " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+            # 先在 FTS 表中取出匹配的 ID 和相关度再回表；LIMIT -1 阻止 SQLite 把子查询展开成连接，
+            # 否则可能按 user_id 索引遍历该用户全部日志并逐条 MATCH
+            matched = select(
+                literal_column("rowid").label("id"),
+                literal_column(f"-bm25({FTS_TABLE})").label("rank"),
+            ).select_from(table(FTS_TABLE)).where(
+                text(f"{FTS_TABLE} MATCH :search_match").bindparams(search_match=match),
+                column("user_id") == user_id,
+            ).limit(-1).subquery("search_matched")
+            query = query.join(matched, matched.c.id == source.id)
+            rank = matched.c.rank
+        else:
+            rank = literal_column("0")
+        for term in short_terms:
+            query = query.filter(_like_any_field(source, term))
+    elif _fts_ready:
+        document = literal_column(PG_DOCUMENT.format(prefix="log_entries."))
+        vector = func.to_tsvector(literal_column("'simple'"), document)
+        tsquery = func.websearch_to_tsquery(literal_column("'simple'"), " ".join(terms))
+        query = query.filter(or_(
+            vector.op("@@")(tsquery),
+            and_(*[document.ilike(_like_pattern(t), escape="\\") for t in terms]),
+        ))
+        rank = func.ts_rank(vector, tsquery)
+    else:
+        for term in terms:
+            query = query.filter(_like_any_field(source, term))
+        rank = literal_column("0")
+
+    return query.add_columns(rank.label("rank")).order_by(
+        desc("rank"), desc(source.created_at), desc(source.id)
+    )
+
+
+def _field_text(value) -> str:
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def record_matches(record: dict, terms: List[str]) -> bool:
+    """分段文件存储下逐条匹配（所有搜索词都需出现在某个字段中）"""
+    text_value = "\n".join(_field_text(record.get(field) or "") for field in SEARCH_FIELDS).lower()
+    return all(term.lower() in text_value for term in terms)
+
+
+def highlight(record, terms: List[str]) -> Optional[str]:
+    """
+    生成摘要：取第一个命中的字段，截取命中位置附近的内容，
+    HTML 转义后用 <mark> 标记所有搜索词；record 为日志对象或字典
+    """
+    if not terms:
+        return None
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    for field in SEARCH_FIELDS:
+        value = record.get(field) if isinstance(record, dict) else getattr(record, field, None)
+        if not value:
+            continue
+        value = _field_text(value)
+        found = pattern.search(value)
+        if not found:
+            continue
+        start = max(found.start() - SNIPPET_BEFORE, 0)
+        end = min(found.end() + SNIPPET_AFTER, len(value))
+        window = value[start:end]
+        parts, last = [], 0
+        for m in pattern.finditer(window):
+            parts.append(html.escape(window[last:m.start()]))
+            parts.append(f"<mark>{html.escape(m.group())}</mark>")
+            last = m.end()
+        parts.append(html.escape(window[last:]))
+        return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(value) else "")
+    return None
@@ -10,8 +10,17 @@ from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from config import settings
-from routers import auth, keys, totp, user
+from routers import auth, keys, totp, usage, user
 from log_middleware import log_middleware
+from key_crypto import init_keyring
+from session_store import init_session_store, shutdown_session_store
+from hash_pool import init_hash_pool, shutdown_hash_pool
+from audit_writer import audit_writer
+from partitions import init_partitions, shutdown_partitions
+from log_details import init_log_details
+from log_search import init_log_search
+import metrics
+from captcha import captcha_pool
 from pathlib import Path
 
 # 获取前端静态文件目录
@@ -28,6 +37,66 @@ app = FastAPI(
     redoc_url="/redoc" if settings.DEBUG else None
 )
 
+# 启动时构建密钥环（PBKDF2 派生只执行一次）
+@app.on_event("startup")
+def startup_keyring():
+    init_keyring()
+
+# 启动时加载已撤销会话，并开始后台同步
+@app.on_event("startup")
+def startup_session_store():
+    init_session_store()
+
+# 启动时迁移/预建日志分区，并开始后台分区维护（LOG_PARTITIONING=monthly 时）
+@app.on_event("startup")
+def startup_partitions():
+    init_partitions()
+
+# 启动时把历史操作日志的 details 规范化为 JSON 对象（需在分区初始化之后，只执行一次）
+@app.on_event("startup")
+def startup_log_details():
+    init_log_details()
+
+# 启动时建立操作日志全文索引（需在分区初始化之后）
+@app.on_event("startup")
+def startup_log_search():
+    init_log_search()
+
+# 启动时创建密码哈希进程池
+@app.on_event("startup")
+def startup_hash_pool():
+    init_hash_pool()
+
+# 启动验证码预渲染线程
+@app.on_event("startup")
+def startup_captcha_pool():
+    captcha_pool.start()
+
+# 启动审计日志批量写入任务，关闭时写完队列中剩余日志
+@app.on_event("startup")
+async def startup_audit_writer():
+    audit_writer.start()
+
+@app.on_event("shutdown")
+async def shutdown_audit_writer():
+    await audit_writer.stop()
+
+# 定期写入本 worker 的指标快照，供 /metrics 汇总多个 worker
+@app.on_event("startup")
+async def startup_metrics():
+    metrics.start_metrics()
+
+@app.on_event("shutdown")
+async def shutdown_metrics():
+    metrics.stop_metrics()
+
+@app.on_event("shutdown")
+def shutdown_sessions():
+    shutdown_session_store()
+    shutdown_hash_pool()
+    shutdown_partitions()
+    captcha_pool.stop()
+
 # Rate limiter state
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -51,6 +120,8 @@ app.include_router(auth.router)
 app.include_router(keys.router)
 app.include_router(totp.router)
 app.include_router(user.router)
+app.include_router(usage.router)
+app.include_router(metrics.router)
 
 @app.middleware("http")
 async def add_security_headers(request: Request, call_next):
@@ -0,0 +1,266 @@
+"""
+请求延迟直方图和 Prometheus /metrics
+- 按 (路由模板, 方法, 状态类别 2xx/4xx/5xx) 统计响应时间，对数-线性分桶：
+  每个 2 的幂区间再线性分为 SUB_BUCKETS 份（0.25ms ~ 65s），分位数相对误差不超过 1/SUB_BUCKETS
+- 计数由 log_middleware 在事件循环线程中更新，不加锁；快照同样在事件循环中复制
+- 多 worker：每个进程每 METRICS_SNAPSHOT_INTERVAL_SECONDS 把快照原子写入 METRICS_DIR/{pid}.json，
+  /metrics 把其他存活进程的快照与本进程的当前值相加；已退出进程的快照会被删除（计数器表现为重置）
+- 同时导出各进程内组件的统计：用户缓存、哈希进程池、数据密钥缓存、审计写入、验证码池、
+  会话撤销、总数缓存、分段日志存储（多进程求和）
+- 需携带 Authorization: Bearer <METRICS_TOKEN>；未设置 METRICS_TOKEN 时返回 403
+  （服务通常经同机反向代理访问，不能按来源地址判断是否为本机请求）
+- 读取组件统计不会创建尚未启动的组件（如哈希进程池）
+"""
+import asyncio
+import bisect
+import hmac
+import json
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from config import settings
+
+# 每个 2 的幂区间的线性分段数、最小/最大区间（毫秒，2 的指数）
+SUB_BUCKETS = 4
+MIN_EXPONENT = -2
+MAX_EXPONENT = 16
+
+# 各桶上界（毫秒），最后还有一个 +Inf 桶
+BUCKET_BOUNDS: List[float] = [2.0 ** MIN_EXPONENT] + [
+    2.0 ** e * (1 + k / SUB_BUCKETS)
+    for e in range(MIN_EXPONENT, MAX_EXPONENT)
+    for k in range(1, SUB_BUCKETS + 1)
+]
+
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+    """单个序列的分桶计数"""
+    __slots__ = ("counts", "total", "sum_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+
+
+class RequestMetrics:
+    """本进程的请求指标"""
+
+    def __init__(self):
+        self._series: Dict[Tuple[str, str, str], Histogram] = {}
+        self.in_flight = 0
+
+    def start(self):
+        self.in_flight += 1
+
+    def finish(self, route_path: Optional[str], method: str, status_code: int, ms: float):
+        self.in_flight -= 1
+        key = (route_path or UNMATCHED_ROUTE, method, f"{status_code // 100}xx")
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = Histogram()
+        series.observe(ms)
+
+    def snapshot(self) -> dict:
+        """复制当前值（需在事件循环线程中调用）"""
+        return {
+            "pid": os.getpid(),
+            "in_flight": self.in_flight,
+            "series": [
+                [route, method, status, list(h.counts), h.total, h.sum_ms]
+                for (route, method, status), h in self._series.items()
+            ],
+            "components": component_stats(),
+        }
+
+
+request_metrics = RequestMetrics()
+
+
+# ============ 组件统计 ============
+
+def component_stats() -> Dict[str, dict]:
+    """各组件 stats()，只保留数值项（导入放在函数内，避免循环导入）"""
+    from auth import get_user_cache_stats
+    from audit_writer import get_audit_writer_stats
+    from captcha import captcha_pool
+    from count_cache import get_count_cache_stats
+    from hash_pool import get_hash_pool_stats
+    from key_crypto import get_data_key_cache_stats
+    from segment_log import get_segment_store_stats
+    from session_store import get_session_store_stats
+
+    sources = {
+        "user_cache": get_user_cache_stats,
+        "hash_pool": get_hash_pool_stats,
+        "data_key_cache": get_data_key_cache_stats,
+        "audit_writer": get_audit_writer_stats,
+        "captcha_pool": captcha_pool.stats,
+        "session_store": get_session_store_stats,
+        "count_cache": get_count_cache_stats,
+        "segment_store": get_segment_store_stats,
+    }
+    result = {}
+    for name, stats in sources.items():
+        try:
+            values = stats()
+        except Exception as e:
+            print(f"⚠️  读取 {name} 统计失败: {e}")
+            continue
+        result[name] = {
+            key: float(value) for key, value in values.items()
+            if isinstance(value, (int, float))
+        }
+    return result
+
+
+# ============ 多进程快照 ============
+
+_snapshot_task: Optional[asyncio.Task] = None
+
+
+def _snapshot_path(pid: int) -> Path:
+    return Path(settings.METRICS_DIR) / f"{pid}.json"
+
+
+def _write_snapshot(snapshot: dict):
+    directory = Path(settings.METRICS_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = _snapshot_path(snapshot["pid"])
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(snapshot))
+    os.replace(tmp, path)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_other_snapshots() -> List[dict]:
+    """读取其他存活 worker 的快照，删除已退出进程的快照"""
+    directory = Path(settings.METRICS_DIR)
+    if not directory.exists():
+        return []
+    snapshots, own_pid = [], os.getpid()
+    for path in directory.glob("*.json"):
+        if not path.stem.isdigit() or int(path.stem) == own_pid:
+            continue
+        if not _pid_alive(int(path.stem)):
+            path.unlink(missing_ok=True)
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(settings.METRICS_SNAPSHOT_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(_write_snapshot, request_metrics.snapshot())
+        except Exception as e:
+            print(f"⚠️  写入指标快照失败: {e}")
+
+
+def start_metrics():
+    """启动定期写快照的任务（需在事件循环中调用）"""
+    global _snapshot_task
+    if settings.METRICS_SNAPSHOT_INTERVAL_SECONDS > 0 and _snapshot_task is None:
+        _snapshot_task = asyncio.get_running_loop().create_task(_snapshot_loop())
+
+
+def stop_metrics():
+    global _snapshot_task
+    if _snapshot_task is not None:
+        _snapshot_task.cancel()
+        _snapshot_task = None
+    _snapshot_path(os.getpid()).unlink(missing_ok=True)
+
+
+# ============ Prometheus 文本格式 ============
+
+def _label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_bound(ms: float) -> str:
+    return repr(ms / 1000)
+
+
+def render_metrics(snapshots: List[dict]) -> str:
+    """把多个进程的快照相加并输出 Prometheus 文本格式"""
+    series: Dict[Tuple[str, str, str], list] = {}
+    components: Dict[Tuple[str, str], float] = {}
+    in_flight = 0
+    for snapshot in snapshots:
+        in_flight += snapshot.get("in_flight", 0)
+        for route, method, status, counts, total, sum_ms in snapshot.get("series", []):
+            merged = series.setdefault((route, method, status), [[0] * len(counts), 0, 0.0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += sum_ms
+        for name, values in snapshot.get("components", {}).items():
+            for key, value in values.items():
+                components[(name, key)] = components.get((name, key), 0.0) + value
+
+    lines = [
+        "# HELP http_request_duration_seconds Request latency by route template, method and status class.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (route, method, status), (counts, total, sum_ms) in sorted(series.items()):
+        labels = f'route="{_label_value(route)}",method="{method}",status="{status}"'
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, counts):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {total}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {sum_ms / 1000}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {total}")
+
+    lines += [
+        "# HELP http_requests_in_flight Requests currently being handled.",
+        "# TYPE http_requests_in_flight gauge",
+        f"http_requests_in_flight {in_flight}",
+        "# HELP app_workers Worker processes included in these metrics.",
+        "# TYPE app_workers gauge",
+        f"app_workers {len(snapshots)}",
+    ]
+    for (component, key), value in sorted(components.items()):
+        metric = f"app_{component}_{key}"
+        lines.append(f"# TYPE {metric} untyped")
+        lines.append(f"{metric} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint(request: Request):
+    """Prometheus 指标（所有 worker 汇总）"""
+    if not settings.METRICS_TOKEN:
+        raise HTTPException(status_code=403, detail="未配置 METRICS_TOKEN，指标接口已禁用")
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), expected):
+        raise HTTPException(status_code=401, detail="未授权")
+    own = request_metrics.snapshot()
+    others = await asyncio.to_thread(_read_other_snapshots)
+    return PlainTextResponse(render_metrics([own] + others),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
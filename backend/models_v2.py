@@ -1,6 +1,7 @@
 # 重构版模型定义 - 移除管理员，用户自主管理
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Boolean, Text, TIMESTAMP, ForeignKey, Numeric
+from sqlalchemy import Column, Integer, String, Boolean, Text, TIMESTAMP, ForeignKey, Numeric, LargeBinary, Index, JSON
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -24,6 +25,8 @@ class User(Base):
     login_history = relationship("LoginHistory", back_populates="user", cascade="all, delete-orphan")
     logs = relationship("LogEntry", back_populates="user", cascade="all, delete-orphan")
     token_usage = relationship("TokenUsage", back_populates="user", cascade="all, delete-orphan")
+    data_key = relationship("UserDataKey", back_populates="user", cascade="all, delete-orphan", uselist=False)
+    sessions = relationship("UserSession", back_populates="user", cascade="all, delete-orphan")
 
 class ApiProvider(Base):
     __tablename__ = "api_providers"
@@ -66,6 +69,7 @@ class UserApiKey(Base):
     provider_id = Column(Integer, ForeignKey("api_providers.id", ondelete="SET NULL"), nullable=True)
     key_name = Column(String(100), nullable=False)
     api_key_encrypted = Column(Text, nullable=False)
+    api_key_cipher = Column(LargeBinary, nullable=True)  # AES-GCM 二进制密文，非空时优先于 api_key_encrypted
     api_key_preview = Column(String(20))
     model_id = Column(String(100), nullable=True)
     status = Column(String(20), default="active")
@@ -88,13 +92,44 @@ class TOTPConfig(Base):
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, unique=True, index=True)
     secret = Column(String(255), nullable=False)
     is_enabled = Column(Boolean, default=False)
+    last_used_step = Column(Integer, nullable=True)  # 最近一次验证通过的时间步（防重放，各 worker 共享）
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
     updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     user = relationship("User", back_populates="totp_config")
 
+class UserDataKey(Base):
+    """用户数据密钥（信封加密），由主密钥包装后存储"""
+    __tablename__ = "user_data_keys"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, unique=True, index=True)
+    key_version = Column(Integer, nullable=False)  # 包装时使用的主密钥版本
+    wrapped_key = Column(LargeBinary, nullable=False)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    user = relationship("User", back_populates="data_key")
+
+class UserSession(Base):
+    """登录会话（按 JWT jti 记录），撤销后 revoked_at 非空"""
+    __tablename__ = "user_sessions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    jti = Column(String(64), unique=True, nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    ip_address = Column(String(45), nullable=True)
+    user_agent = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    expires_at = Column(TIMESTAMP, nullable=False, index=True)
+    revoked_at = Column(TIMESTAMP, nullable=True, index=True)
+    
+    user = relationship("User", back_populates="sessions")
+
 class LogEntry(Base):
     __tablename__ = "log_entries"
+    # 按月分区（SQLite 视图 + 触发器）时删除不返回影响行数
+    __mapper_args__ = {"confirm_deleted_rows": False}
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -107,13 +142,16 @@ class LogEntry(Base):
     user_agent = Column(Text, nullable=True)
     status = Column(String(20), default="success")
     error_message = Column(Text, nullable=True)
-    details = Column(Text, nullable=True)
+    # JSON 对象（PostgreSQL 为 JSONB），写入前经 log_details.normalize_details 规范化
+    details = Column(JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), "postgresql"), nullable=True)
     created_at = Column(TIMESTAMP, default=datetime.utcnow, index=True)
     
     user = relationship("User", back_populates="logs")
 
 class LoginHistory(Base):
     __tablename__ = "login_history"
+    # 按月分区（SQLite 视图 + 触发器）时删除不返回影响行数
+    __mapper_args__ = {"confirm_deleted_rows": False}
     
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
@@ -178,3 +216,13 @@ class RenewalRecord(Base):
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
     
     key = relationship("UserApiKey", back_populates="renewals")
+
+
+# 列表接口按 (created_at, id) 倒序游标分页使用的复合索引
+Index("ix_log_entries_user_created_id", LogEntry.user_id, LogEntry.created_at.desc(), LogEntry.id.desc())
+Index("ix_login_history_user_created_id", LoginHistory.user_id, LoginHistory.created_at.desc(), LoginHistory.id.desc())
+Index("ix_token_usage_user_created_id", TokenUsage.user_id, TokenUsage.created_at.desc(), TokenUsage.id.desc())
+Index("ix_renewal_records_user_created_id", RenewalRecord.user_id, RenewalRecord.created_at.desc(), RenewalRecord.id.desc())
+
+# 用量批量上报按 (user_id, request_id) 去重
+Index("ux_token_usage_user_request_id", TokenUsage.user_id, TokenUsage.request_id, unique=True)
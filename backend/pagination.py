@@ -0,0 +1,65 @@
+"""
+列表接口的游标（keyset）分页
+- 按 (created_at, id) 倒序，游标为上一页最后一条记录的 (created_at, id)，编码为不透明字符串
+- 传入 cursor 时不使用 OFFSET、不统计总数，查询只沿 (user_id, created_at DESC, id DESC) 索引向后读取一页，
+  响应时间与翻页深度无关
+- 未传 cursor 时保持原有 page / page_size 分页，响应中同样返回 next_cursor，客户端可从任意一页切换到游标分页
+"""
+import base64
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import desc, or_
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """解析游标，格式错误时返回 400"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+
+def cursor_upper_bound(end: Optional[datetime], cursor: Optional[Tuple[datetime, int]]) -> Optional[datetime]:
+    """游标之后的记录都早于游标时间，用作分区裁剪的上界"""
+    if cursor is None:
+        return end
+    upper = cursor[0] + timedelta(microseconds=1)
+    return upper if end is None or upper < end else end
+
+
+def keyset_query(query, model, page: int, page_size: int, cursor: Optional[Tuple[datetime, int]] = None):
+    """
+    按 (created_at, id) 倒序取一页（多取一条用于判断是否还有下一页）
+    cursor 为 decode_cursor 的结果，为空时退回 OFFSET 分页
+    """
+    query = query.order_by(desc(model.created_at), desc(model.id))
+    if cursor is not None:
+        created_at, row_id = cursor
+        # 写成 created_at <= ? AND (...) 而不是 (created_at < ? OR (created_at = ? AND id < ?))，
+        # 后者在参数化查询下 SQLite 只能按 user_id 扫描索引
+        query = query.filter(
+            model.created_at <= created_at,
+            or_(model.created_at < created_at, model.id < row_id),
+        )
+    else:
+        query = query.offset((page - 1) * page_size)
+    return query.limit(page_size + 1)
+
+
+def split_page(rows: List, page_size: int) -> Tuple[List, Optional[str]]:
+    """返回 (本页记录, 下一页游标)，没有下一页时游标为 None"""
+    if len(rows) <= page_size:
+        return rows, None
+    if page_size <= 0:
+        return [], None
+    rows = rows[:page_size]
+    last = rows[-1]
+    return rows, encode_cursor(last.created_at, last.id)
@@ -0,0 +1,482 @@
+"""
+log_entries / login_history 按月分区（LOG_PARTITIONING=monthly 时启用）
+- PostgreSQL：原生范围分区，父表保持原表名，分区名 {表名}_{YYYYMM}
+- SQLite：每月一张表 {表名}_{YYYYMM}，原表名改为 UNION ALL 视图，
+  视图上的 INSTEAD OF 触发器按 created_at 把插入路由到对应月份表、把删除转发到各月份表；
+  ID 由 partition_ids 计数表分配，ORM 插入在 flush 前预先分配（视图无法返回自增 ID）
+- 启动时把已有的普通表迁移为分区（按月复制数据），并预建当月和下月分区；
+  迁移、建分区和删分区持有 migration_lock，多个 worker 同时启动时依次执行
+- 后台维护线程定期预建分区，超过 LOG_RETENTION_MONTHS 的分区整表删除（不逐行 DELETE），
+  配置 LOG_ARCHIVE_DIR 时删除前先导出为 gzip 压缩的 JSON Lines 文件
+- partition_source() 返回只覆盖查询时间范围的分区的查询源，读取接口不扫描无关月份
+"""
+import gzip
+import json
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+from sqlalchemy import (
+    Column, ForeignKey, Index, MetaData, Table, event, inspect, select, text, union_all
+)
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy.schema import CreateIndex, CreateTable
+from config import settings
+from database import engine, migration_lock
+from log_search import (
+    sqlite_create_table, sqlite_drop_partition, sqlite_fts_active, sqlite_sync_delete, sqlite_sync_insert
+)
+from models_v2 import LogEntry, LoginHistory
+
+PARTITIONED_MODELS = {
+    "log_entries": LogEntry,
+    "login_history": LoginHistory,
+}
+
+# 维护线程执行间隔（秒）
+MAINTENANCE_INTERVAL_SECONDS = 3600
+# 跨 worker 的迁移锁名
+MIGRATION_LOCK = "log-partitions"
+
+_active = False
+_stop_event = threading.Event()
+_maintenance_thread: Optional[threading.Thread] = None
+# 表名 -> 已存在的分区月份（升序，如 [202609, 202610]）
+_months: Dict[str, List[int]] = {}
+_months_lock = threading.Lock()
+
+
+def partitioning_enabled() -> bool:
+    return settings.LOG_PARTITIONING == "monthly"
+
+
+# ============ 月份计算 ============
+
+def month_of(dt: datetime) -> int:
+    return dt.year * 100 + dt.month
+
+
+def month_start(month: int) -> datetime:
+    return datetime(month // 100, month % 100, 1)
+
+
+def add_months(month: int, count: int) -> int:
+    index = (month // 100) * 12 + (month % 100 - 1) + count
+    return (index // 12) * 100 + index % 12 + 1
+
+
+def partition_name(table_name: str, month: int) -> str:
+    return f"{table_name}_{month}"
+
+
+def _partition_table(table_name: str, month: int) -> Table:
+    """按模型列定义构建分区表（只复制列、主键和外键，索引按分区命名）"""
+    name = partition_name(table_name, month)
+    columns = {}
+    for col in PARTITIONED_MODELS[table_name].__table__.columns:
+        args = [ForeignKey(fk.column, ondelete=fk.ondelete) for fk in col.foreign_keys]
+        columns[col.name] = Column(col.name, col.type, *args, primary_key=col.primary_key,
+                                   nullable=col.nullable, autoincrement=False)
+    return Table(
+        name, MetaData(), *columns.values(),
+        Index(f"ix_{name}_user_created_id", columns["user_id"], columns["created_at"].desc(), columns["id"].desc()),
+        Index(f"ix_{name}_created_at", columns["created_at"]),
+    )
+
+
+def _column_names(table_name: str) -> List[str]:
+    return [col.name for col in PARTITIONED_MODELS[table_name].__table__.columns]
+
+
+def _to_sql_time(dt: datetime) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+# ============ SQLite ============
+
+def _sqlite_transaction(statements: List[str]):
+    """在一个 IMMEDIATE 事务中执行 DDL（pysqlite 默认不为 DDL 开启事务，视图重建需原子完成）"""
+    raw = engine.raw_connection()
+    dbapi_conn = raw.driver_connection
+    isolation_level = dbapi_conn.isolation_level
+    dbapi_conn.isolation_level = None
+    try:
+        cursor = dbapi_conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+    finally:
+        dbapi_conn.isolation_level = isolation_level
+        raw.close()
+
+
+def _range_condition(expr: str, months: List[int], i: int) -> str:
+    """第 i 个分区接收的 created_at 范围（早于最早分区的归入第一个，晚于最新分区的归入最后一个）"""
+    conditions = []
+    if i > 0:
+        conditions.append(f"{expr} >= '{_to_sql_time(month_start(months[i]))}'")
+    if i < len(months) - 1:
+        conditions.append(f"{expr} < '{_to_sql_time(month_start(months[i + 1]))}'")
+    return " AND ".join(conditions) or "1"
+
+
+def _sqlite_view_statements(table_name: str, months: List[int]) -> List[str]:
+    """重建 UNION ALL 视图和 INSTEAD OF 触发器"""
+    columns = _column_names(table_name)
+    column_list = ", ".join(columns)
+    created = "COALESCE(NEW.created_at, CURRENT_TIMESTAMP)"
+    new_id = f"COALESCE(NEW.id, (SELECT last_id FROM partition_ids WHERE name = '{table_name}'))"
+    values = ", ".join(
+        new_id if c == "id"
+        else created if c == "created_at"
+        else f"NEW.{c}"
+        for c in columns
+    )
+
+    inserts = [
+        f"INSERT INTO {partition_name(table_name, month)} ({column_list}) "
+        f"SELECT {values} WHERE {_range_condition(created, months, i)};"
+        for i, month in enumerate(months)
+    ]
+    deletes = [f"DELETE FROM {partition_name(table_name, month)} WHERE id = OLD.id;" for month in months]
+    prelude = []
+    if table_name == "log_entries" and sqlite_fts_active():
+        # 同步全文索引（见 log_search.py）；触发器引用的表需先存在，否则之后的 ALTER TABLE 会校验失败
+        prelude.append(sqlite_create_table())
+        inserts.append(sqlite_sync_insert(new_id))
+        deletes.append(sqlite_sync_delete())
+    selects = " UNION ALL ".join(
+        f"SELECT {column_list} FROM {partition_name(table_name, month)}" for month in months
+    )
+
+    return prelude + [
+        f"DROP VIEW IF EXISTS {table_name}",
+        f"CREATE VIEW {table_name} AS {selects}",
+        f"CREATE TRIGGER {table_name}_insert INSTEAD OF INSERT ON {table_name} BEGIN "
+        f"UPDATE partition_ids SET last_id = last_id + 1 WHERE name = '{table_name}' AND NEW.id IS NULL; "
+        + " ".join(inserts) + " END",
+        f"CREATE TRIGGER {table_name}_delete INSTEAD OF DELETE ON {table_name} BEGIN "
+        + " ".join(deletes) + " END",
+    ]
+
+
+def _sqlite_create_statements(table_name: str, month: int) -> List[str]:
+    table = _partition_table(table_name, month)
+    statements = [str(CreateTable(table, if_not_exists=True).compile(dialect=engine.dialect))]
+    statements += [str(CreateIndex(index, if_not_exists=True).compile(dialect=engine.dialect))
+                   for index in table.indexes]
+    return statements
+
+
+def _sqlite_existing_months(table_name: str) -> List[int]:
+    prefix = f"{table_name}_"
+    months = []
+    for name in inspect(engine).get_table_names():
+        suffix = name[len(prefix):]
+        if name.startswith(prefix) and len(suffix) == 6 and suffix.isdigit():
+            months.append(int(suffix))
+    return sorted(months)
+
+
+def _sqlite_migrate(table_name: str, months: List[int]):
+    """把普通表迁移为按月分区 + 视图（只在首次启用时执行）"""
+    columns = ", ".join(_column_names(table_name))
+    legacy = f"{table_name}_legacy"
+    with engine.connect() as conn:
+        data_months = [int(m) for (m,) in conn.execute(text(
+            f"SELECT DISTINCT strftime('%Y%m', created_at) FROM {table_name} WHERE created_at IS NOT NULL"
+        )) if m]
+    months = sorted(set(months) | set(data_months))
+
+    created = "COALESCE(created_at, CURRENT_TIMESTAMP)"
+    statements = [f"ALTER TABLE {table_name} RENAME TO {legacy}"]
+    for i, month in enumerate(months):
+        statements += _sqlite_create_statements(table_name, month)
+        statements.append(
+            f"INSERT INTO {partition_name(table_name, month)} ({columns}) "
+            f"SELECT {columns.replace('created_at', created)} "
+            f"FROM {legacy} WHERE {_range_condition(created, months, i)}"
+        )
+    statements += [
+        f"INSERT OR REPLACE INTO partition_ids (name, last_id) "
+        f"SELECT '{table_name}', COALESCE(MAX(id), 0) FROM {legacy}",
+        f"DROP TABLE {legacy}",
+    ]
+    statements += _sqlite_view_statements(table_name, months)
+    _sqlite_transaction(statements)
+    print(f"✅ 已将 {table_name} 迁移为按月分区（{len(months)} 个分区）")
+    return months
+
+
+def _sqlite_ensure(table_name: str, wanted: List[int]) -> List[int]:
+    _sqlite_transaction([
+        "CREATE TABLE IF NOT EXISTS partition_ids (name VARCHAR(50) PRIMARY KEY, last_id INTEGER NOT NULL)",
+        f"INSERT OR IGNORE INTO partition_ids (name, last_id) VALUES ('{table_name}', 0)",
+    ])
+    existing = _sqlite_existing_months(table_name)
+    if table_name not in inspect(engine).get_view_names():
+        return _sqlite_migrate(table_name, wanted)
+
+    missing = [m for m in wanted if m not in existing]
+    if missing:
+        months = sorted(set(existing) | set(missing))
+        statements = []
+        for month in missing:
+            statements += _sqlite_create_statements(table_name, month)
+        _sqlite_transaction(statements + _sqlite_view_statements(table_name, months))
+        return months
+
+    # 视图触发器与当前配置不一致时重建（如启用或关闭了全文索引）
+    view_statements = _sqlite_view_statements(table_name, existing)
+    with engine.connect() as conn:
+        trigger_sql = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = :name"
+        ), {"name": f"{table_name}_insert"}).scalar()
+    if trigger_sql not in view_statements:
+        _sqlite_transaction(view_statements)
+    return existing
+
+
+def _sqlite_drop(table_name: str, month: int, remaining: List[int]):
+    statements = _sqlite_view_statements(table_name, remaining)
+    if table_name == "log_entries" and sqlite_fts_active():
+        statements.append(sqlite_drop_partition(partition_name(table_name, month)))
+    _sqlite_transaction(statements + [f"DROP TABLE IF EXISTS {partition_name(table_name, month)}"])
+
+
+def allocate_ids(connection, table_name: str, count: int) -> range:
+    """分配 count 个连续 ID（与视图插入触发器共用 partition_ids 计数）"""
+    connection.execute(
+        text("UPDATE partition_ids SET last_id = last_id + :count WHERE name = :name"),
+        {"count": count, "name": table_name}
+    )
+    last_id = connection.execute(
+        text("SELECT last_id FROM partition_ids WHERE name = :name"), {"name": table_name}
+    ).scalar()
+    return range(last_id - count + 1, last_id + 1)
+
+
+@event.listens_for(Session, "before_flush")
+def _assign_partition_ids(session, flush_context, instances):
+    """SQLite 分区模式下为待插入的日志预先分配 ID（写入视图时数据库无法返回自增 ID）"""
+    if not (_active and settings.USE_SQLITE):
+        return
+    for table_name, model in PARTITIONED_MODELS.items():
+        pending = [obj for obj in session.new if isinstance(obj, model) and obj.id is None]
+        if pending:
+            ids = allocate_ids(session.connection(), table_name, len(pending))
+            for obj, new_id in zip(pending, ids):
+                obj.id = new_id
+
+
+# ============ PostgreSQL ============
+
+def _pg_is_partitioned(conn, table_name: str) -> bool:
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+        "WHERE c.relname = :name"
+    ), {"name": table_name}).first() is not None
+
+
+def _pg_create_partition(conn, table_name: str, month: int):
+    start, end = month_start(month), month_start(add_months(month, 1))
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table_name, month)} PARTITION OF {table_name} "
+        f"FOR VALUES FROM ('{_to_sql_time(start)}') TO ('{_to_sql_time(end)}')"
+    ))
+
+
+def _pg_migrate(conn, table_name: str, months: List[int]) -> List[int]:
+    """把普通表迁移为原生分区表（主键需包含分区键 created_at）"""
+    legacy = f"{table_name}_legacy"
+    columns = ", ".join(_column_names(table_name))
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": table_name}).scalar()
+    data_months = [int(m) for (m,) in conn.execute(text(
+        f"SELECT DISTINCT to_char(created_at, 'YYYYMM') FROM {table_name} WHERE created_at IS NOT NULL"
+    )) if m]
+    months = sorted(set(months) | set(data_months))
+
+    conn.execute(text(f"ALTER TABLE {table_name} RENAME TO {legacy}"))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    conn.execute(text(
+        f"CREATE TABLE {table_name} (LIKE {legacy} INCLUDING DEFAULTS, PRIMARY KEY (id, created_at)) "
+        f"PARTITION BY RANGE (created_at)"
+    ))
+    conn.execute(text(
+        f"ALTER TABLE {table_name} ADD FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE"
+    ))
+    conn.execute(text(
+        f"CREATE INDEX ix_{table_name}_user_created_id ON {table_name} (user_id, created_at DESC, id DESC)"
+    ))
+    conn.execute(text(f"CREATE INDEX ix_{table_name}_created ON {table_name} (created_at)"))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table_name}.id"))
+    for month in months:
+        _pg_create_partition(conn, table_name, month)
+    conn.execute(text(
+        f"INSERT INTO {table_name} ({columns}) "
+        f"SELECT {columns.replace('created_at', 'COALESCE(created_at, now())')} FROM {legacy}"
+    ))
+    conn.execute(text(f"DROP TABLE {legacy}"))
+    print(f"✅ 已将 {table_name} 迁移为按月分区（{len(months)} 个分区）")
+    return months
+
+
+def _pg_existing_months(conn, table_name: str) -> List[int]:
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :name"
+    ), {"name": table_name})
+    prefix = f"{table_name}_"
+    return sorted(int(name[len(prefix):]) for (name,) in rows
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def _pg_ensure(table_name: str, wanted: List[int]) -> List[int]:
+    with engine.begin() as conn:
+        if not _pg_is_partitioned(conn, table_name):
+            return _pg_migrate(conn, table_name, wanted)
+        for month in wanted:
+            _pg_create_partition(conn, table_name, month)
+        return _pg_existing_months(conn, table_name)
+
+
+def _pg_drop(table_name: str, month: int):
+    name = partition_name(table_name, month)
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE {table_name} DETACH PARTITION {name}"))
+        conn.execute(text(f"DROP TABLE {name}"))
+
+
+# ============ 维护 ============
+
+def ensure_partitions(now: Optional[datetime] = None) -> Dict[str, List[int]]:
+    """迁移（首次）并预建当月和下月分区，返回各表现有分区月份"""
+    current = month_of(now or datetime.utcnow())
+    wanted = [current, add_months(current, 1)]
+    result = {}
+    with migration_lock(MIGRATION_LOCK):
+        for table_name in PARTITIONED_MODELS:
+            if settings.USE_SQLITE:
+                result[table_name] = _sqlite_ensure(table_name, wanted)
+            else:
+                result[table_name] = _pg_ensure(table_name, wanted)
+    with _months_lock:
+        _months.update(result)
+    return result
+
+
+def archive_partition(table_name: str, month: int) -> Path:
+    """把一个分区导出为 gzip 压缩的 JSON Lines 文件"""
+    archive_dir = Path(settings.LOG_ARCHIVE_DIR)
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    path = archive_dir / f"{partition_name(table_name, month)}.jsonl.gz"
+    table = _partition_table(table_name, month)
+    with engine.connect() as conn, gzip.open(path, "wt", encoding="utf-8") as f:
+        result = conn.execution_options(stream_results=True).execute(select(table))
+        for row in result.mappings():
+            f.write(json.dumps(dict(row), default=str, ensure_ascii=False) + "\n")
+    return path
+
+
+def _existing_months(table_name: str) -> List[int]:
+    if settings.USE_SQLITE:
+        return _sqlite_existing_months(table_name)
+    with engine.connect() as conn:
+        return _pg_existing_months(conn, table_name)
+
+
+def drop_expired_partitions(now: Optional[datetime] = None) -> List[str]:
+    """删除（可选先归档）整月都超出保留期的分区，返回已处理的分区名"""
+    if settings.LOG_RETENTION_MONTHS <= 0:
+        return []
+    # 保留当月及之前 LOG_RETENTION_MONTHS 个月
+    oldest_kept = add_months(month_of(now or datetime.utcnow()), -settings.LOG_RETENTION_MONTHS)
+    dropped = []
+    with migration_lock(MIGRATION_LOCK):
+        for table_name in PARTITIONED_MODELS:
+            # 从数据库重新读取（其他 worker 可能已删除）
+            months = _existing_months(table_name)
+            for month in [m for m in months if m < oldest_kept]:
+                if settings.LOG_ARCHIVE_DIR:
+                    archive_partition(table_name, month)
+                months.remove(month)
+                if settings.USE_SQLITE:
+                    _sqlite_drop(table_name, month, months)
+                else:
+                    _pg_drop(table_name, month)
+                dropped.append(partition_name(table_name, month))
+            with _months_lock:
+                _months[table_name] = list(months)
+    return dropped
+
+
+def _maintenance_loop():
+    while not _stop_event.wait(MAINTENANCE_INTERVAL_SECONDS):
+        try:
+            ensure_partitions()
+            for name in drop_expired_partitions():
+                print(f"🗑️  已删除过期日志分区 {name}")
+        except Exception as e:
+            print(f"⚠️  日志分区维护失败: {e}")
+
+
+def init_partitions():
+    """启动时迁移并预建分区，并启动后台维护线程"""
+    global _active, _maintenance_thread
+    if not partitioning_enabled():
+        return
+    ensure_partitions()
+    _active = True
+    for name in drop_expired_partitions():
+        print(f"🗑️  已删除过期日志分区 {name}")
+    if _maintenance_thread is None:
+        _stop_event.clear()
+        _maintenance_thread = threading.Thread(target=_maintenance_loop, name="log-partitions", daemon=True)
+        _maintenance_thread.start()
+
+
+def shutdown_partitions():
+    global _maintenance_thread
+    _stop_event.set()
+    _maintenance_thread = None
+
+
+def physical_tables(table_name: str) -> List[str]:
+    """实际存放数据的表：SQLite 分区模式下为各月份表（视图不能直接 UPDATE），否则为原表"""
+    if settings.USE_SQLITE and table_name in inspect(engine).get_view_names():
+        return [partition_name(table_name, month) for month in _sqlite_existing_months(table_name)]
+    return [table_name]
+
+
+# ============ 读取 ============
+
+def partition_source(model, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """
+    返回用于查询的实体：SQLite 分区模式下为只包含与 [start, end) 重叠的月份表的 UNION ALL；
+    PostgreSQL 由 created_at 条件自动裁剪分区，未启用分区时直接返回模型本身
+    调用方仍需对返回的实体加上 created_at 范围条件
+    """
+    if not (_active and settings.USE_SQLITE) or (start is None and end is None):
+        return model
+    table_name = model.__tablename__
+    with _months_lock:
+        months = list(_months.get(table_name, []))
+    # 每个月份表的实际范围：第一个分区向前、最后一个分区向后无界（与插入触发器一致）
+    selected = []
+    for i, month in enumerate(months):
+        lower = month_start(month) if i > 0 else None
+        upper = month_start(months[i + 1]) if i < len(months) - 1 else None
+        if (end is None or lower is None or lower < end) and (start is None or upper is None or upper > start):
+            selected.append(month)
+    if not selected or len(selected) == len(months):
+        return model
+    tables = [_partition_table(table_name, month) for month in selected]
+    source = union_all(*[select(*t.columns) for t in tables]).subquery(table_name)
+    return aliased(model, source, adapt_on_names=True)
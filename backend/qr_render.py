@@ -0,0 +1,114 @@
+"""
+TOTP 二维码渲染
+- png：PIL 渲染（1 位色），在专用渲染线程池中执行，并发渲染数量受 QR_RENDER_WORKERS 限制
+- svg：直接由二维码矩阵生成 SVG 路径，不经过 PIL，渲染最快，但未压缩时体积大于 PNG
+- uri：不渲染，只返回 otpauth URI，由客户端自行生成二维码
+- QRCode 对象按线程复用；渲染结果不缓存（URI 中含明文 TOTP 密钥，且每次注册密钥都不同）
+"""
+import base64
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import quote
+from config import settings
+
+QR_MODES = ("svg", "png", "uri")
+QR_ISSUER = "LLM-API-Manager"
+QR_MASK_PATTERN = 0
+
+
+def build_totp_uri(username: str, secret: str) -> str:
+    """生成 otpauth URI"""
+    return f"otpauth://totp/{QR_ISSUER}:{quote(username)}?secret={secret}&issuer={QR_ISSUER}"
+
+
+class QRRenderer:
+    """二维码渲染服务"""
+
+    def __init__(self, workers: int = 2, box_size: int = 10, border: int = 4):
+        self.box_size = box_size
+        self.border = border
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qr-render")
+        self._local = threading.local()
+
+    def _matrix(self, uri: str) -> list:
+        """返回含边框的模块矩阵（复用当前线程的 QRCode 对象）"""
+        import qrcode
+        qr = getattr(self._local, "qr", None)
+        if qr is None:
+            # 固定掩码，跳过 8 种掩码逐一试算评分（占生成耗时的大部分），扫码不受影响
+            qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L,
+                               box_size=self.box_size, border=self.border,
+                               mask_pattern=QR_MASK_PATTERN)
+            self._local.qr = qr
+        qr.clear()
+        qr.version = None
+        qr.add_data(uri)
+        qr.make(fit=True)
+        return qr.get_matrix()
+
+    def render_svg(self, uri: str) -> str:
+        """SVG 文本（每行连续的深色模块合并为一个矩形，全部放在单个 path 中）"""
+        matrix = self._matrix(uri)
+        size = len(matrix)
+        parts = []
+        for y, row in enumerate(matrix):
+            x = 0
+            while x < size:
+                if not row[x]:
+                    x += 1
+                    continue
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                parts.append(f"M{start} {y}h{x - start}v1H{start}z")
+        path = "".join(parts)
+        pixels = size * self.box_size
+        return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{pixels}" height="{pixels}" '
+                f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+                f'<rect width="{size}" height="{size}" fill="#fff"/>'
+                f'<path d="{path}" fill="#000"/></svg>')
+
+    def render_png(self, uri: str) -> bytes:
+        """PNG 字节（PIL），应在渲染线程池中调用"""
+        from PIL import Image
+        matrix = self._matrix(uri)
+        size = len(matrix)
+        img = Image.new("1", (size, size), 1)
+        img.putdata([0 if dark else 1 for row in matrix for dark in row])
+        img = img.resize((size * self.box_size, size * self.box_size), Image.NEAREST)
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG", optimize=False)
+        return buffer.getvalue()
+
+    def _data_uri(self, uri: str, mode: str) -> Optional[str]:
+        if mode == "svg":
+            svg = self.render_svg(uri)
+            return "data:image/svg+xml;base64," + base64.b64encode(svg.encode()).decode()
+        if mode == "png":
+            return "data:image/png;base64," + base64.b64encode(self.render_png(uri)).decode()
+        return None
+
+    def render_inline(self, uri: str, mode: str = None) -> dict:
+        """
+        在当前线程渲染，返回 {"qr_code": data URI 或 None, "totp_uri": ..., "qr_format": ...}
+        """
+        mode = mode if mode in QR_MODES else settings.QR_RENDER_MODE
+        result = {"qr_code": None, "totp_uri": uri, "qr_format": mode}
+        if mode != "uri":
+            result["qr_code"] = self._data_uri(uri, mode)
+        return result
+
+    def render(self, uri: str, mode: str = None) -> dict:
+        """同步接口使用：png 交给渲染线程池（限制并发的 PIL 渲染），svg/uri 直接在当前线程完成"""
+        mode = mode if mode in QR_MODES else settings.QR_RENDER_MODE
+        if mode == "png":
+            return self._executor.submit(self.render_inline, uri, mode).result()
+        return self.render_inline(uri, mode)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+qr_renderer = QRRenderer(settings.QR_RENDER_WORKERS)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+API密钥批量重新加密（密钥轮换或切换密文格式后执行）
+- 按主键顺序分批遍历 user_api_keys（keyset 分页，不使用 OFFSET）
+- 解密/加密在进程池中并行执行
+- 每批单独提交，并写入检查点，中断后可从检查点继续
+- 更新语句带旧密文条件，服务运行期间执行也不会覆盖用户的并发修改
+- --format aesgcm/envelope 将 Fernet 文本迁移到 api_key_cipher 二进制列，--format fernet 反向迁移
+- --rewrap-data-keys 只用当前主密钥重新包装 user_data_keys（信封加密下的主密钥轮换）
+
+运行方式: python reencrypt_keys.py [--batch-size 1000] [--workers 4] [--format aesgcm] [--checkpoint 文件] [--reset]
+          python reencrypt_keys.py --rewrap-data-keys
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+# 添加backend目录到路径
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from sqlalchemy import text
+from config import settings
+from database import engine, upgrade_schema
+from key_crypto import KeyRing, CIPHER_FORMATS, get_keyring, is_envelope, create_data_key
+
+DEFAULT_CHECKPOINT = Path(__file__).parent / "reencrypt_checkpoint.json"
+
+# 进程池工作进程内的密钥环（每个进程只派生一次）
+_worker_keyring: KeyRing = None
+
+
+def _init_worker(keys: dict, current_version: int):
+    global _worker_keyring
+    _worker_keyring = KeyRing(keys, current_version)
+
+
+def _reencrypt_rows(rows: list, cipher_format: str, raw_data_keys: dict) -> tuple:
+    """在工作进程中重新加密一批 (id, 用户ID, 旧文本, 旧二进制)，返回 (更新列表, 失败ID列表)"""
+    updated, failed = [], []
+    data_keys = {user_id: AESGCM(raw) for user_id, raw in raw_data_keys.items()}
+    for key_id, user_id, token, blob in rows:
+        try:
+            new = _worker_keyring.reencrypt(blob if blob is not None else token, cipher_format,
+                                            user_id, data_keys.get(user_id))
+        except Exception:
+            failed.append(key_id)
+            continue
+        if cipher_format == "fernet":
+            new_token, new_blob = new, None
+        else:
+            new_token, new_blob = "", new
+        updated.append({"id": key_id, "old_token": token, "old_blob": blob,
+                        "new_token": new_token, "new_blob": new_blob})
+    return updated, failed
+
+
+def load_raw_data_keys(user_ids: set, create: bool) -> dict:
+    """批量读取并解包用户数据密钥（传给工作进程），create 时为缺失的用户生成"""
+    if not user_ids:
+        return {}
+    keyring = get_keyring()
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(f"SELECT user_id, wrapped_key FROM user_data_keys "
+                 f"WHERE user_id IN ({','.join(str(int(u)) for u in user_ids)})")
+        ).fetchall()
+    wrapped = {row[0]: bytes(row[1]) for row in rows}
+    if create:
+        for user_id in user_ids - wrapped.keys():
+            wrapped[user_id] = create_data_key(user_id).wrapped_key
+    return {user_id: keyring.unwrap_key(w) for user_id, w in wrapped.items()}
+
+
+def load_checkpoint(path: Path, version: int, cipher_format: str) -> dict:
+    """读取检查点；目标版本或格式不同时从头开始"""
+    if path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("target_version") == version and checkpoint.get("format", "fernet") == cipher_format:
+            return checkpoint
+    return {"target_version": version, "format": cipher_format, "last_id": 0,
+            "updated": 0, "skipped": 0, "conflicts": 0, "failed": []}
+
+
+def save_checkpoint(path: Path, checkpoint: dict):
+    """原子写入检查点"""
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def fetch_batches(start_id: int, batch_size: int, cipher_format: str):
+    """按 id 递增分批读取，返回 (本批最大id, 需要重新加密的行, 跳过数)"""
+    keyring = get_keyring()
+    last_id = start_id
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(
+                text("SELECT id, user_id, api_key_encrypted, api_key_cipher FROM user_api_keys "
+                     "WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": batch_size}
+            ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        pending = [
+            (row[0], row[1], row[2], bytes(row[3]) if row[3] is not None else None)
+            for row in rows
+            if keyring.needs_reencrypt(row[3] if row[3] is not None else row[2], cipher_format)
+        ]
+        yield last_id, pending, len(rows) - len(pending)
+
+
+def apply_updates(updates: list) -> int:
+    """在一个事务中写回一批结果，返回因并发修改而跳过的行数"""
+    conflicts = 0
+    with engine.begin() as conn:
+        for update in updates:
+            blob_condition = "api_key_cipher IS NULL" if update["old_blob"] is None else "api_key_cipher = :old_blob"
+            result = conn.execute(
+                text("UPDATE user_api_keys SET api_key_encrypted = :new_token, api_key_cipher = :new_blob "
+                     f"WHERE id = :id AND api_key_encrypted = :old_token AND {blob_condition}"),
+                update
+            )
+            conflicts += 1 - result.rowcount
+    return conflicts
+
+
+def run_reencryption(batch_size: int = 1000, workers: int = None, cipher_format: str = None,
+                     checkpoint_path: Path = DEFAULT_CHECKPOINT, reset: bool = False) -> dict:
+    """执行重新加密，返回最终检查点"""
+    keyring = get_keyring()
+    cipher_format = cipher_format or settings.API_KEY_CIPHER_FORMAT
+    upgrade_schema()
+    if reset and checkpoint_path.exists():
+        checkpoint_path.unlink()
+    checkpoint = load_checkpoint(checkpoint_path, keyring.current_version, cipher_format)
+
+    print(f"目标: {cipher_format} 格式, 密钥版本 v{keyring.current_version}，从 id > {checkpoint['last_id']} 继续")
+    start_time = time.time()
+
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(keyring.keys, keyring.current_version)) as pool:
+        for last_id, pending, skipped in fetch_batches(checkpoint["last_id"], batch_size, cipher_format):
+            # 涉及信封格式的行需要对应用户的数据密钥
+            envelope_users = {
+                row[1] for row in pending
+                if cipher_format == "envelope" or (row[3] is not None and is_envelope(row[3]))
+            }
+            raw_data_keys = load_raw_data_keys(envelope_users, create=cipher_format == "envelope")
+
+            # 批内再拆分给各个工作进程
+            chunk_size = max(1, -(-len(pending) // workers))
+            chunks = [pending[i:i + chunk_size] for i in range(0, len(pending), chunk_size)]
+            chunk_keys = [{row[1]: raw_data_keys[row[1]] for row in chunk if row[1] in raw_data_keys}
+                          for chunk in chunks]
+            updates = []
+            for chunk_updates, chunk_failed in pool.map(_reencrypt_rows, chunks,
+                                                        [cipher_format] * len(chunks), chunk_keys):
+                updates.extend(chunk_updates)
+                checkpoint["failed"].extend(chunk_failed)
+
+            conflicts = apply_updates(updates) if updates else 0
+
+            checkpoint["last_id"] = last_id
+            checkpoint["updated"] += len(updates) - conflicts
+            checkpoint["conflicts"] += conflicts
+            checkpoint["skipped"] += skipped
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            elapsed = time.time() - start_time
+            print(f"  - 已处理至 id={last_id}，更新 {checkpoint['updated']}，"
+                  f"跳过 {checkpoint['skipped']}，用时 {elapsed:.1f}s")
+
+    print(f"完成：更新 {checkpoint['updated']}，跳过 {checkpoint['skipped']}，"
+          f"并发冲突 {checkpoint['conflicts']}，失败 {len(checkpoint['failed'])}")
+    if checkpoint["failed"]:
+        print(f"无法解密的密钥ID: {checkpoint['failed'][:20]}")
+    return checkpoint
+
+
+def run_rewrap(batch_size: int = 1000) -> dict:
+    """用当前主密钥重新包装所有数据密钥（数据密钥本身和API密钥密文不变）"""
+    keyring = get_keyring()
+    stats = {"rewrapped": 0, "skipped": 0, "conflicts": 0, "failed": []}
+    last_id = 0
+    print(f"目标主密钥版本: v{keyring.current_version}")
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(
+                text("SELECT id, key_version, wrapped_key FROM user_data_keys "
+                     "WHERE id > :last_id ORDER BY id LIMIT :limit"),
+                {"last_id": last_id, "limit": batch_size}
+            ).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+
+        updates = []
+        for key_id, key_version, wrapped in rows:
+            if key_version == keyring.current_version:
+                stats["skipped"] += 1
+                continue
+            try:
+                new_wrapped = keyring.wrap_key(keyring.unwrap_key(bytes(wrapped)))
+            except Exception:
+                stats["failed"].append(key_id)
+                continue
+            updates.append({"id": key_id, "old": bytes(wrapped), "new": new_wrapped,
+                            "version": keyring.current_version})
+
+        with engine.begin() as conn:
+            for update in updates:
+                result = conn.execute(
+                    text("UPDATE user_data_keys SET wrapped_key = :new, key_version = :version "
+                         "WHERE id = :id AND wrapped_key = :old"),
+                    update
+                )
+                stats["rewrapped"] += result.rowcount
+                stats["conflicts"] += 1 - result.rowcount
+        print(f"  - 已处理至 id={last_id}，重新包装 {stats['rewrapped']}")
+
+    print(f"完成：重新包装 {stats['rewrapped']}，跳过 {stats['skipped']}，失败 {len(stats['failed'])}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="使用当前密钥版本重新加密所有API密钥")
+    parser.add_argument("--batch-size", type=int, default=1000, help="每批读取并提交的行数")
+    parser.add_argument("--workers", type=int, default=None, help="加密进程数（默认CPU核数）")
+    parser.add_argument("--format", choices=CIPHER_FORMATS, default=None,
+                        help="目标密文格式（默认 API_KEY_CIPHER_FORMAT）")
+    parser.add_argument("--checkpoint", type=Path, default=DEFAULT_CHECKPOINT, help="检查点文件")
+    parser.add_argument("--reset", action="store_true", help="忽略已有检查点，从头开始")
+    parser.add_argument("--rewrap-data-keys", action="store_true", help="只重新包装用户数据密钥")
+    args = parser.parse_args()
+
+    if args.rewrap_data_keys:
+        run_rewrap(args.batch_size)
+    else:
+        run_reencryption(args.batch_size, args.workers, args.format, args.checkpoint, args.reset)
@@ -0,0 +1,195 @@
+"""
+待完成注册存储（注册第一步写入，第二步取出）
+- 按临时 token 存取，另有用户名索引，预占用户名为 O(1)/O(log n)
+- 过期清理按到期时间排序（内存后端用小顶堆，SQLite 后端用索引），不再每次扫描全部条目
+- memory：进程内存储，仅适用于单 worker
+- sqlite：共享 SQLite 文件，多个 uvicorn worker 之间共享预占状态
+  通过 REGISTRATION_STORE=sqlite 和 REGISTRATION_STORE_PATH 配置
+"""
+import heapq
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Optional
+from config import settings
+
+
+class PendingRegistrationStore(ABC):
+    """待完成注册存储接口"""
+
+    @abstractmethod
+    def reserve(self, token: str, username: str, data: dict, ttl_seconds: int) -> bool:
+        """写入待完成注册并预占用户名，用户名已被预占时返回 False"""
+
+    @abstractmethod
+    def get(self, token: str) -> Optional[dict]:
+        """读取未过期的注册信息"""
+
+    @abstractmethod
+    def remove(self, token: str):
+        """删除注册信息并释放用户名"""
+
+    @abstractmethod
+    def is_username_pending(self, username: str) -> bool:
+        """用户名是否已被未过期的注册预占"""
+
+    @abstractmethod
+    def purge_expired(self) -> int:
+        """清理已过期条目，返回清理数量"""
+
+
+class MemoryRegistrationStore(PendingRegistrationStore):
+    """进程内存储：token 字典 + 用户名索引 + 到期时间小顶堆"""
+
+    def __init__(self):
+        self._entries: Dict[str, tuple] = {}  # token -> (用户名, 数据, 到期时间)
+        self._by_username: Dict[str, str] = {}  # 用户名 -> token
+        self._expiry_heap = []  # (到期时间, token)
+        self._lock = threading.Lock()
+
+    def _purge(self, now: float) -> int:
+        removed = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, token = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(token)
+            # 已被提前删除的条目在堆中留有残余记录，跳过即可
+            if entry is not None and entry[2] == expires_at:
+                del self._entries[token]
+                self._by_username.pop(entry[0], None)
+                removed += 1
+        return removed
+
+    def reserve(self, token: str, username: str, data: dict, ttl_seconds: int) -> bool:
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            if username in self._by_username:
+                return False
+            expires_at = now + ttl_seconds
+            self._entries[token] = (username, data, expires_at)
+            self._by_username[username] = token
+            heapq.heappush(self._expiry_heap, (expires_at, token))
+            return True
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            self._purge(time.time())
+            entry = self._entries.get(token)
+            return dict(entry[1]) if entry else None
+
+    def remove(self, token: str):
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is not None:
+                self._by_username.pop(entry[0], None)
+
+    def is_username_pending(self, username: str) -> bool:
+        with self._lock:
+            self._purge(time.time())
+            return username in self._by_username
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            return self._purge(time.time())
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteRegistrationStore(PendingRegistrationStore):
+    """
+    共享 SQLite 文件存储，多个 worker 进程共用
+    用户名列 UNIQUE 保证并发预占只有一个成功，expires_at 索引支持按到期时间清理
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pending_registrations ("
+                "token TEXT PRIMARY KEY, username TEXT NOT NULL UNIQUE, "
+                "data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_pending_registrations_expires_at "
+                "ON pending_registrations (expires_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        """每个线程复用一个连接（WAL 模式，读写不互相阻塞）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, token: str, username: str, data: dict, ttl_seconds: int) -> bool:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM pending_registrations WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT INTO pending_registrations (token, username, data, expires_at) VALUES (?, ?, ?, ?)",
+                (token, username, json.dumps(data), now + ttl_seconds)
+            )
+            conn.execute("COMMIT")
+            return True
+        except sqlite3.IntegrityError:
+            conn.execute("ROLLBACK")
+            return False
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def get(self, token: str) -> Optional[dict]:
+        row = self._connect().execute(
+            "SELECT data FROM pending_registrations WHERE token = ? AND expires_at > ?",
+            (token, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def remove(self, token: str):
+        self._connect().execute("DELETE FROM pending_registrations WHERE token = ?", (token,))
+
+    def is_username_pending(self, username: str) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM pending_registrations WHERE username = ? AND expires_at > ?",
+            (username, time.time())
+        ).fetchone()
+        return row is not None
+
+    def purge_expired(self) -> int:
+        cursor = self._connect().execute(
+            "DELETE FROM pending_registrations WHERE expires_at <= ?", (time.time(),)
+        )
+        return cursor.rowcount
+
+
+def create_registration_store() -> PendingRegistrationStore:
+    """按 REGISTRATION_STORE 配置创建存储"""
+    if settings.REGISTRATION_STORE == "sqlite":
+        path = Path(settings.REGISTRATION_STORE_PATH)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return SQLiteRegistrationStore(path)
+    return MemoryRegistrationStore()
+
+
+_registration_store: Optional[PendingRegistrationStore] = None
+_registration_store_lock = threading.Lock()
+
+
+def get_registration_store() -> PendingRegistrationStore:
+    global _registration_store
+    if _registration_store is None:
+        with _registration_store_lock:
+            if _registration_store is None:
+                _registration_store = create_registration_store()
+    return _registration_store
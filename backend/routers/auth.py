@@ -8,15 +8,28 @@ from typing import Optional
 from pydantic import BaseModel
 from database import get_db
 from models_v2 import User, TOTPConfig, LoginHistory, LogEntry
-from schemas import UserResponse, Token, MessageResponse
+from log_details import normalize_details
+from schemas import UserResponse, Token, MessageResponse, CaptchaResponse
 from auth import (
-    verify_password, 
-    get_password_hash, 
-    create_access_token, 
-    get_current_user
+    verify_password_pooled, 
+    get_password_hash_pooled, 
+    verify_password_async,
+    get_password_hash_async,
+    password_needs_rehash,
+    issue_access_token, 
+    decode_token,
+    oauth2_scheme,
+    get_current_user,
+    set_request_user,
+    invalidate_user_cache
 )
 from totp_utils import generate_totp_secret, verify_totp_code
-import base64
+from key_crypto import invalidate_data_key
+from segment_log import purge_user_segments
+from session_store import revoke_session, revoke_user_sessions
+from registration_store import get_registration_store
+from qr_render import qr_renderer, build_totp_uri
+from captcha import captcha_pool
 
 router = APIRouter(prefix="/api", tags=["auth"])
 limiter = Limiter(key_func=get_remote_address)
@@ -54,26 +67,9 @@ class DeleteAccountRequest(BaseModel):
     totp_code: str  # 需要TOTP验证
 
 
-# ============ 临时token存储 ============
-# 生产环境应使用Redis，这里简化处理
-temp_registration_store = {}
-
-
-def is_username_in_temp_store(username: str) -> bool:
-    """检查用户名是否在临时注册存储中（防止重复注册）"""
-    # 先清理过期的临时数据
-    expired_tokens = []
-    for token, data in temp_registration_store.items():
-        if datetime.utcnow() - data["created_at"] > timedelta(minutes=10):
-            expired_tokens.append(token)
-    for token in expired_tokens:
-        del temp_registration_store[token]
-    
-    # 检查用户名是否被占用
-    for data in temp_registration_store.values():
-        if data["username"] == username:
-            return True
-    return False
+# ============ 待完成注册存储 ============
+# 见 registration_store.py，REGISTRATION_STORE=sqlite 时多个 worker 共享
+REGISTRATION_TTL_SECONDS = 600  # 10分钟
 
 
 def get_client_ip(request: Request) -> str:
@@ -92,8 +88,8 @@ def get_user_agent(request: Request) -> str:
 def log_user_action(db: Session, user_id: int, username: str, action: str, 
                    ip_address: str, user_agent: str, status: str = "success",
                    resource_type: str = None, resource_id: int = None, 
-                   resource_name: str = None, details: str = None):
-    """记录用户操作日志"""
+                   resource_name: str = None, details: str = None, commit: bool = True):
+    """记录用户操作日志（commit=False 时只加入当前事务，由调用方提交）"""
     log = LogEntry(
         user_id=user_id,
         username=username,
@@ -104,16 +100,17 @@ def log_user_action(db: Session, user_id: int, username: str, action: str,
         ip_address=ip_address,
         user_agent=user_agent,
         status=status,
-        details=details
+        details=normalize_details(details)
     )
     db.add(log)
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def record_login_history(db: Session, user_id: int, ip_address: str, user_agent: str,
                         login_type: str = "password", status: str = "success", 
-                        fail_reason: str = None):
-    """记录登录历史"""
+                        fail_reason: str = None, commit: bool = True):
+    """记录登录历史（commit=False 时只加入当前事务，由调用方提交）"""
     history = LoginHistory(
         user_id=user_id,
         ip_address=ip_address,
@@ -123,14 +120,28 @@ def record_login_history(db: Session, user_id: int, ip_address: str, user_agent:
         fail_reason=fail_reason
     )
     db.add(history)
-    db.commit()
+    if commit:
+        db.commit()
+
+
+# ============ 验证码 ============
+
+@router.get("/captcha", response_model=CaptchaResponse)
+def get_captcha():
+    """获取验证码（从预渲染池中取出，不在请求中绘图）"""
+    return captcha_pool.pop()
 
 
 # ============ 注册流程（强制TOTP）===========
 
 @router.post("/register/step1")
 @limiter.limit("5/hour")
-def register_step1(request: Request, user_data: RegisterStep1Request, db: Session = Depends(get_db)):
+def register_step1(
+    request: Request,
+    user_data: RegisterStep1Request,
+    qr_format: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
     """
     注册第一步：验证基本信息，生成TOTP密钥
     返回临时token和TOTP二维码
@@ -140,7 +151,7 @@ def register_step1(request: Request, user_data: RegisterStep1Request, db: Sessio
     if db.query(User).filter(User.username == user_data.username).first():
         raise HTTPException(status_code=400, detail="用户名已被使用")
     
-    if is_username_in_temp_store(user_data.username):
+    if get_registration_store().is_username_pending(user_data.username):
         raise HTTPException(status_code=400, detail="用户名正在被其他用户注册中，请稍后重试或更换用户名")
     
     # 密码强度验证
@@ -165,35 +176,23 @@ def register_step1(request: Request, user_data: RegisterStep1Request, db: Sessio
     import secrets
     temp_token = secrets.token_urlsafe(32)
     
-    # 存储临时注册信息
-    temp_registration_store[temp_token] = {
+    # 存储临时注册信息（同时预占用户名，并发预占同一用户名只有一个成功）
+    reserved = get_registration_store().reserve(temp_token, user_data.username, {
         "username": user_data.username,
-        "password_hash": get_password_hash(user_data.password),
+        "password_hash": get_password_hash_pooled(user_data.password),
         "totp_secret": secret,
-        "created_at": datetime.utcnow(),
         "ip": get_client_ip(request)
-    }
-    
-    # 生成二维码
-    import qrcode
-    import io
-    
-    # TOTP URI
-    totp_uri = f"otpauth://totp/LLM-API-Manager:{user_data.username}?secret={secret}&issuer=LLM-API-Manager"
-    
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(totp_uri)
-    qr.make(fit=True)
+    }, REGISTRATION_TTL_SECONDS)
+    if not reserved:
+        raise HTTPException(status_code=400, detail="用户名正在被其他用户注册中，请稍后重试或更换用户名")
     
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode()
+    # 生成二维码（QR_RENDER_MODE 或 qr_format 指定 png / svg / uri，uri 由客户端渲染）
+    qr = qr_renderer.render(build_totp_uri(user_data.username, secret), qr_format)
     
     return {
         "temp_token": temp_token,
         "totp_secret": secret,
-        "qr_code": f"data:image/png;base64,{qr_base64}",
+        **qr,
         "message": "请使用Authenticator应用扫描二维码，然后输入6位验证码完成注册",
         "success": True
     }
@@ -206,16 +205,12 @@ def register_step2(request: Request, data: RegisterStep2Request, db: Session = D
     注册第二步：验证TOTP，完成注册
     只有在这一步成功后，用户才会被写入数据库
     """
-    # 检查临时token
-    reg_data = temp_registration_store.get(data.temp_token)
+    # 检查临时token（过期条目由存储自动清理）
+    registration_store = get_registration_store()
+    reg_data = registration_store.get(data.temp_token)
     if not reg_data:
         raise HTTPException(status_code=400, detail="注册会话已过期，请重新开始注册")
     
-    # 检查是否过期（10分钟）
-    if datetime.utcnow() - reg_data["created_at"] > timedelta(minutes=10):
-        del temp_registration_store[data.temp_token]
-        raise HTTPException(status_code=400, detail="注册会话已过期，请重新开始注册")
-    
     # 验证TOTP
     if not verify_totp_code(reg_data["totp_secret"], data.totp_code):
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
@@ -223,7 +218,7 @@ def register_step2(request: Request, data: RegisterStep2Request, db: Session = D
     # 最终检查：确保用户名在数据库中仍然可用（防止并发注册）
     if db.query(User).filter(User.username == reg_data["username"]).first():
         # 清理临时数据
-        del temp_registration_store[data.temp_token]
+        registration_store.remove(data.temp_token)
         raise HTTPException(status_code=400, detail="用户名已被使用，请重新注册")
     
     # 创建用户
@@ -252,10 +247,10 @@ def register_step2(request: Request, data: RegisterStep2Request, db: Session = D
     record_login_history(db, new_user.id, ip, ua, "totp", "success")
     
     # 清理临时数据
-    del temp_registration_store[data.temp_token]
+    registration_store.remove(data.temp_token)
     
     # 生成登录token
-    access_token = create_access_token(data={"sub": new_user.username})
+    access_token = issue_access_token(db, new_user, ip, ua)
     
     return Token(
         access_token=access_token,
@@ -296,18 +291,20 @@ def login(request: Request, user_data: LoginWithTOTPRequest, db: Session = Depen
         raise HTTPException(status_code=400, detail="账户已锁定，请稍后再试")
     
     # 验证密码
-    if not verify_password(user_data.password, user.password_hash):
+    if not verify_password_pooled(user_data.password, user.password_hash):
         user.login_attempts = (user.login_attempts or 0) + 1
         
         # 5次失败后锁定30分钟
         if user.login_attempts >= 5:
             user.locked_until = datetime.utcnow() + timedelta(minutes=30)
+            record_login_history(db, user.id, ip, ua, "password", "failed", "多次失败，账户已锁定", commit=False)
             db.commit()
-            record_login_history(db, user.id, ip, ua, "password", "failed", "多次失败，账户已锁定")
+            invalidate_user_cache(user.username)
             raise HTTPException(status_code=400, detail="多次登录失败，账户已锁定30分钟")
         
+        record_login_history(db, user.id, ip, ua, "password", "failed", "密码错误", commit=False)
         db.commit()
-        record_login_history(db, user.id, ip, ua, "password", "failed", "密码错误")
+        invalidate_user_cache(user.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误",
@@ -320,24 +317,28 @@ def login(request: Request, user_data: LoginWithTOTPRequest, db: Session = Depen
         record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP未启用")
         raise HTTPException(status_code=400, detail="账户安全设置异常，请联系客服")
     
-    if not verify_totp_code(totp_config.secret, user_data.totp_code):
+    if not verify_totp_code(totp_config.secret, user_data.totp_code, user.id, db):
         user.login_attempts = (user.login_attempts or 0) + 1
+        record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP验证码错误", commit=False)
         db.commit()
-        record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP验证码错误")
+        invalidate_user_cache(user.username)
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
     
     # 登录成功
     user.login_attempts = 0
     user.locked_until = None
     user.last_login = datetime.utcnow()
+    # 哈希 rounds 与当前 BCRYPT_ROUNDS 不一致时，用本次明文密码重新生成
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = get_password_hash_pooled(user_data.password)
+    
+    # 登录历史、操作日志和会话记录与用户状态在同一事务中提交
+    record_login_history(db, user.id, ip, ua, "totp", "success", commit=False)
+    log_user_action(db, user.id, user.username, "用户登录", ip, ua, commit=False)
+    access_token = issue_access_token(db, user, ip, ua, commit=False)
     db.commit()
-    
-    # 记录登录历史
-    record_login_history(db, user.id, ip, ua, "totp", "success")
-    log_user_action(db, user.id, user.username, "用户登录", ip, ua)
-    
-    # 生成token
-    access_token = create_access_token(data={"sub": user.username})
+    invalidate_user_cache(user.username)
+    set_request_user(request, user)
     
     return Token(
         access_token=access_token,
@@ -366,10 +367,21 @@ def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 
 @router.post("/logout", response_model=MessageResponse)
-def logout(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def logout(
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     """登出"""
     ip = get_client_ip(request)
     ua = get_user_agent(request)
+    
+    # 撤销当前会话，令牌立即失效
+    jti = decode_token(token).get("jti")
+    if jti:
+        revoke_session(db, jti)
+    
     log_user_action(db, current_user.id, current_user.username, "用户登出", ip, ua)
     return MessageResponse(message="登出成功", success=True)
 
@@ -389,11 +401,11 @@ async def change_password(
     
     # 验证TOTP
     totp_config = db.query(TOTPConfig).filter(TOTPConfig.user_id == current_user.id).first()
-    if not totp_config or not verify_totp_code(totp_config.secret, data.totp_code):
+    if not totp_config or not verify_totp_code(totp_config.secret, data.totp_code, current_user.id, db):
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
     
     # 验证当前密码
-    if not verify_password(data.current_password, current_user.password_hash):
+    if not await verify_password_async(data.current_password, current_user.password_hash):
         log_user_action(db, current_user.id, current_user.username, "修改密码", ip, ua, "failed", 
                        details="当前密码错误")
         raise HTTPException(status_code=400, detail="当前密码错误")
@@ -413,9 +425,13 @@ async def change_password(
         raise HTTPException(status_code=400, detail="密码必须包含数字、字母、特殊符号中的至少两项")
     
     # 更新密码
-    current_user.password_hash = get_password_hash(data.new_password)
+    current_user.password_hash = await get_password_hash_async(data.new_password)
     current_user.updated_at = datetime.utcnow()
     db.commit()
+    invalidate_user_cache(current_user.username)
+    
+    # 撤销该用户所有会话（包括当前会话），需要重新登录
+    revoke_user_sessions(db, current_user.id)
     
     log_user_action(db, current_user.id, current_user.username, "修改密码", ip, ua, 
                    details="密码修改成功")
@@ -436,11 +452,11 @@ def delete_account(
     
     # 验证TOTP
     totp_config = db.query(TOTPConfig).filter(TOTPConfig.user_id == current_user.id).first()
-    if not totp_config or not verify_totp_code(totp_config.secret, data.totp_code):
+    if not totp_config or not verify_totp_code(totp_config.secret, data.totp_code, current_user.id, db):
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
     
     # 验证密码
-    if not verify_password(data.password, current_user.password_hash):
+    if not verify_password_pooled(data.password, current_user.password_hash):
         log_user_action(db, current_user.id, current_user.username, "删除账户", ip, ua, "failed",
                        details="密码错误")
         raise HTTPException(status_code=400, detail="密码错误")
@@ -448,9 +464,15 @@ def delete_account(
     username = current_user.username
     user_id = current_user.id
     
+    # 撤销所有会话（会话记录随用户级联删除，内存撤销集合保留到令牌过期）
+    revoke_user_sessions(db, user_id)
+    
     # 删除用户（级联删除相关数据）
     db.delete(current_user)
     db.commit()
+    invalidate_data_key(user_id)
+    purge_user_segments(user_id)
+    invalidate_user_cache(username)
     
     # 记录日志（用户已删除）
     log = LogEntry(
@@ -460,7 +482,7 @@ def delete_account(
         ip_address=ip,
         user_agent=ua,
         status="success",
-        details=f"用户 {username} (ID: {user_id}) 已删除账户"
+        details={"message": f"用户 {username} (ID: {user_id}) 已删除账户", "deleted_user_id": user_id}
     )
     db.add(log)
     db.commit()
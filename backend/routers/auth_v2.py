@@ -9,16 +9,28 @@ from typing import List, Optional
 from pydantic import BaseModel
 from database import get_db
 from models_v2 import User, TOTPConfig, LoginHistory, LogEntry
+from log_details import normalize_details
 from schemas import UserCreate, UserLogin, UserResponse, Token, MessageResponse
 from auth import (
-    verify_password, 
-    get_password_hash, 
-    create_access_token, 
-    get_current_user
+    verify_password_pooled, 
+    get_password_hash_pooled, 
+    verify_password_async,
+    get_password_hash_async,
+    password_needs_rehash,
+    issue_access_token, 
+    decode_token,
+    oauth2_scheme,
+    get_current_user,
+    set_request_user,
+    invalidate_user_cache
 )
 from totp_utils import generate_totp_secret, verify_totp_code
+from key_crypto import invalidate_data_key
+from session_store import revoke_session, revoke_user_sessions
+from registration_store import get_registration_store
+from qr_render import qr_renderer, build_totp_uri
+from segment_log import segments_enabled, get_segment_store, purge_user_segments
 from config import settings
-import base64
 
 router = APIRouter(prefix="/api", tags=["auth"])
 limiter = Limiter(key_func=get_remote_address)
@@ -50,9 +62,9 @@ class DeleteAccountRequest(BaseModel):
     password: str
 
 
-# ============ 临时token存储（生产环境应使用Redis）===========
-# 内存存储，重启后丢失
-temp_registration_store = {}
+# ============ 待完成注册存储 ============
+# 见 registration_store.py，REGISTRATION_STORE=sqlite 时多个 worker 共享
+REGISTRATION_TTL_SECONDS = 600  # 10分钟
 
 
 def get_client_ip(request: Request) -> str:
@@ -71,8 +83,8 @@ def get_user_agent(request: Request) -> str:
 def log_user_action(db: Session, user_id: int, username: str, action: str, 
                    ip_address: str, user_agent: str, status: str = "success",
                    resource_type: str = None, resource_id: int = None, 
-                   resource_name: str = None, details: dict = None):
-    """记录用户操作日志"""
+                   resource_name: str = None, details: dict = None, commit: bool = True):
+    """记录用户操作日志（commit=False 时只加入当前事务，由调用方提交）"""
     log = LogEntry(
         user_id=user_id,
         username=username,
@@ -83,16 +95,17 @@ def log_user_action(db: Session, user_id: int, username: str, action: str,
         ip_address=ip_address,
         user_agent=user_agent,
         status=status,
-        details=str(details) if details else None
+        details=normalize_details(details)
     )
     db.add(log)
-    db.commit()
+    if commit:
+        db.commit()
 
 
 def record_login_history(db: Session, user_id: int, ip_address: str, user_agent: str,
                         login_type: str = "password", status: str = "success", 
-                        fail_reason: str = None):
-    """记录登录历史"""
+                        fail_reason: str = None, commit: bool = True):
+    """记录登录历史（commit=False 时只加入当前事务，由调用方提交）"""
     history = LoginHistory(
         user_id=user_id,
         ip_address=ip_address,
@@ -102,14 +115,20 @@ def record_login_history(db: Session, user_id: int, ip_address: str, user_agent:
         fail_reason=fail_reason
     )
     db.add(history)
-    db.commit()
+    if commit:
+        db.commit()
 
 
 # ============ 注册流程（强制TOTP）===========
 
 @router.post("/register/step1")
 @limiter.limit("5/hour")
-def register_step1(request: Request, user_data: RegisterStep1Request, db: Session = Depends(get_db)):
+def register_step1(
+    request: Request,
+    user_data: RegisterStep1Request,
+    qr_format: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
     """
     注册第一步：验证基本信息，生成TOTP密钥
     返回临时token和TOTP二维码
@@ -133,36 +152,24 @@ def register_step1(request: Request, user_data: RegisterStep1Request, db: Sessio
     import secrets
     temp_token = secrets.token_urlsafe(32)
     
-    # 存储临时注册信息
-    temp_registration_store[temp_token] = {
+    # 存储临时注册信息（同时预占用户名）
+    reserved = get_registration_store().reserve(temp_token, user_data.username, {
         "username": user_data.username,
         "email": user_data.email,
-        "password_hash": get_password_hash(user_data.password),
+        "password_hash": get_password_hash_pooled(user_data.password),
         "totp_secret": secret,
-        "created_at": datetime.utcnow(),
         "ip": get_client_ip(request)
-    }
-    
-    # 生成二维码
-    import qrcode
-    import io
-    
-    # TOTP URI
-    totp_uri = f"otpauth://totp/LLM-API-Manager:{user_data.username}?secret={secret}&issuer=LLM-API-Manager"
+    }, REGISTRATION_TTL_SECONDS)
+    if not reserved:
+        raise HTTPException(status_code=400, detail="用户名正在被其他用户注册中，请稍后重试或更换用户名")
     
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(totp_uri)
-    qr.make(fit=True)
-    
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode()
+    # 生成二维码（QR_RENDER_MODE 或 qr_format 指定 png / svg / uri，uri 由客户端渲染）
+    qr = qr_renderer.render(build_totp_uri(user_data.username, secret), qr_format)
     
     return {
         "temp_token": temp_token,
         "totp_secret": secret,
-        "qr_code": f"data:image/png;base64,{qr_base64}",
+        **qr,
         "message": "请使用Authenticator应用扫描二维码，然后输入6位验证码完成注册",
         "success": True
     }
@@ -174,16 +181,12 @@ def register_step2(request: Request, data: RegisterStep2Request, db: Session = D
     """
     注册第二步：验证TOTP，完成注册
     """
-    # 检查临时token
-    reg_data = temp_registration_store.get(data.temp_token)
+    # 检查临时token（过期条目由存储自动清理）
+    registration_store = get_registration_store()
+    reg_data = registration_store.get(data.temp_token)
     if not reg_data:
         raise HTTPException(status_code=400, detail="注册会话已过期，请重新开始注册")
     
-    # 检查是否过期（10分钟）
-    if datetime.utcnow() - reg_data["created_at"] > timedelta(minutes=10):
-        del temp_registration_store[data.temp_token]
-        raise HTTPException(status_code=400, detail="注册会话已过期，请重新开始注册")
-    
     # 验证TOTP
     if not verify_totp_code(reg_data["totp_secret"], data.totp_code):
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
@@ -214,10 +217,10 @@ def register_step2(request: Request, data: RegisterStep2Request, db: Session = D
     log_user_action(db, new_user.id, new_user.username, "用户注册", ip, ua)
     
     # 清理临时数据
-    del temp_registration_store[data.temp_token]
+    registration_store.remove(data.temp_token)
     
     # 生成登录token
-    access_token = create_access_token(data={"sub": new_user.username})
+    access_token = issue_access_token(db, new_user, ip, ua)
     
     return Token(
         access_token=access_token,
@@ -259,18 +262,20 @@ def login(request: Request, user_data: LoginWithTOTPRequest, db: Session = Depen
         raise HTTPException(status_code=400, detail="账户已锁定，请稍后再试")
     
     # 验证密码
-    if not verify_password(user_data.password, user.password_hash):
+    if not verify_password_pooled(user_data.password, user.password_hash):
         user.login_attempts = (user.login_attempts or 0) + 1
         
         # 5次失败后锁定30分钟
         if user.login_attempts >= 5:
             user.locked_until = datetime.utcnow() + timedelta(minutes=30)
+            record_login_history(db, user.id, ip, ua, "password", "failed", "多次失败，账户已锁定", commit=False)
             db.commit()
-            record_login_history(db, user.id, ip, ua, "password", "failed", "多次失败，账户已锁定")
+            invalidate_user_cache(user.username)
             raise HTTPException(status_code=400, detail="多次登录失败，账户已锁定30分钟")
         
+        record_login_history(db, user.id, ip, ua, "password", "failed", "密码错误", commit=False)
         db.commit()
-        record_login_history(db, user.id, ip, ua, "password", "failed", "密码错误")
+        invalidate_user_cache(user.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误",
@@ -283,24 +288,28 @@ def login(request: Request, user_data: LoginWithTOTPRequest, db: Session = Depen
         record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP未启用")
         raise HTTPException(status_code=400, detail="账户安全设置异常，请联系管理员")
     
-    if not verify_totp_code(totp_config.secret, user_data.totp_code):
+    if not verify_totp_code(totp_config.secret, user_data.totp_code, user.id, db):
         user.login_attempts = (user.login_attempts or 0) + 1
+        record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP验证码错误", commit=False)
         db.commit()
-        record_login_history(db, user.id, ip, ua, "totp", "failed", "TOTP验证码错误")
+        invalidate_user_cache(user.username)
         raise HTTPException(status_code=400, detail="TOTP验证码错误")
     
     # 登录成功
     user.login_attempts = 0
     user.locked_until = None
     user.last_login = datetime.utcnow()
+    # 哈希 rounds 与当前 BCRYPT_ROUNDS 不一致时，用本次明文密码重新生成
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = get_password_hash_pooled(user_data.password)
+    
+    # 登录历史、操作日志和会话记录与用户状态在同一事务中提交
+    record_login_history(db, user.id, ip, ua, "totp", "success", commit=False)
+    log_user_action(db, user.id, user.username, "用户登录", ip, ua, commit=False)
+    access_token = issue_access_token(db, user, ip, ua, commit=False)
     db.commit()
-    
-    # 记录登录历史
-    record_login_history(db, user.id, ip, ua, "totp", "success")
-    log_user_action(db, user.id, user.username, "用户登录", ip, ua)
-    
-    # 生成token
-    access_token = create_access_token(data={"sub": user.username})
+    invalidate_user_cache(user.username)
+    set_request_user(request, user)
     
     return Token(
         access_token=access_token,
@@ -330,9 +339,20 @@ def get_current_user_info(current_user: User = Depends(get_current_user)):
 
 
 @router.post("/logout", response_model=MessageResponse)
-def logout(request: Request, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def logout(
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
     ip = get_client_ip(request)
     ua = get_user_agent(request)
+    
+    # 撤销当前会话，令牌立即失效
+    jti = decode_token(token).get("jti")
+    if jti:
+        revoke_session(db, jti)
+    
     log_user_action(db, current_user.id, current_user.username, "用户登出", ip, ua)
     return MessageResponse(message="登出成功", success=True)
 
@@ -351,7 +371,7 @@ async def change_password(
     ua = get_user_agent(request)
     
     # 验证当前密码
-    if not verify_password(data.current_password, current_user.password_hash):
+    if not await verify_password_async(data.current_password, current_user.password_hash):
         log_user_action(db, current_user.id, current_user.username, "修改密码", ip, ua, "failed", details={"error": "当前密码错误"})
         raise HTTPException(status_code=400, detail="当前密码错误")
     
@@ -360,9 +380,13 @@ async def change_password(
         raise HTTPException(status_code=400, detail="密码长度至少8位")
     
     # 更新密码
-    current_user.password_hash = get_password_hash(data.new_password)
+    current_user.password_hash = await get_password_hash_async(data.new_password)
     current_user.updated_at = datetime.utcnow()
     db.commit()
+    invalidate_user_cache(current_user.username)
+    
+    # 撤销该用户所有会话（包括当前会话），需要重新登录
+    revoke_user_sessions(db, current_user.id)
     
     log_user_action(db, current_user.id, current_user.username, "修改密码", ip, ua, details={"message": "密码修改成功"})
     
@@ -381,16 +405,22 @@ def delete_account(
     ua = get_user_agent(request)
     
     # 验证密码
-    if not verify_password(data.password, current_user.password_hash):
+    if not verify_password_pooled(data.password, current_user.password_hash):
         log_user_action(db, current_user.id, current_user.username, "删除账户", ip, ua, "failed", details={"error": "密码错误"})
         raise HTTPException(status_code=400, detail="密码错误")
     
     username = current_user.username
     user_id = current_user.id
     
+    # 撤销所有会话（会话记录随用户级联删除，内存撤销集合保留到令牌过期）
+    revoke_user_sessions(db, user_id)
+    
     # 删除用户（级联删除相关数据）
     db.delete(current_user)
     db.commit()
+    invalidate_data_key(user_id)
+    purge_user_segments(user_id)
+    invalidate_user_cache(username)
     
     # 记录日志（用户已删除，使用临时记录）
     log = LogEntry(
@@ -400,7 +430,7 @@ def delete_account(
         ip_address=ip,
         user_agent=ua,
         status="success",
-        details=f"用户 {username} (ID: {user_id}) 已删除账户"
+        details={"message": f"用户 {username} (ID: {user_id}) 已删除账户", "deleted_user_id": user_id}
     )
     db.add(log)
     db.commit()
@@ -458,6 +488,21 @@ def get_user_logs(
     """获取用户操作日志"""
     from sqlalchemy import desc
     
+    if segments_enabled():
+        total, records = get_segment_store().query(current_user.id, page, page_size, action)
+        return {
+            "total": total,
+            "page": page,
+            "page_size": page_size,
+            "logs": [
+                {key: record.get(key) for key in (
+                    "id", "action", "resource_type", "resource_name",
+                    "ip_address", "status", "details", "created_at"
+                )}
+                for record in records
+            ]
+        }
+    
     query = db.query(LogEntry).filter(LogEntry.user_id == current_user.id)
     
     if action:
@@ -498,6 +543,9 @@ def get_log_actions(
     """获取用户的操作类型列表"""
     from sqlalchemy import distinct
     
+    if segments_enabled():
+        return get_segment_store().actions(current_user.id)
+    
     actions = db.query(distinct(LogEntry.action))\
         .filter(LogEntry.user_id == current_user.id)\
         .all()
@@ -1,15 +1,12 @@
 # 重构版密钥管理路由 - 用户自主管理
 import os
-from base64 import urlsafe_b64encode, urlsafe_b64decode
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from datetime import datetime, timedelta
 from database import get_db
 from models_v2 import User, UserApiKey, ApiProvider, ApiModel, TokenUsage, KeyBalance, RenewalRecord, LogEntry
+from log_details import normalize_details
 from schemas import (
     UserApiKeyCreate, 
     UserApiKeyUpdate, 
@@ -19,27 +16,10 @@ from schemas import (
     MessageResponse
 )
 from auth import get_current_user
-from config import settings
+from key_crypto import store_api_key, reveal_api_key
 
 router = APIRouter(prefix="/api/keys", tags=["api-keys"])
 
-# Generate Fernet key from settings
-def get_encryption_key() -> bytes:
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=settings.ENCRYPTION_SALT,
-        iterations=100000,
-    )
-    return urlsafe_b64encode(kdf.derive(settings.API_KEY_ENCRYPTION_KEY))
-
-def encrypt_api_key(api_key: str) -> str:
-    f = Fernet(get_encryption_key())
-    return f.encrypt(api_key.encode()).decode()
-
-def decrypt_api_key(encrypted_key: str) -> str:
-    f = Fernet(get_encryption_key())
-    return f.decrypt(encrypted_key.encode()).decode()
 
 def get_key_preview(api_key: str) -> str:
     if len(api_key) <= 8:
@@ -73,7 +53,7 @@ def log_action(db: Session, user_id: int, username: str, action: str,
         ip_address=ip,
         user_agent=ua,
         status=status,
-        details=str(details) if details else None
+        details=normalize_details(details)
     )
     db.add(log)
     db.commit()
@@ -187,18 +167,16 @@ def create_api_key(
     if existing:
         raise HTTPException(status_code=400, detail="密钥名称已存在")
     
-    encrypted_key = encrypt_api_key(key_data.api_key)
-    
     new_key = UserApiKey(
         user_id=current_user.id,
         provider_id=key_data.provider_id,
         key_name=key_data.key_name,
-        api_key_encrypted=encrypted_key,
         api_key_preview=get_key_preview(key_data.api_key),
         model_id=key_data.model_id,
         notes=key_data.notes,
         status="active"
     )
+    store_api_key(db, new_key, key_data.api_key)
     
     db.add(new_key)
     db.commit()
@@ -248,7 +226,7 @@ def get_api_key(
         provider_name=provider.display_name if provider else None,
         key_name=key.key_name,
         api_key_preview=key.api_key_preview,
-        api_key=decrypt_api_key(key.api_key_encrypted),
+        api_key=reveal_api_key(db, key),
         model_id=key.model_id,
         status=key.status,
         notes=key.notes,
@@ -290,7 +268,7 @@ def update_api_key(
         key.key_name = key_data.key_name
     
     if key_data.api_key:
-        key.api_key_encrypted = encrypt_api_key(key_data.api_key)
+        store_api_key(db, key, key_data.api_key)
         key.api_key_preview = get_key_preview(key_data.api_key)
     
     if key_data.model_id is not None:
@@ -10,8 +10,10 @@ from sqlalchemy.orm import Session
 from auth import get_current_user
 from models_v2 import User, TOTPConfig
 from database import get_db
-from totp_utils import generate_totp_secret, verify_totp_code, generate_qr_code_base64
+from totp_utils import generate_totp_secret, verify_totp_code
+from qr_render import qr_renderer, build_totp_uri
 from datetime import datetime
+from typing import Optional
 import base64
 
 router = APIRouter(prefix="/api/totp", tags=["totp"])
@@ -48,7 +50,7 @@ def verify_totp(
             detail="TOTP未启用"
         )
     
-    is_valid = verify_totp_code(config.secret, code)
+    is_valid = verify_totp_code(config.secret, code, current_user.id, db)
     
     return {
         "is_valid": is_valid,
@@ -59,6 +61,7 @@ def verify_totp(
 
 @router.get("/regenerate")
 def regenerate_totp(
+    qr_format: Optional[str] = None,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -76,14 +79,14 @@ def regenerate_totp(
     
     # 生成新的临时密钥（不会立即生效）
     new_secret = generate_totp_secret()
-    qr_code = generate_qr_code_base64(current_user.username, new_secret)
+    qr = qr_renderer.render(build_totp_uri(current_user.username, new_secret), qr_format)
     
     # 存储临时密钥（实际应用中应该用Redis，这里简化处理）
     # 这里返回新密钥，用户需要在确认接口中验证新密钥
     
     return {
         "new_secret": new_secret,
-        "qr_code": f"data:image/png;base64,{qr_code}",
+        **qr,
         "message": "请扫描新二维码，然后使用新验证码确认更新",
         "success": True
     }
@@ -108,7 +111,7 @@ def confirm_regenerate_totp(
         )
     
     # 验证旧验证码
-    if not verify_totp_code(config.secret, old_code):
+    if not verify_totp_code(config.secret, old_code, current_user.id, db):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="当前TOTP验证码错误"
@@ -0,0 +1,39 @@
+"""
+用量上报路由
+- 批量写入Token使用记录（JSON 数组或 NDJSON）
+"""
+import asyncio
+from fastapi import APIRouter, Depends, Request
+from database import SessionLocal
+from models_v2 import User
+from auth import get_current_user
+from usage_ingest import parse_events, ingest_usage, read_body
+
+router = APIRouter(prefix="/api/usage", tags=["usage"])
+
+
+@router.post("/batch")
+async def ingest_usage_batch(
+    request: Request,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    批量上报Token使用记录
+    请求体为事件的 JSON 数组，或 Content-Type: application/x-ndjson 时每行一个事件
+    （请求体最大 USAGE_BATCH_MAX_BYTES 字节）；
+    按 request_id 去重（重复上报不会重复计数），密钥必须属于当前用户
+    """
+    body = await read_body(request)
+    content_type = request.headers.get("Content-Type", "")
+    user_id = current_user.id
+    
+    # 校验和写入都在线程中执行，不阻塞事件循环；线程中使用独立的数据库会话
+    def run():
+        events = parse_events(body, content_type)
+        db = SessionLocal()
+        try:
+            return ingest_usage(db, user_id, events)
+        finally:
+            db.close()
+    
+    return await asyncio.to_thread(run)
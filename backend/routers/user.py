@@ -3,14 +3,15 @@
 - 日志查看
 - 登录历史
 - Token使用记录
+- 历史记录导出（NDJSON / CSV，可选 gzip）
 - 余额管理
 - 续费功能
 """
 from datetime import datetime, timedelta
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request, Query
 from sqlalchemy.orm import Session
 from sqlalchemy import desc, func
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel
 from database import get_db
 from models_v2 import (
@@ -18,6 +19,13 @@ from models_v2 import (
     TokenUsage, KeyBalance, RenewalRecord
 )
 from auth import get_current_user
+from segment_log import segments_enabled, get_segment_store
+from partitions import partition_source
+from pagination import decode_cursor, encode_cursor, cursor_upper_bound, keyset_query, split_page
+from count_cache import check_total_mode, count_total
+from log_search import parse_terms, apply_search, highlight
+from log_details import normalize_details, parse_detail_filters, apply_detail_filters
+from exports import EXPORT_BATCH_SIZE, check_export_format, export_filename, export_response
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
@@ -47,7 +55,7 @@ def get_client_ip(request: Request) -> str:
 
 def log_action(db: Session, user_id: int, username: str, action: str, 
                ip: str, status: str = "success", resource_type: str = None,
-               resource_id: int = None, resource_name: str = None, details: str = None):
+               resource_id: int = None, resource_name: str = None, details: dict = None):
     """记录操作日志"""
     log = LogEntry(
         user_id=user_id,
@@ -58,7 +66,7 @@ def log_action(db: Session, user_id: int, username: str, action: str,
         resource_name=resource_name,
         ip_address=ip,
         status=status,
-        details=details
+        details=normalize_details(details)
     )
     db.add(log)
     db.commit()
@@ -157,29 +165,47 @@ def get_dashboard(
 
 @router.get("/login-history")
 def get_login_history(
-    page: int = 1,
-    page_size: int = 20,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
     status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    total_mode: str = Query("exact", alias="total"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取登录历史记录"""
-    query = db.query(LoginHistory).filter(LoginHistory.user_id == current_user.id)
+    """
+    获取登录历史记录（指定时间范围时只查询范围内的分区）
+    传入 cursor（上一页返回的 next_cursor）时按游标分页，不返回总数
+    总数按用户和过滤条件缓存，total=estimate 时大结果集返回估算值（total_estimated 为 true）
+    """
+    check_total_mode(total_mode)
+    after = decode_cursor(cursor) if cursor else None
+    history_source = partition_source(LoginHistory, start_date, cursor_upper_bound(end_date, after))
+    query = db.query(history_source).filter(history_source.user_id == current_user.id)
     
     if status:
-        query = query.filter(LoginHistory.status == status)
-    
-    total = query.count()
+        query = query.filter(history_source.status == status)
+    if start_date:
+        query = query.filter(history_source.created_at >= start_date)
+    if end_date:
+        query = query.filter(history_source.created_at < end_date)
+    
+    total, total_estimated = (None, False) if after else count_total(
+        db, query, "login_history", current_user.id, (status, start_date, end_date), total_mode
+    )
     
-    history = query.order_by(desc(LoginHistory.created_at))\
-        .offset((page - 1) * page_size)\
-        .limit(page_size)\
-        .all()
+    history, next_cursor = split_page(
+        keyset_query(query, history_source, page, page_size, after).all(), page_size
+    )
     
     return {
         "total": total,
+        "total_estimated": total_estimated,
         "page": page,
         "page_size": page_size,
+        "next_cursor": next_cursor,
         "items": [
             {
                 "id": h.id,
@@ -196,6 +222,40 @@ def get_login_history(
     }
 
 
+LOGIN_HISTORY_EXPORT_FIELDS = ["id", "ip_address", "location", "user_agent", "login_type",
+                               "status", "fail_reason", "created_at"]
+
+
+@router.get("/login-history/export")
+def export_login_history(
+    export_format: str = Query("ndjson", alias="format"),
+    gzip: bool = False,
+    status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """流式导出登录历史（按时间倒序，过滤条件同列表接口）"""
+    check_export_format(export_format)
+    user_id = current_user.id
+    
+    def produce(db: Session):
+        history_source = partition_source(LoginHistory, start_date, end_date)
+        query = db.query(history_source).filter(history_source.user_id == user_id)
+        if status:
+            query = query.filter(history_source.status == status)
+        if start_date:
+            query = query.filter(history_source.created_at >= start_date)
+        if end_date:
+            query = query.filter(history_source.created_at < end_date)
+        query = query.order_by(desc(history_source.created_at), desc(history_source.id))
+        for h in query.yield_per(EXPORT_BATCH_SIZE):
+            yield {field: getattr(h, field) for field in LOGIN_HISTORY_EXPORT_FIELDS}
+    
+    return export_response(produce, LOGIN_HISTORY_EXPORT_FIELDS, export_format, gzip,
+                           export_filename("login_history", user_id))
+
+
 @router.get("/login-stats")
 def get_login_stats(
     days: int = 30,
@@ -204,36 +264,37 @@ def get_login_stats(
 ):
     """获取登录统计"""
     start_date = datetime.utcnow() - timedelta(days=days)
+    history = partition_source(LoginHistory, start_date)
     
     # 总登录次数
-    total_logins = db.query(LoginHistory).filter(
-        LoginHistory.user_id == current_user.id,
-        LoginHistory.created_at >= start_date
+    total_logins = db.query(history).filter(
+        history.user_id == current_user.id,
+        history.created_at >= start_date
     ).count()
     
     # 成功/失败次数
-    success_logins = db.query(LoginHistory).filter(
-        LoginHistory.user_id == current_user.id,
-        LoginHistory.created_at >= start_date,
-        LoginHistory.status == "success"
+    success_logins = db.query(history).filter(
+        history.user_id == current_user.id,
+        history.created_at >= start_date,
+        history.status == "success"
     ).count()
     
     failed_logins = total_logins - success_logins
     
     # 唯一IP数
-    unique_ips = db.query(func.count(func.distinct(LoginHistory.ip_address))).filter(
-        LoginHistory.user_id == current_user.id,
-        LoginHistory.created_at >= start_date
+    unique_ips = db.query(func.count(func.distinct(history.ip_address))).filter(
+        history.user_id == current_user.id,
+        history.created_at >= start_date
     ).scalar() or 0
     
     # 按日期统计
     daily_logins = db.query(
-        func.date(LoginHistory.created_at).label('date'),
+        func.date(history.created_at).label('date'),
         func.count().label('count')
     ).filter(
-        LoginHistory.user_id == current_user.id,
-        LoginHistory.created_at >= start_date
-    ).group_by(func.date(LoginHistory.created_at)).all()
+        history.user_id == current_user.id,
+        history.created_at >= start_date
+    ).group_by(func.date(history.created_at)).all()
     
     return {
         "period_days": days,
@@ -249,56 +310,187 @@ def get_login_stats(
 
 @router.get("/logs")
 def get_user_logs(
-    page: int = 1,
-    page_size: int = 20,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
     action: Optional[str] = None,
     status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    detail_filters: List[str] = Query([], alias="filter"),
+    total_mode: str = Query("exact", alias="total"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取用户操作日志"""
-    query = db.query(LogEntry).filter(LogEntry.user_id == current_user.id)
+    """
+    获取用户操作日志（指定时间范围时只查询范围内的分区）
+    传入 cursor（上一页返回的 next_cursor）时按游标分页，不返回总数
+    总数按用户和过滤条件缓存，total=estimate 时大结果集返回估算值（total_estimated 为 true）
+    传入 q 时在操作、资源名称、错误信息和详情中搜索，按相关度排序，
+    每条记录附带 rank 和高亮摘要 snippet（搜索结果只支持 page 分页）
+    filter 按 details 字段过滤，可重复，如 filter=status_code>=400&filter=response_time_ms>500
+    """
+    check_total_mode(total_mode)
+    terms = parse_terms(q)
+    filters = parse_detail_filters(detail_filters)
+    if terms and cursor:
+        raise HTTPException(status_code=400, detail="搜索结果不支持游标分页")
+    after = decode_cursor(cursor) if cursor else None
+    
+    if segments_enabled():
+        total, records = get_segment_store().query(current_user.id, page, page_size, action, status,
+                                                   start_date, end_date,
+                                                   before_id=after[1] if after else None,
+                                                   terms=terms, detail_filters=filters)
+        skip = 0 if after else (page - 1) * page_size
+        next_cursor = None
+        if records and skip + len(records) < total:
+            last = records[-1]
+            next_cursor = encode_cursor(datetime.fromisoformat(last["created_at"]), last["id"])
+        return {
+            "total": None if after else total,
+            "total_estimated": False,
+            "page": page,
+            "page_size": page_size,
+            "next_cursor": None if terms else next_cursor,
+            "items": [
+                {
+                    **{key: record.get(key) for key in (
+                        "id", "action", "resource_type", "resource_id", "resource_name",
+                        "ip_address", "status", "error_message", "details", "created_at"
+                    )},
+                    **({"rank": 0, "snippet": highlight(record, terms)} if terms else {})
+                }
+                for record in records
+            ]
+        }
+    
+    logs_source = partition_source(LogEntry, start_date, cursor_upper_bound(end_date, after))
+    query = db.query(logs_source).filter(logs_source.user_id == current_user.id)
     
     if action:
-        query = query.filter(LogEntry.action.ilike(f"%{action}%"))
+        query = query.filter(logs_source.action.ilike(f"%{action}%"))
     if status:
-        query = query.filter(LogEntry.status == status)
-    
-    total = query.count()
+        query = query.filter(logs_source.status == status)
+    if start_date:
+        query = query.filter(logs_source.created_at >= start_date)
+    if end_date:
+        query = query.filter(logs_source.created_at < end_date)
+    if filters:
+        query = apply_detail_filters(query, logs_source, filters)
+    
+    if terms:
+        query = apply_search(query, logs_source, current_user.id, terms)
+    
+    total, total_estimated = (None, False) if after else count_total(
+        db, query, "logs", current_user.id,
+        (action, status, start_date, end_date, tuple(terms), tuple(filters)), total_mode
+    )
     
-    logs = query.order_by(desc(LogEntry.created_at))\
-        .offset((page - 1) * page_size)\
-        .limit(page_size)\
-        .all()
+    if terms:
+        rows = query.offset((page - 1) * page_size).limit(page_size).all()
+        logs, ranks, next_cursor = [row[0] for row in rows], [row[1] for row in rows], None
+    else:
+        logs, next_cursor = split_page(
+            keyset_query(query, logs_source, page, page_size, after).all(), page_size
+        )
+        ranks = None
+    
+    items = [
+        {
+            "id": log.id,
+            "action": log.action,
+            "resource_type": log.resource_type,
+            "resource_id": log.resource_id,
+            "resource_name": log.resource_name,
+            "ip_address": log.ip_address,
+            "status": log.status,
+            "error_message": log.error_message,
+            "details": log.details,
+            "created_at": log.created_at.isoformat() if log.created_at else None
+        }
+        for log in logs
+    ]
+    if ranks is not None:
+        for item, log, rank in zip(items, logs, ranks):
+            item["rank"] = float(rank or 0)
+            item["snippet"] = highlight(log, terms)
     
     return {
         "total": total,
+        "total_estimated": total_estimated,
         "page": page,
         "page_size": page_size,
-        "items": [
-            {
-                "id": log.id,
-                "action": log.action,
-                "resource_type": log.resource_type,
-                "resource_id": log.resource_id,
-                "resource_name": log.resource_name,
-                "ip_address": log.ip_address,
-                "status": log.status,
-                "error_message": log.error_message,
-                "details": log.details,
-                "created_at": log.created_at.isoformat() if log.created_at else None
-            }
-            for log in logs
-        ]
+        "next_cursor": next_cursor,
+        "items": items
     }
 
 
+LOG_EXPORT_FIELDS = ["id", "action", "resource_type", "resource_id", "resource_name",
+                     "ip_address", "status", "error_message", "details", "created_at"]
+
+
+@router.get("/logs/export")
+def export_user_logs(
+    export_format: str = Query("ndjson", alias="format"),
+    gzip: bool = False,
+    action: Optional[str] = None,
+    status: Optional[str] = None,
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    q: Optional[str] = None,
+    detail_filters: List[str] = Query([], alias="filter"),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    流式导出操作日志（按时间倒序，过滤、搜索条件同列表接口）
+    format=ndjson|csv，gzip=true 时压缩输出
+    """
+    check_export_format(export_format)
+    terms = parse_terms(q)
+    filters = parse_detail_filters(detail_filters)
+    user_id = current_user.id
+    
+    if segments_enabled():
+        def produce(db: Session):
+            return get_segment_store().iter_records(user_id, action, status, start_date, end_date,
+                                                    terms=terms, detail_filters=filters)
+    else:
+        def produce(db: Session):
+            logs_source = partition_source(LogEntry, start_date, end_date)
+            query = db.query(logs_source).filter(logs_source.user_id == user_id)
+            if action:
+                query = query.filter(logs_source.action.ilike(f"%{action}%"))
+            if status:
+                query = query.filter(logs_source.status == status)
+            if start_date:
+                query = query.filter(logs_source.created_at >= start_date)
+            if end_date:
+                query = query.filter(logs_source.created_at < end_date)
+            if filters:
+                query = apply_detail_filters(query, logs_source, filters)
+            if terms:
+                # 只用搜索条件过滤，导出仍按时间倒序
+                query = apply_search(query, logs_source, user_id, terms).order_by(None)
+            query = query.order_by(desc(logs_source.created_at), desc(logs_source.id))
+            for row in query.yield_per(EXPORT_BATCH_SIZE):
+                log = row[0] if terms else row
+                yield {field: getattr(log, field) for field in LOG_EXPORT_FIELDS}
+    
+    return export_response(produce, LOG_EXPORT_FIELDS, export_format, gzip,
+                           export_filename("logs", user_id))
+
+
 @router.get("/log-actions")
 def get_log_action_types(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     """获取操作类型列表"""
+    if segments_enabled():
+        return get_segment_store().actions(current_user.id)
+    
     actions = db.query(func.distinct(LogEntry.action)).filter(
         LogEntry.user_id == current_user.id
     ).all()
@@ -310,15 +502,23 @@ def get_log_action_types(
 
 @router.get("/token-usage")
 def get_token_usage(
-    page: int = 1,
-    page_size: int = 20,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
     key_id: Optional[int] = None,
     model_id: Optional[str] = None,
     days: int = 30,
+    cursor: Optional[str] = None,
+    total_mode: str = Query("exact", alias="total"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取Token使用记录"""
+    """
+    获取Token使用记录
+    传入 cursor（上一页返回的 next_cursor）时按游标分页，不返回总数
+    总数按用户和过滤条件缓存，total=estimate 时大结果集返回估算值（total_estimated 为 true）
+    """
+    check_total_mode(total_mode)
+    after = decode_cursor(cursor) if cursor else None
     start_date = datetime.utcnow() - timedelta(days=days)
     
     query = db.query(TokenUsage).filter(
@@ -331,17 +531,20 @@ def get_token_usage(
     if model_id:
         query = query.filter(TokenUsage.model_id == model_id)
     
-    total = query.count()
+    total, total_estimated = (None, False) if after else count_total(
+        db, query, "token_usage", current_user.id, (key_id, model_id, days), total_mode
+    )
     
-    usage = query.order_by(desc(TokenUsage.created_at))\
-        .offset((page - 1) * page_size)\
-        .limit(page_size)\
-        .all()
+    usage, next_cursor = split_page(
+        keyset_query(query, TokenUsage, page, page_size, after).all(), page_size
+    )
     
     return {
         "total": total,
+        "total_estimated": total_estimated,
         "page": page,
         "page_size": page_size,
+        "next_cursor": next_cursor,
         "items": [
             {
                 "id": u.id,
@@ -360,6 +563,58 @@ def get_token_usage(
     }
 
 
+TOKEN_USAGE_EXPORT_FIELDS = ["id", "key_id", "key_name", "provider", "model_id", "request_tokens",
+                             "response_tokens", "total_tokens", "cost", "request_id", "created_at"]
+
+
+@router.get("/token-usage/export")
+def export_token_usage(
+    export_format: str = Query("ndjson", alias="format"),
+    gzip: bool = False,
+    key_id: Optional[int] = None,
+    model_id: Optional[str] = None,
+    days: int = 30,
+    current_user: User = Depends(get_current_user)
+):
+    """流式导出Token使用记录（按时间倒序，过滤条件同列表接口）"""
+    check_export_format(export_format)
+    user_id = current_user.id
+    start_date = datetime.utcnow() - timedelta(days=days)
+    
+    def produce(db: Session):
+        # 密钥名称和服务商在同一查询中取出，避免逐行加载关联对象
+        query = db.query(
+            TokenUsage, UserApiKey.key_name, ApiProvider.display_name
+        ).outerjoin(UserApiKey, UserApiKey.id == TokenUsage.key_id).outerjoin(
+            ApiProvider, ApiProvider.id == TokenUsage.provider_id
+        ).filter(
+            TokenUsage.user_id == user_id,
+            TokenUsage.created_at >= start_date
+        )
+        if key_id:
+            query = query.filter(TokenUsage.key_id == key_id)
+        if model_id:
+            query = query.filter(TokenUsage.model_id == model_id)
+        query = query.order_by(desc(TokenUsage.created_at), desc(TokenUsage.id))
+        for u, key_name, provider in query.yield_per(EXPORT_BATCH_SIZE):
+            yield {
+                "id": u.id,
+                "key_id": u.key_id,
+                "key_name": key_name,
+                "provider": provider,
+                "model_id": u.model_id,
+                "request_tokens": u.request_tokens,
+                "response_tokens": u.response_tokens,
+                "total_tokens": u.total_tokens,
+                "cost": float(u.cost) if u.cost is not None else None,
+                "request_id": u.request_id,
+                "created_at": u.created_at,
+            }
+    
+    return export_response(produce, TOKEN_USAGE_EXPORT_FIELDS, export_format, gzip,
+                           export_filename("token_usage", user_id))
+
+
 @router.get("/token-stats")
 def get_token_stats(
     days: int = 30,
@@ -581,7 +836,7 @@ def renew_key(
     log_action(
         db, current_user.id, current_user.username, "续费密钥",
         ip, "success", "key", key.id, key.key_name,
-        f"金额: {data.amount}, 天数: {data.duration_days}"
+        {"amount": data.amount, "duration_days": data.duration_days}
     )
     
     return {
@@ -599,13 +854,21 @@ def renew_key(
 
 @router.get("/renewals")
 def get_renewal_records(
-    page: int = 1,
-    page_size: int = 20,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(20, ge=1, le=100),
     key_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    total_mode: str = Query("exact", alias="total"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    """获取续费记录"""
+    """
+    获取续费记录
+    传入 cursor（上一页返回的 next_cursor）时按游标分页，不返回总数
+    总数按用户和过滤条件缓存，total=estimate 时大结果集返回估算值（total_estimated 为 true）
+    """
+    check_total_mode(total_mode)
+    after = decode_cursor(cursor) if cursor else None
     query = db.query(RenewalRecord).filter(
         RenewalRecord.user_id == current_user.id
     )
@@ -613,17 +876,20 @@ def get_renewal_records(
     if key_id:
         query = query.filter(RenewalRecord.key_id == key_id)
     
-    total = query.count()
+    total, total_estimated = (None, False) if after else count_total(
+        db, query, "renewals", current_user.id, (key_id,), total_mode
+    )
     
-    records = query.order_by(desc(RenewalRecord.created_at))\
-        .offset((page - 1) * page_size)\
-        .limit(page_size)\
-        .all()
+    records, next_cursor = split_page(
+        keyset_query(query, RenewalRecord, page, page_size, after).all(), page_size
+    )
     
     return {
         "total": total,
+        "total_estimated": total_estimated,
         "page": page,
         "page_size": page_size,
+        "next_cursor": next_cursor,
         "items": [
             {
                 "id": r.id,
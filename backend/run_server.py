@@ -32,7 +32,7 @@ def clear_pyc_files(base_dir: Path):
 def create_base_tables(engine):
     """创建基础表（如果不存在）"""
     from database import Base
-    from models_v2 import User, ApiProvider, ApiModel, UserApiKey, LogEntry, TOTPConfig, LoginHistory, TokenUsage, KeyBalance, RenewalRecord
+    from models_v2 import User, ApiProvider, ApiModel, UserApiKey, LogEntry, TOTPConfig, LoginHistory, TokenUsage, KeyBalance, RenewalRecord, UserDataKey, UserSession
     
     print("创建基础数据库表...")
     Base.metadata.create_all(bind=engine)
@@ -115,8 +115,10 @@ def initialize_database():
             DATABASE_URL = settings.DATABASE_URL.replace("postgresql://", "postgresql+psycopg://")
             engine = create_engine(DATABASE_URL, pool_pre_ping=True)
         
-        # 1. 先创建基础表
+        # 1. 先创建基础表，并补齐新增列
         create_base_tables(engine)
+        from database import upgrade_schema
+        upgrade_schema(engine)
         
         # 2. 初始化默认数据
         init_default_providers(engine)
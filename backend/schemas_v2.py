@@ -146,7 +146,7 @@ class LogEntryItem(BaseModel):
     resource_name: Optional[str] = None
     ip_address: Optional[str] = None
     status: str
-    details: Optional[str] = None
+    details: Optional[dict] = None
     created_at: str
 
 class UserLogsResponse(BaseModel):
@@ -0,0 +1,500 @@
+"""
+追加写分段审计日志存储（AUDIT_STORAGE=segments 时启用）
+- 日志只追加写入分段文件 {编号}.log，超过 AUDIT_SEGMENT_MAX_MB 后滚动到新分段
+  记录格式: 长度(4字节) + JSON
+- 每个分段有对应的 {编号}.uidx，每条记录一个 24 字节索引项 (用户ID, 偏移, 用户内序号, 上一条索引项)，
+  同一用户的记录通过"上一条索引项"跨分段串成倒序链表
+- 内存中每个用户只保留记录数、最新索引项和每 CHECKPOINT_INTERVAL 条一个的检查点（稀疏索引），
+  内存占用与用户数成正比，不随日志量增长
+- 按用户倒序分页：从最近的检查点沿链表走不超过 CHECKPOINT_INTERVAL 步定位到页首，
+  再沿链表读取一页，读取通过 mmap，不扫描其他用户的记录
+- 写入时持有文件锁（fcntl 可用时），多个 worker 可以追加到同一目录；
+  写入前和读取前增量读取各 .uidx 的新增部分，看到其他 worker 写入的日志
+- 记录ID = 分段编号 << 32 | 索引项序号，无需跨进程协调即唯一且递增
+- 删除账户时写入墓碑索引项（偏移为 TOMBSTONE_OFFSET），该用户ID此前的记录和游标不再可见，
+  用户ID被复用（SQLite 没有 AUTOINCREMENT）时新用户看不到旧用户的日志
+- 旧版本只有 .idx 的分段在启动时按 .log 重建 .uidx（记录ID随之改变，旧游标失效）
+- 启用后 LogEntry 在 flush 前从会话中移出、不再写入 log_entries 表，事务提交后才写入分段文件，
+  回滚时丢弃（与数据库中的其他修改一致）
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.orm import Session
+from config import settings
+from log_details import record_matches_filters
+from log_search import record_matches
+from models_v2 import LogEntry
+
+try:
+    import fcntl
+except ImportError:  # Windows：仅支持单进程写入
+    fcntl = None
+
+RECORD_HEADER = struct.Struct(">I")
+# 用户ID, 记录偏移, 用户内序号（从 0 开始）, 同一用户上一条记录的索引项ID
+INDEX_ENTRY = struct.Struct(">QIIQ")
+NO_ENTRY = 0xFFFFFFFFFFFFFFFF
+# 墓碑索引项的偏移（删除账户）
+TOMBSTONE_OFFSET = 0xFFFFFFFF
+LOG_SUFFIX = ".log"
+INDEX_SUFFIX = ".uidx"
+
+# 每个用户每隔多少条记录保留一个检查点（定位页首最多沿链表走的步数）
+CHECKPOINT_INTERVAL = 64
+
+_log_columns = [attr.key for attr in sa_inspect(LogEntry).column_attrs if attr.key != "id"]
+
+
+def _entry_id(segment: int, number: int) -> int:
+    return (segment << 32) | number
+
+
+def _record_filter(action: Optional[str], status: Optional[str],
+                   start: Optional[datetime], end: Optional[datetime],
+                   terms: Optional[List[str]], detail_filters: Optional[List[tuple]]) -> Callable[[dict], bool]:
+    """构建逐条匹配函数（操作类型不区分大小写包含匹配，时间为 [start, end)）"""
+    action = action.lower() if action else None
+    start = start.isoformat() if start else None
+    end = end.isoformat() if end else None
+
+    def matches(record: dict) -> bool:
+        if action and action not in (record.get("action") or "").lower():
+            return False
+        if status and record.get("status") != status:
+            return False
+        if (start and record.get("created_at", "") < start) or (end and record.get("created_at", "") >= end):
+            return False
+        if terms and not record_matches(record, terms):
+            return False
+        if detail_filters and not record_matches_filters(record, detail_filters):
+            return False
+        return True
+
+    return matches
+
+
+
+class _UserIndex:
+    """单个用户的稀疏索引"""
+    __slots__ = ("count", "latest", "checkpoints", "floor")
+
+    def __init__(self, floor: int = 0):
+        self.count = 0
+        self.latest = NO_ENTRY
+        # checkpoints[k] 为序号 k * CHECKPOINT_INTERVAL 的索引项ID
+        self.checkpoints = array("Q")
+        # 最近一个墓碑的索引项ID，更早的记录属于已删除的账户
+        self.floor = floor
+
+
+class SegmentLogStore:
+    """分段日志存储"""
+
+    def __init__(self, directory: str, max_segment_bytes: int):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._users: Dict[int, _UserIndex] = {}
+        # 分段 -> 已加载的索引项数
+        self._index_pos: Dict[int, int] = {}
+        # (分段, 后缀) -> (mmap, 映射长度)
+        self._maps: Dict[Tuple[int, str], Tuple[mmap.mmap, int]] = {}
+        with self._lock, self._file_lock():
+            self._rebuild_legacy()
+            self._refresh_locked()
+
+    def _path(self, segment: int, suffix: str) -> Path:
+        return self.directory / f"{segment:08d}{suffix}"
+
+    def _segments(self) -> List[int]:
+        return sorted(int(p.stem) for p in self.directory.glob(f"*{LOG_SUFFIX}") if p.stem.isdigit())
+
+    def _file_lock(self):
+        return _FileLock(self.directory / "append.lock")
+
+    # ============ 写入 ============
+
+    def append(self, entries: List[dict]) -> int:
+        """追加一批日志（LogEntry 列名 -> 值），返回写入条数"""
+        if not entries:
+            return 0
+        with self._lock, self._file_lock():
+            # 先读入其他 worker 写入的索引项，才能接上各用户的链表
+            self._refresh_locked()
+            segments = self._segments()
+            segment = segments[-1] if segments else 0
+            log_path = self._path(segment, LOG_SUFFIX)
+            if log_path.exists() and log_path.stat().st_size >= self.max_segment_bytes:
+                segment += 1
+                log_path = self._path(segment, LOG_SUFFIX)
+
+            index_path, number = self._index_tail(segment)
+
+            pending: Dict[int, Tuple[int, int]] = {}
+            index_data = bytearray()
+            with open(log_path, "ab") as log_file:
+                offset = log_file.tell()
+                chunks = []
+                for entry in entries:
+                    payload = json.dumps(entry, default=_json_default, ensure_ascii=False).encode()
+                    chunks.append(RECORD_HEADER.pack(len(payload)))
+                    chunks.append(payload)
+                    user_id = entry.get("user_id") or 0
+                    if user_id in pending:
+                        seq, prev = pending[user_id]
+                    else:
+                        user = self._users.get(user_id)
+                        seq, prev = (user.count, user.latest) if user else (0, NO_ENTRY)
+                    index_data += INDEX_ENTRY.pack(user_id, offset, seq, prev)
+                    pending[user_id] = (seq + 1, _entry_id(segment, number))
+                    number += 1
+                    offset += RECORD_HEADER.size + len(payload)
+                log_file.write(b"".join(chunks))
+                log_file.flush()
+            # 先写数据再写索引，索引中出现的偏移一定已经可读
+            with open(index_path, "ab") as index_file:
+                index_file.write(index_data)
+            self._refresh_locked()
+        return len(entries)
+
+    def purge_user(self, user_id: int):
+        """删除账户后写入墓碑：该用户ID此前的记录不再可见（记录仍留在分段文件中）"""
+        with self._lock, self._file_lock():
+            self._refresh_locked()
+            user = self._users.get(user_id)
+            if user is None or user.latest == NO_ENTRY:
+                return
+            segments = self._segments()
+            index_path, _ = self._index_tail(segments[-1])
+            with open(index_path, "ab") as index_file:
+                index_file.write(INDEX_ENTRY.pack(user_id, TOMBSTONE_OFFSET, 0, NO_ENTRY))
+            self._refresh_locked()
+
+    def _index_tail(self, segment: int) -> Tuple[Path, int]:
+        """返回分段的 .uidx 路径和下一个索引项序号，截掉写入中断留下的不完整索引项（需持有文件锁）"""
+        index_path = self._path(segment, INDEX_SUFFIX)
+        number = self._index_pos.get(segment, 0)
+        if index_path.exists() and index_path.stat().st_size != number * INDEX_ENTRY.size:
+            os.truncate(index_path, number * INDEX_ENTRY.size)
+        return index_path, number
+
+    # ============ 索引加载 ============
+
+    def refresh(self):
+        """增量加载各分段 .uidx 的新增索引项（包括其他 worker 写入的）"""
+        with self._lock:
+            self._refresh_locked()
+
+    def _refresh_locked(self):
+        for segment in self._segments():
+            self._load_segment(segment)
+
+    def _load_segment(self, segment: int):
+        """读入一个分段 .uidx 中尚未加载的索引项，更新各用户的记录数、最新项和检查点"""
+        index_path = self._path(segment, INDEX_SUFFIX)
+        if not index_path.exists():
+            return
+        start = self._index_pos.get(segment, 0)
+        available = index_path.stat().st_size // INDEX_ENTRY.size
+        if available <= start:
+            return
+        with open(index_path, "rb") as f:
+            f.seek(start * INDEX_ENTRY.size)
+            data = f.read((available - start) * INDEX_ENTRY.size)
+        number = start
+        for user_id, offset, seq, _ in INDEX_ENTRY.iter_unpack(data):
+            entry_id = _entry_id(segment, number)
+            if offset == TOMBSTONE_OFFSET:
+                self._users[user_id] = _UserIndex(floor=entry_id)
+                number += 1
+                continue
+            user = self._users.get(user_id)
+            if user is None:
+                user = self._users[user_id] = _UserIndex()
+            if seq % CHECKPOINT_INTERVAL == 0:
+                user.checkpoints.append(entry_id)
+            user.count = seq + 1
+            user.latest = entry_id
+            number += 1
+        self._index_pos[segment] = available
+
+    def _rebuild_legacy(self):
+        """为旧版本写入（没有 .uidx）的分段按 .log 重建索引，需持有文件锁，按分段顺序进行"""
+        for segment in self._segments():
+            index_path = self._path(segment, INDEX_SUFFIX)
+            if index_path.exists():
+                self._load_segment(segment)
+                continue
+            index_data = bytearray()
+            with open(self._path(segment, LOG_SUFFIX), "rb") as f:
+                data = f.read()
+            offset, number = 0, 0
+            while offset + RECORD_HEADER.size <= len(data):
+                (length,) = RECORD_HEADER.unpack_from(data, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > len(data):
+                    break
+                user_id = json.loads(data[offset + RECORD_HEADER.size:end]).get("user_id") or 0
+                user = self._users.get(user_id)
+                if user is None:
+                    user = self._users[user_id] = _UserIndex()
+                entry_id = _entry_id(segment, number)
+                index_data += INDEX_ENTRY.pack(user_id, offset, user.count, user.latest)
+                if user.count % CHECKPOINT_INTERVAL == 0:
+                    user.checkpoints.append(entry_id)
+                user.count += 1
+                user.latest = entry_id
+                offset, number = end, number + 1
+            tmp = index_path.with_suffix(".tmp")
+            tmp.write_bytes(index_data)
+            os.replace(tmp, index_path)
+            self._index_pos[segment] = number
+            print(f"✅ 已重建审计日志分段 {segment} 的索引（{number} 条）")
+
+    # ============ 读取 ============
+
+    def _map(self, segment: int, suffix: str, needed: int) -> mmap.mmap:
+        """映射分段文件，活动分段增长到 needed 之后才重新映射"""
+        mapped = self._maps.get((segment, suffix))
+        if mapped is not None and mapped[1] >= needed:
+            return mapped[0]
+        if mapped is not None:
+            mapped[0].close()
+        with open(self._path(segment, suffix), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        self._maps[(segment, suffix)] = (mm, size)
+        return mm
+
+    def _entry(self, entry_id: int) -> Optional[Tuple[int, int, int, int]]:
+        """读取索引项 (用户ID, 偏移, 序号, 上一条)，ID 无效时返回 None"""
+        segment, number = entry_id >> 32, entry_id & 0xFFFFFFFF
+        if number >= self._index_pos.get(segment, 0):
+            return None
+        position = number * INDEX_ENTRY.size
+        mm = self._map(segment, INDEX_SUFFIX, position + INDEX_ENTRY.size)
+        return INDEX_ENTRY.unpack_from(mm, position)
+
+    def _read(self, entry_id: int, offset: int) -> dict:
+        segment = entry_id >> 32
+        mm = self._map(segment, LOG_SUFFIX, offset + RECORD_HEADER.size)
+        (length,) = RECORD_HEADER.unpack_from(mm, offset)
+        start = offset + RECORD_HEADER.size
+        mm = self._map(segment, LOG_SUFFIX, start + length)
+        record = json.loads(mm[start:start + length])
+        record["id"] = entry_id
+        return record
+
+    def _entry_at(self, user: _UserIndex, seq: int) -> int:
+        """用户序号为 seq 的索引项ID：从不早于它的最近检查点沿链表后退"""
+        k = -(-seq // CHECKPOINT_INTERVAL)
+        if k < len(user.checkpoints):
+            entry_id, current = user.checkpoints[k], k * CHECKPOINT_INTERVAL
+        else:
+            entry_id, current = user.latest, user.count - 1
+        while current > seq:
+            entry_id = self._entry(entry_id)[3]
+            current -= 1
+        return entry_id
+
+    def _walk(self, entry_id: int, limit: Optional[int] = None) -> Iterator[dict]:
+        """从 entry_id 开始沿链表读取记录（新到旧），需持有 self._lock"""
+        while entry_id != NO_ENTRY and (limit is None or limit > 0):
+            _, offset, _, prev = self._entry(entry_id)
+            yield self._read(entry_id, offset)
+            entry_id = prev
+            if limit is not None:
+                limit -= 1
+
+    def _start(self, user_id: int, before_id: Optional[int]) -> Tuple[int, int]:
+        """返回 (可见记录数, 最新一条可见记录的索引项ID)；before_id 为游标，只看更早的记录"""
+        user = self._users.get(user_id)
+        if user is None:
+            return 0, NO_ENTRY
+        if before_id is None:
+            return user.count, user.latest
+        entry = self._entry(before_id)
+        if entry is None or entry[0] != user_id or before_id < user.floor:
+            return 0, NO_ENTRY
+        return entry[2], entry[3]
+
+    def query(self, user_id: int, page: int = 1, page_size: int = 20,
+              action: Optional[str] = None, status: Optional[str] = None,
+              start: Optional[datetime] = None, end: Optional[datetime] = None,
+              before_id: Optional[int] = None,
+              terms: Optional[List[str]] = None,
+              detail_filters: Optional[List[tuple]] = None) -> Tuple[int, List[dict]]:
+        """
+        按时间倒序分页，返回 (总数, 本页记录)
+        before_id 为游标（上一页最后一条记录的 ID），只返回更早的记录，总数为游标之后的剩余条数
+        terms 为搜索词、detail_filters 为 details 过滤条件，均逐条匹配（分段文件没有索引）
+        """
+        self.refresh()
+        with self._lock:
+            available, first = self._start(user_id, before_id)
+            skip = 0 if before_id is not None else max(page - 1, 0) * page_size
+
+            if not (action or status or start or end or terms or detail_filters):
+                if skip >= available:
+                    return available, []
+                if skip:
+                    first = self._entry_at(self._users[user_id], available - 1 - skip)
+                return available, list(self._walk(first, page_size))
+
+            # 带过滤条件时从新到旧逐条匹配（需要读取该用户的全部记录才能得到总数）
+            matches = _record_filter(action, status, start, end, terms, detail_filters)
+            total, items = 0, []
+            for record in self._walk(first):
+                if not matches(record):
+                    continue
+                if skip <= total < skip + page_size:
+                    items.append(record)
+                total += 1
+            return total, items
+
+    def iter_records(self, user_id: int, action: Optional[str] = None, status: Optional[str] = None,
+                     start: Optional[datetime] = None, end: Optional[datetime] = None,
+                     terms: Optional[List[str]] = None,
+                     detail_filters: Optional[List[tuple]] = None) -> Iterator[dict]:
+        """按时间倒序逐条返回该用户符合条件的记录（用于导出，每条记录单独加锁，不一次读入内存）"""
+        self.refresh()
+        with self._lock:
+            _, entry_id = self._start(user_id, None)
+        matches = _record_filter(action, status, start, end, terms, detail_filters)
+        while entry_id != NO_ENTRY:
+            with self._lock:
+                _, offset, _, prev = self._entry(entry_id)
+                record = self._read(entry_id, offset)
+            if matches(record):
+                yield record
+            entry_id = prev
+
+    def actions(self, user_id: int) -> List[str]:
+        """该用户出现过的操作类型"""
+        self.refresh()
+        with self._lock:
+            _, first = self._start(user_id, None)
+            seen = {}
+            for record in self._walk(first):
+                seen.setdefault(record.get("action"), None)
+        return [a for a in seen if a]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"segments": len(self._index_pos),
+                    "indexed_records": sum(self._index_pos.values()),
+                    "users": len(self._users),
+                    "checkpoints": sum(len(u.checkpoints) for u in self._users.values()),
+                    "mapped": len(self._maps)}
+
+    def close(self):
+        with self._lock:
+            for mm, _ in self._maps.values():
+                mm.close()
+            self._maps.clear()
+
+
+class _FileLock:
+    """跨进程写锁（fcntl 不可用时只有进程内的 self._lock）"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if fcntl:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+        finally:
+            self.file.close()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+_segment_store: Optional[SegmentLogStore] = None
+_segment_store_lock = threading.Lock()
+
+
+def segments_enabled() -> bool:
+    return settings.AUDIT_STORAGE == "segments"
+
+
+def get_segment_store() -> SegmentLogStore:
+    global _segment_store
+    if _segment_store is None:
+        with _segment_store_lock:
+            if _segment_store is None:
+                _segment_store = SegmentLogStore(settings.AUDIT_SEGMENT_DIR,
+                                                 settings.AUDIT_SEGMENT_MAX_MB * 1024 * 1024)
+    return _segment_store
+
+
+def get_segment_store_stats() -> dict:
+    """未启用分段存储时返回空字典（不创建存储目录）"""
+    if not segments_enabled() or _segment_store is None:
+        return {}
+    return _segment_store.stats()
+
+
+def _entry_from_model(log: LogEntry) -> dict:
+    entry = {key: getattr(log, key) for key in _log_columns}
+    if entry.get("created_at") is None:
+        entry["created_at"] = datetime.utcnow()
+    return entry
+
+
+def purge_user_segments(user_id: int):
+    """删除账户后调用：隐藏该用户在分段存储中的日志（未启用分段存储时不做任何事）"""
+    if segments_enabled():
+        get_segment_store().purge_user(user_id)
+
+
+@event.listens_for(Session, "before_flush")
+def _divert_log_entries(session, flush_context, instances):
+    """启用分段存储时，把待插入的 LogEntry 移出会话，记录下来等事务提交后写入分段文件"""
+    if not segments_enabled():
+        return
+    pending = [obj for obj in session.new if isinstance(obj, LogEntry)]
+    if not pending:
+        return
+    session.info.setdefault("segment_log_entries", []).extend(_entry_from_model(log) for log in pending)
+    for log in pending:
+        session.expunge(log)
+
+
+@event.listens_for(Session, "after_commit")
+def _append_on_commit(session):
+    entries = session.info.pop("segment_log_entries", None)
+    if not entries:
+        return
+    try:
+        get_segment_store().append(entries)
+    except Exception as e:
+        # 数据库事务已提交，不再向调用方抛出
+        print(f"⚠️  写入审计日志分段失败（{len(entries)} 条）: {e}")
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_on_end(session, transaction):
+    """回滚或关闭会话时丢弃（未连接数据库的事务回滚不触发 after_rollback；提交时 after_commit 已先取走）"""
+    if transaction.parent is None:
+        session.info.pop("segment_log_entries", None)
@@ -0,0 +1,158 @@
+"""
+登录会话存储
+- 每个访问令牌带唯一 jti，签发时写入 user_sessions 表
+- 已撤销且未过期的 jti 保存在进程内集合中，get_current_user 只做一次字典查找，不访问数据库
+- 启动时从表中加载撤销集合；后台线程定期同步其他 worker 的撤销记录并清理过期条目
+- 登出撤销当前会话，修改密码、删除账户撤销该用户全部会话
+- 不带 jti 的旧令牌不受撤销影响，最长在 ACCESS_TOKEN_EXPIRE_MINUTES 后自然过期
+"""
+import threading
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from sqlalchemy.orm import Session
+from config import settings
+from database import SessionLocal
+from models_v2 import UserSession
+
+
+class RevocationSet:
+    """
+    已撤销 jti -> 过期时间
+    读取不加锁（单次字典查找），写入和清理在锁内进行，清理时整体替换字典
+    """
+
+    def __init__(self):
+        self._revoked: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def __len__(self) -> int:
+        return len(self._revoked)
+
+    def add(self, jti: str, expires_at: datetime):
+        with self._lock:
+            self._revoked[jti] = expires_at
+
+    def prune(self, now: datetime = None) -> int:
+        """移除已过期的 jti（过期令牌本身已无法通过校验），返回移除数量"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            alive = {jti: exp for jti, exp in self._revoked.items() if exp > now}
+            removed = len(self._revoked) - len(alive)
+            self._revoked = alive
+        return removed
+
+
+revoked_tokens = RevocationSet()
+
+_last_sync: Optional[datetime] = None
+_sync_thread: Optional[threading.Thread] = None
+_stop_event = threading.Event()
+
+
+def new_jti() -> str:
+    return uuid.uuid4().hex
+
+
+def record_session(db: Session, jti: str, user_id: int, expires_at: datetime,
+                   ip: str = None, ua: str = None, commit: bool = True):
+    """记录新签发的会话（commit=False 时只加入当前事务）"""
+    db.add(UserSession(jti=jti, user_id=user_id, expires_at=expires_at,
+                       ip_address=ip, user_agent=ua))
+    if commit:
+        db.commit()
+
+
+def is_token_revoked(jti: Optional[str]) -> bool:
+    """O(1) 撤销检查，不访问数据库"""
+    return jti is not None and jti in revoked_tokens
+
+
+def revoke_session(db: Session, jti: str):
+    """撤销单个会话（登出）"""
+    session = db.query(UserSession).filter(UserSession.jti == jti).first()
+    if session is None:
+        return
+    if session.revoked_at is None:
+        session.revoked_at = datetime.utcnow()
+        db.commit()
+    revoked_tokens.add(jti, session.expires_at)
+
+
+def revoke_user_sessions(db: Session, user_id: int) -> int:
+    """撤销用户全部未过期会话（修改密码、删除账户），返回撤销数量"""
+    now = datetime.utcnow()
+    sessions = db.query(UserSession).filter(
+        UserSession.user_id == user_id,
+        UserSession.revoked_at.is_(None),
+        UserSession.expires_at > now
+    ).all()
+    for session in sessions:
+        session.revoked_at = now
+    db.commit()
+    for session in sessions:
+        revoked_tokens.add(session.jti, session.expires_at)
+    return len(sessions)
+
+
+def sync_revocations(full: bool = False) -> int:
+    """
+    从 user_sessions 表加载撤销记录（full=True 时加载全部，否则只加载上次同步之后的）
+    同时清理内存和表中的过期会话，返回加载数量
+    """
+    global _last_sync
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        query = db.query(UserSession.jti, UserSession.expires_at).filter(
+            UserSession.revoked_at.isnot(None),
+            UserSession.expires_at > now
+        )
+        if not full and _last_sync is not None:
+            # 多留一个同步周期，避免 worker 之间的时钟和提交延迟造成遗漏
+            since = _last_sync - timedelta(seconds=settings.SESSION_SYNC_INTERVAL_SECONDS)
+            query = query.filter(UserSession.revoked_at >= since)
+        rows = query.all()
+        if full:
+            db.query(UserSession).filter(UserSession.expires_at <= now).delete(synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+
+    for jti, expires_at in rows:
+        revoked_tokens.add(jti, expires_at)
+    revoked_tokens.prune(now)
+    _last_sync = now
+    return len(rows)
+
+
+def _sync_loop():
+    while not _stop_event.wait(settings.SESSION_SYNC_INTERVAL_SECONDS):
+        try:
+            sync_revocations()
+        except Exception as e:
+            print(f"⚠️  会话撤销同步失败: {e}")
+
+
+def init_session_store():
+    """启动时加载撤销集合，并启动后台同步线程"""
+    global _sync_thread
+    count = sync_revocations(full=True)
+    print(f"✅ 已加载 {count} 个已撤销会话")
+    if _sync_thread is None and settings.SESSION_SYNC_INTERVAL_SECONDS > 0:
+        _stop_event.clear()
+        _sync_thread = threading.Thread(target=_sync_loop, name="session-sync", daemon=True)
+        _sync_thread.start()
+
+
+def shutdown_session_store():
+    global _sync_thread
+    _stop_event.set()
+    _sync_thread = None
+
+
+def get_session_store_stats() -> dict:
+    return {"revoked": len(revoked_tokens), "last_sync": _last_sync}
@@ -1,7 +1,13 @@
 # TOTP工具函数
 import base64
+import hashlib
+import hmac
 import secrets
-from typing import Tuple
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 def generate_totp_secret() -> str:
     """生成新的TOTP密钥"""
@@ -12,31 +18,147 @@ def generate_totp_secret() -> str:
     return base64.b32encode(random_bytes).decode('utf-8').rstrip('=')
 
 
-def verify_totp_code(secret: str, code: str, window: int = 1) -> bool:
+class TOTPVerifier:
     """
-    验证TOTP验证码
+    带缓存和防重放的TOTP验证器（RFC 6238，SHA1，6位，30秒）
+    - 按用户缓存解码后的密钥（密钥变化时自动重新解码），以及当前时间步前后 window 个窗口的验证码（每个时间步只计算一次）
+    - 防重放：最近一次验证通过的时间步之后只接受更晚时间步的验证码（RFC 6238 第 5.2 节），
+      同一验证码和窗口内更早的验证码都不能再使用
+    - 已有账户的时间步记录在 totp_configs.last_used_step（见 verify_totp_code，各 worker 共享、随用户删除）；
+      没有用户ID时（注册、更换密钥确认）以密钥为键记录在进程内
+    - 两个缓存都有上限，按最久未使用淘汰；进程内的时间步记录在窗口移出后即清理
+    """
+
+    def __init__(self, window: int = 1, interval: int = 30, digits: int = 6,
+                 max_users: int = 10000, max_used: int = 100000):
+        self.window = window
+        self.interval = interval
+        self.digits = digits
+        self.max_users = max_users
+        self.max_used = max_used
+        # 缓存键 -> [密钥字符串, 解码后的密钥, 时间步, {时间步: 验证码}]
+        self._users = OrderedDict()
+        # 缓存键 -> 最近一次验证通过的时间步
+        self._last_steps = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def decode_secret(secret: str) -> bytes:
+        """Base32 解码（自动补齐填充符，忽略大小写）"""
+        secret = secret.strip().replace(" ", "").upper()
+        return base64.b32decode(secret + "=" * (-len(secret) % 8))
+
+    def _code_at(self, key: bytes, step: int) -> str:
+        digest = hmac.new(key, struct.pack(">Q", step), hashlib.sha1).digest()
+        offset = digest[-1] & 0x0F
+        value = struct.unpack(">I", digest[offset:offset + 4])[0] & 0x7FFFFFFF
+        return str(value % (10 ** self.digits)).zfill(self.digits)
+
+    def _window_codes(self, cache_key, secret: str, step: int) -> dict:
+        """返回当前时间步有效的 {时间步: 验证码}，密钥或时间步变化时重新计算"""
+        entry = self._users.get(cache_key)
+        if entry is None or entry[0] != secret:
+            entry = [secret, self.decode_secret(secret), None, {}]
+            self._users[cache_key] = entry
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        self._users.move_to_end(cache_key)
+        if entry[2] != step:
+            entry[2] = step
+            entry[3] = {s: self._code_at(entry[1], s)
+                        for s in range(step - self.window, step + self.window + 1)}
+        return entry[3]
+
+    def _prune_last_steps(self, step: int):
+        """清理已不在任何可接受窗口内的记录（时间步 + window 小于当前时间步）"""
+        while self._last_steps:
+            last_step = next(iter(self._last_steps.values()))
+            if last_step + self.window >= step and len(self._last_steps) <= self.max_used:
+                break
+            self._last_steps.popitem(last=False)
+
+    def match(self, secret: str, code: str, user_id: int = None, for_time: float = None) -> Optional[int]:
+        """返回验证码对应的时间步（不记录、不防重放），不匹配时返回 None"""
+        code = (code or "").strip()
+        if len(code) != self.digits or not code.isdigit():
+            return None
+        step = int((time.time() if for_time is None else for_time) // self.interval)
+        cache_key = user_id if user_id is not None else secret
+        try:
+            with self._lock:
+                codes = self._window_codes(cache_key, secret, step)
+        except Exception as e:
+            print(f"TOTP验证异常: {e}")
+            return None
+        matched = None
+        for code_step, expected in codes.items():
+            if hmac.compare_digest(code, expected):
+                matched = code_step
+        return matched
+
+    def verify(self, secret: str, code: str, user_id: int = None, for_time: float = None) -> bool:
+        """
+        验证并消耗验证码（进程内防重放）
+        user_id 为空时（注册、更换密钥确认）以密钥本身作为缓存和防重放的键
+        """
+        now = time.time() if for_time is None else for_time
+        matched = self.match(secret, code, user_id, now)
+        if matched is None:
+            return False
+        cache_key = user_id if user_id is not None else secret
+        with self._lock:
+            last_step = self._last_steps.pop(cache_key, None)
+            if last_step is not None and matched <= last_step:
+                self._last_steps[cache_key] = last_step
+                return False
+            self._last_steps[cache_key] = matched
+            self._prune_last_steps(int(now // self.interval))
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"cached_users": len(self._users), "tracked_steps": len(self._last_steps)}
+
+
+totp_verifier = TOTPVerifier()
+
+
+def consume_totp_step(db, user_id: int, step: int) -> bool:
+    """
+    条件更新 totp_configs.last_used_step，只有 step 晚于已记录的时间步时才成功
+    立即提交，其他 worker 随后看到的就是新值（调用前会话中不应有未提交的修改）
+    """
+    from sqlalchemy import or_, update
+    from models_v2 import TOTPConfig
+
+    result = db.execute(
+        update(TOTPConfig).where(
+            TOTPConfig.user_id == user_id,
+            or_(TOTPConfig.last_used_step.is_(None), TOTPConfig.last_used_step < step),
+        ).values(last_used_step=step).execution_options(synchronize_session=False)
+    )
+    db.commit()
+    return result.rowcount == 1
+
+
+def verify_totp_code(secret: str, code: str, user_id: int = None, db=None) -> bool:
+    """
+    验证TOTP验证码（验证码只能使用一次，且不接受早于上次验证通过的时间步）
     
     Args:
         secret: TOTP密钥（base32编码，可以有或没有填充符）
         code: 用户输入的6位验证码
-        window: 时间窗口容错（前后各window个时间窗口）
+        user_id: 用户ID，用于缓存密钥和防重放
+        db: 数据库会话；与 user_id 同时提供时防重放记录在 totp_configs（多 worker 共享），
+            否则只在进程内防重放
     
     Returns:
         bool: 验证是否通过
     """
-    try:
-        import pyotp
-        # 确保密钥格式正确（Base32 需要填充符）
-        # pyotp 要求密钥长度必须是8的倍数，不足则用 '=' 填充
-        padded_secret = secret
-        if len(secret) % 8 != 0:
-            padded_secret = secret + '=' * (8 - len(secret) % 8)
-        
-        totp = pyotp.TOTP(padded_secret)
-        return totp.verify(code, valid_window=window)
-    except Exception as e:
-        print(f"TOTP验证异常: {e}")
-        return False
+    if user_id is None or db is None:
+        return totp_verifier.verify(secret, code, user_id)
+    step = totp_verifier.match(secret, code, user_id)
+    return step is not None and consume_totp_step(db, user_id, step)
 
 
 def generate_qr_code_base64(username: str, secret: str) -> str:
@@ -50,26 +172,10 @@ def generate_qr_code_base64(username: str, secret: str) -> str:
     Returns:
         str: base64编码的PNG图片
     """
+    from qr_render import qr_renderer, build_totp_uri
     try:
-        import qrcode
-        import io
-        
-        # TOTP URI
-        totp_uri = f"otpauth://totp/LLM-API-Manager:{username}?secret={secret}&issuer=LLM-API-Manager"
-        
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(totp_uri)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        return base64.b64encode(buffer.getvalue()).decode()
+        data_uri = qr_renderer.render(build_totp_uri(username, secret), "png")["qr_code"]
+        return data_uri.split(",", 1)[1]
     except Exception as e:
         print(f"生成二维码失败: {e}")
         return ""
@@ -77,7 +183,8 @@ def generate_qr_code_base64(username: str, secret: str) -> str:
 
 def get_totp_uri(username: str, secret: str) -> str:
     """获取TOTP URI（用于手动添加到验证器）"""
-    return f"otpauth://totp/LLM-API-Manager:{username}?secret={secret}&issuer=LLM-API-Manager"
+    from qr_render import build_totp_uri
+    return build_totp_uri(username, secret)
 
 
 def generate_backup_codes(count: int = 8) -> list:
@@ -0,0 +1,192 @@
+"""
+Token 使用记录批量写入（POST /api/usage/batch）
+- 请求体为 JSON 数组或 NDJSON（Content-Type: application/x-ndjson，每行一个事件），
+  超过 USAGE_BATCH_MAX_BYTES 时返回 413（按 Content-Length 提前拒绝，读取时也按字节数截止），
+  整批一次性用 pydantic TypeAdapter 校验（NDJSON 先拼成数组），格式错误时整批返回 400
+- 去重：(user_id, request_id) 唯一索引，批内重复只保留第一条，已写入的由 ON CONFLICT DO NOTHING 跳过
+- 归属校验批量查询：密钥必须属于当前用户，provider_id 为空时取密钥的服务商；
+  不通过的事件列在 rejected 中，其余照常写入
+- 写入使用 executemany（SQLAlchemy insertmanyvalues 合并为多行 INSERT ... RETURNING），
+  同一事务中把各密钥的 last_used_at 推进到本批最新的使用时间
+"""
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional
+from fastapi import HTTPException, Request
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.orm import Session
+from config import settings
+from count_cache import invalidate_counts
+from models_v2 import ApiProvider, TokenUsage, UserApiKey
+
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+
+# IN 查询每次的参数个数（SQLite 单条语句的参数数量有上限）
+LOOKUP_CHUNK_SIZE = 1000
+# 响应中最多列出的拒绝事件
+MAX_REJECTED_REPORTED = 100
+
+usage_table = TokenUsage.__table__
+keys_table = UserApiKey.__table__
+
+
+class UsageEvent(BaseModel):
+    """一次 API 调用的用量"""
+    model_config = {"protected_namespaces": ()}
+    
+    request_id: str = Field(..., min_length=1, max_length=100)
+    key_id: int
+    provider_id: Optional[int] = None
+    model_id: Optional[str] = Field(None, max_length=100)
+    request_tokens: int = Field(0, ge=0)
+    response_tokens: int = Field(0, ge=0)
+    total_tokens: Optional[int] = Field(None, ge=0)
+    cost: Optional[Decimal] = Field(None, ge=0, max_digits=10, decimal_places=6)
+    created_at: Optional[datetime] = None
+
+
+_events_adapter = TypeAdapter(List[UsageEvent])
+
+
+async def read_body(request: Request) -> bytes:
+    """读取请求体，超过 USAGE_BATCH_MAX_BYTES 时返回 413（不把超大请求体整个读入内存）"""
+    limit = settings.USAGE_BATCH_MAX_BYTES
+    too_large = HTTPException(status_code=413, detail=f"请求体不能超过 {limit} 字节")
+    content_length = request.headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > limit:
+        raise too_large
+    chunks, size = [], 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def parse_events(body: bytes, content_type: str) -> List[UsageEvent]:
+    """解析并校验请求体，错误时抛出 400（指出第几条事件）"""
+    if (content_type or "").split(";")[0].strip().lower() in NDJSON_CONTENT_TYPES:
+        lines = [line for line in body.splitlines() if line.strip()]
+        body = b"[" + b",".join(lines) + b"]"
+    try:
+        events = _events_adapter.validate_json(body)
+    except ValidationError as e:
+        error = e.errors()[0]
+        location = error.get("loc", ())
+        where = f"第 {location[0] + 1} 条事件" if location and isinstance(location[0], int) else "请求体"
+        field = ".".join(str(part) for part in location[1:])
+        raise HTTPException(status_code=400,
+                            detail=f"{where}{' 的 ' + field if field else ''} 无效: {error.get('msg')}")
+    if len(events) > settings.USAGE_BATCH_MAX_EVENTS:
+        raise HTTPException(status_code=413,
+                            detail=f"每批最多 {settings.USAGE_BATCH_MAX_EVENTS} 条事件")
+    return events
+
+
+def _chunks(values: List, size: int = LOOKUP_CHUNK_SIZE) -> Iterable[List]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _utc_naive(value: Optional[datetime], now: datetime) -> datetime:
+    """时间统一为不带时区的 UTC（与其他表的 datetime.utcnow 一致）"""
+    if value is None:
+        return now
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _insert_statement():
+    if settings.USE_SQLITE:
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(usage_table).on_conflict_do_nothing(
+        index_elements=["user_id", "request_id"]
+    ).returning(usage_table.c.request_id)
+
+
+def ingest_usage(db: Session, user_id: int, events: List[UsageEvent]) -> dict:
+    """写入一批用量事件，返回 {received, inserted, duplicates, rejected_count, rejected}"""
+    now = datetime.utcnow()
+    rejected = []
+
+    # 批内按 request_id 去重
+    seen, unique = set(), []
+    for index, event in enumerate(events):
+        if event.request_id in seen:
+            continue
+        seen.add(event.request_id)
+        unique.append((index, event))
+
+    # 批量查询密钥归属和服务商
+    key_providers: Dict[int, Optional[int]] = {}
+    key_ids = list({event.key_id for _, event in unique})
+    for chunk in _chunks(key_ids):
+        key_providers.update(db.execute(
+            select(UserApiKey.id, UserApiKey.provider_id).where(
+                UserApiKey.user_id == user_id, UserApiKey.id.in_(chunk)
+            )
+        ).all())
+    provider_ids = list({event.provider_id for _, event in unique if event.provider_id is not None})
+    known_providers = set()
+    for chunk in _chunks(provider_ids):
+        known_providers.update(db.execute(
+            select(ApiProvider.id).where(ApiProvider.id.in_(chunk))
+        ).scalars())
+
+    rows = []
+    for index, event in unique:
+        if event.key_id not in key_providers:
+            rejected.append({"index": index, "request_id": event.request_id,
+                             "reason": "密钥不存在或不属于当前用户"})
+            continue
+        if event.provider_id is not None and event.provider_id not in known_providers:
+            rejected.append({"index": index, "request_id": event.request_id, "reason": "服务商不存在"})
+            continue
+        rows.append({
+            "user_id": user_id,
+            "key_id": event.key_id,
+            "provider_id": event.provider_id if event.provider_id is not None else key_providers[event.key_id],
+            "model_id": event.model_id,
+            "request_tokens": event.request_tokens,
+            "response_tokens": event.response_tokens,
+            "total_tokens": (event.total_tokens if event.total_tokens is not None
+                             else event.request_tokens + event.response_tokens),
+            "cost": event.cost,
+            "request_id": event.request_id,
+            "created_at": _utc_naive(event.created_at, now),
+        })
+
+    inserted = set()
+    if rows:
+        conn = db.connection()
+        inserted = set(conn.execute(_insert_statement(), rows).scalars())
+
+        # 各密钥的最近使用时间（只前移，不被较早的补报事件回退）
+        last_used: Dict[int, datetime] = {}
+        for row in rows:
+            if row["request_id"] in inserted and row["created_at"] > last_used.get(row["key_id"], datetime.min):
+                last_used[row["key_id"]] = row["created_at"]
+        if last_used:
+            conn.execute(
+                update(keys_table).where(
+                    keys_table.c.id == bindparam("b_key_id"),
+                    keys_table.c.last_used_at.is_(None) | (keys_table.c.last_used_at < bindparam("b_used_at")),
+                ).values(last_used_at=bindparam("b_used_at")),
+                [{"b_key_id": key_id, "b_used_at": used_at} for key_id, used_at in last_used.items()],
+            )
+        db.commit()
+        if inserted:
+            invalidate_counts("token_usage", [user_id])
+
+    return {
+        "received": len(events),
+        "inserted": len(inserted),
+        "duplicates": len(events) - len(rejected) - len(inserted),
+        "rejected_count": len(rejected),
+        "rejected": rejected[:MAX_REJECTED_REPORTED],
+    }
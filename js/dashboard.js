@@ -11,6 +11,14 @@ function escapeHtml(text) {
     return div.innerHTML;
 }
 
+// 日志详情（JSON 对象）：有 message 时直接显示，否则显示紧凑的 JSON
+function formatLogDetails(details) {
+    if (details === null || details === undefined || details === '') return '-';
+    if (typeof details !== 'object') return String(details);
+    if (typeof details.message === 'string' && Object.keys(details).length === 1) return details.message;
+    return JSON.stringify(details);
+}
+
 // 数据存储
 let apiKeys = [];
 let providers = {};
@@ -726,7 +734,7 @@ function renderLogsTable(logs) {
                     ${log.status === 'success' ? '成功' : '失败'}
                 </span>
             </td>
-            <td>${escapeHtml(log.details || '-')}</td>
+            <td>${escapeHtml(formatLogDetails(log.details))}</td>
         </tr>
     `).join('');
 }